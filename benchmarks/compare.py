@@ -0,0 +1,63 @@
+import sys
+import json
+import argparse
+
+
+def load_runs(path):
+    with open(path) as f:
+        results = json.load(f)
+    return results, { run['name']: run for run in results['runs'] }
+
+def format_change(old, new):
+    if old == 0:
+        return '   n/a'
+    return f'{(new - old) / old * 100:+6.1f}%'
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description='Compare two benchmark result files, e.g. from two commits.')
+    parser.add_argument('baseline', help='Results JSON file to compare against.')
+    parser.add_argument('current', help='Results JSON file to check.')
+    parser.add_argument('--threshold', type=float, default=0.10, help='Relative slowdown of a run, or of any of its phases, that counts as a regression. Default is 0.10.')
+    parser.add_argument('--min-secs', type=float, default=0.5, help='Phases faster than this in both files are too noisy to flag. Default is 0.5.')
+    args = parser.parse_args(args)
+
+    baseline, old_runs = load_runs(args.baseline)
+    current, new_runs = load_runs(args.current)
+    print(f'baseline: {baseline.get("commit")} current: {current.get("commit")}')
+
+    regressions = []
+    for name, new in new_runs.items():
+        old = old_runs.get(name)
+        if old is None:
+            print(f'{name}: not in baseline')
+            continue
+
+        rows = [ ('total', old['wall_secs'], new['wall_secs']) ]
+        for phase, new_secs in new['phases'].items():
+            if phase in old['phases']:
+                rows.append((phase, old['phases'][phase], new_secs))
+
+        print(name)
+        for label, old_secs, new_secs in rows:
+            regressed = (max(old_secs, new_secs) >= args.min_secs and
+                         new_secs > old_secs * (1 + args.threshold))
+            if regressed:
+                regressions.append(f'{name} {label}')
+            flag = '  REGRESSION' if regressed else ''
+            print(f'    {label:<20} {old_secs:9.2f}s {new_secs:9.2f}s {format_change(old_secs, new_secs)}{flag}')
+
+        old_rss, new_rss = old['peak_rss_kb'], new['peak_rss_kb']
+        print(f'    {"peak rss":<20} {old_rss / 1024:8.1f}M {new_rss / 1024:8.1f}M {format_change(old_rss, new_rss)}')
+        if old['output'] != new['output']:
+            print(f'    output changed: {old["output"]} -> {new["output"]}')
+
+    if regressions:
+        print(f'{len(regressions)} regressions over {args.threshold:.0%}:')
+        for r in regressions:
+            print(f'    {r}')
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,249 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import subprocess
+
+from pathlib import Path
+from datetime import datetime, timezone
+
+from pmtiles_mosaic.partition import parse_memory_size
+
+from .synthetic import TilesetSpec, SOURCE_FORMATS, get_source
+from .server import LocalServer, copy_mosaic
+
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+
+TOOLS = ['partition', 'partition-basic', 'download-mosaic']
+
+SCENARIOS = {
+    # ~10k vector tiles, a few partitions
+    'small': {
+        'spec': { 'max_zoom': 10, 'tile_size': 4096, 'dup_ratio': 0.3 },
+        'size_limit': '8M',
+    },
+    # ~170k vector tiles, mostly repeated
+    'medium': {
+        'spec': { 'max_zoom': 12, 'tile_size': 2048, 'dup_ratio': 0.5 },
+        'size_limit': '32M',
+    },
+    # ~3k png tiles, with transparent tiles to drop
+    'raster': {
+        'spec': { 'max_zoom': 9, 'tile_format': 'png', 'dup_ratio': 0.4 },
+        'size_limit': '1M',
+        'partition_args': ['--exclude-transparent'],
+    },
+    # ~680k tiny vector tiles in a single partition, partitioned under a memory budget which
+    # the anonymous memory of the run is checked against, about twice what the interpreter holds
+    'memory': {
+        'spec': { 'max_zoom': 13, 'tile_size': 64, 'dup_ratio': 0.3 },
+        'size_limit': '64M',
+        'max_memory': '40M',
+    },
+}
+
+
+def get_git_info():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=REPO_DIR,
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, status != ''
+
+def get_output_stats(out_dir):
+    files = [ f for f in Path(out_dir).rglob('*') if f.is_file() ]
+    return {
+        'num_files': len(files),
+        'total_bytes': sum(f.stat().st_size for f in files),
+    }
+
+
+class BenchmarkRunner:
+    def __init__(self, work_dir, repeat=1, keep_outputs=False):
+        self.work_dir = Path(work_dir)
+        self.sources_dir = self.work_dir / 'sources'
+        self.runs_dir = self.work_dir / 'runs'
+        self.repeat = repeat
+        self.keep_outputs = keep_outputs
+        self.results = []
+
+    def run_case(self, name, tool, args, out_dir, max_memory=None):
+        # runs the tool repeat times in a fresh process, keeps every measurement
+        measurements = []
+        for i in range(self.repeat):
+            if out_dir.exists():
+                shutil.rmtree(out_dir)
+            out_dir.mkdir(parents=True)
+            timings_file = out_dir.parent / f'{out_dir.name}.timings.json'
+            metrics_file = out_dir.parent / f'{out_dir.name}.metrics.json'
+            log_file = out_dir.parent / f'{out_dir.name}.log'
+
+            env = dict(os.environ, PYTHONPATH=str(REPO_DIR))
+            cmd = ([ sys.executable, '-m', 'benchmarks.runner', tool, str(timings_file) ] +
+                   args + [ '--metrics-file', str(metrics_file) ])
+            start = time.perf_counter()
+            with open(log_file, 'w') as log:
+                proc = subprocess.run(cmd, cwd=out_dir, env=env, stdout=log, stderr=subprocess.STDOUT)
+            wall_secs = time.perf_counter() - start
+            if proc.returncode != 0:
+                raise Exception(f'{name} failed with exit code {proc.returncode}, see {log_file}')
+
+            measurement = json.loads(timings_file.read_text())
+            measurement['wall_secs'] = wall_secs
+            measurement['output'] = get_output_stats(out_dir)
+            measurements.append(measurement)
+            print(f'{name} [{i + 1}/{self.repeat}]: {wall_secs:.2f}s', flush=True)
+
+        best = min(measurements, key=lambda m: m['wall_secs'])
+        result = {
+            'name': name,
+            'tool': tool,
+            'args': args,
+            'wall_secs': best['wall_secs'],
+            'phases': best['phases'],
+            'peak_rss_kb': max(m['peak_rss_kb'] for m in measurements),
+            'peak_anon_kb': max(m['peak_anon_kb'] for m in measurements),
+            'peak_anon_growth_kb': max(m['peak_anon_growth_kb'] for m in measurements),
+            'output': best['output'],
+            'repeats': measurements,
+        }
+        if max_memory is not None:
+            budget_bytes = parse_memory_size(max_memory)
+            result['max_memory'] = budget_bytes
+            result['within_budget'] = result['peak_anon_kb'] * 1024 <= budget_bytes
+            status = 'within' if result['within_budget'] else 'OVER'
+            print(f'{name}: anonymous memory peaked at {result["peak_anon_kb"] / 1024:.1f}M, {status} the {max_memory} budget', flush=True)
+        self.results.append(result)
+        return result
+
+    def run_scenario(self, scenario_name, scenario, formats, tools, extra_args):
+        spec = TilesetSpec(**scenario['spec'])
+        size_limit = scenario['size_limit']
+        scenario_dir = self.runs_dir / scenario_name
+
+        mosaic_prefix = None
+        for source_format in formats:
+            start = time.perf_counter()
+            source = get_source(spec, source_format, self.sources_dir)
+            print(f'{scenario_name}: {source_format} source ready in {time.perf_counter() - start:.2f}s', flush=True)
+
+            for tool in ['partition', 'partition-basic']:
+                if tool not in tools:
+                    continue
+                out_dir = scenario_dir / f'{tool}-{source_format}'
+                args = [ '--from-source', str(source),
+                         '--to-pmtiles', str(out_dir / 'out.pmtiles'),
+                         '--size-limit', size_limit ]
+                max_memory = None
+                if tool == 'partition':
+                    args += scenario.get('partition_args', [])
+                    max_memory = scenario.get('max_memory')
+                    if max_memory is not None:
+                        args += [ '--max-memory', max_memory ]
+                args += extra_args.get(tool, [])
+                self.run_case(f'{scenario_name}/{tool}/{source_format}', tool, args, out_dir, max_memory=max_memory)
+
+                if tool == 'partition' and mosaic_prefix is None:
+                    mosaic_prefix = out_dir / 'out'
+
+        if 'download-mosaic' in tools:
+            self.run_downloads(scenario_name, scenario_dir, mosaic_prefix, extra_args)
+
+        if not self.keep_outputs:
+            shutil.rmtree(scenario_dir, ignore_errors=True)
+
+    def run_downloads(self, scenario_name, scenario_dir, mosaic_prefix, extra_args):
+        if mosaic_prefix is None or not Path(f'{mosaic_prefix}.mosaic.json').exists():
+            print(f'{scenario_name}: no mosaic from partition to download, skipping download-mosaic', flush=True)
+            return
+
+        serve_dir = scenario_dir / 'remote'
+        serve_dir.mkdir(parents=True, exist_ok=True)
+        mosaic_name = copy_mosaic(mosaic_prefix, serve_dir)
+        with LocalServer(serve_dir) as server:
+            for archive_type in ['pmtiles', 'mbtiles']:
+                out_dir = scenario_dir / f'download-mosaic-{archive_type}'
+                args = [ '--mosaic-url', server.get_url(mosaic_name),
+                         '--output-file', str(out_dir / f'out.{archive_type}') ]
+                args += extra_args.get('download-mosaic', [])
+                self.run_case(f'{scenario_name}/download-mosaic/{archive_type}', 'download-mosaic', args, out_dir)
+
+    def write_results(self, out_file, scenarios):
+        commit, dirty = get_git_info()
+        results = {
+            'version': 1,
+            'created': datetime.now(timezone.utc).isoformat(),
+            'commit': commit,
+            'dirty': dirty,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'scenarios': { name: { 'spec': TilesetSpec(**s['spec']).to_dict(), 'size_limit': s['size_limit'] }
+                           for name, s in scenarios.items() },
+            'runs': self.results,
+        }
+        out_file = Path(out_file)
+        out_file.parent.mkdir(parents=True, exist_ok=True)
+        out_file.write_text(json.dumps(results, indent=2))
+        print(f'Wrote results to {out_file}')
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description='Time the partition, partition-basic and download-mosaic tools on synthetic tilesets.')
+    parser.add_argument('--scenario', action='append', choices=list(SCENARIOS.keys()), help='Scenario to run. Can be repeated. Default is small.')
+    parser.add_argument('--source-format', action='append', choices=SOURCE_FORMATS, help='Source format to partition from. Can be repeated. Default is all of them.')
+    parser.add_argument('--tool', action='append', choices=TOOLS, help='Tool to time. Can be repeated. Default is all of them.')
+    parser.add_argument('--max-zoom', type=int, help='Override the max zoom of the scenarios, each zoom level adds about 3 times the tiles so far.')
+    parser.add_argument('--tile-size', type=int, help='Override the mean size of the vector tiles, in bytes.')
+    parser.add_argument('--dup-ratio', type=float, help='Override the fraction of tiles repeating one of a few blobs.')
+    parser.add_argument('--size-limit', help='Override the partition size limit of the scenarios.')
+    parser.add_argument('--partition-args', default='', help='Extra arguments for partition, e.g. "--workers 4 --strategy hilbert".')
+    parser.add_argument('--partition-basic-args', default='', help='Extra arguments for partition-basic.')
+    parser.add_argument('--download-mosaic-args', default='', help='Extra arguments for download-mosaic.')
+    parser.add_argument('--repeat', type=int, default=1, help='Number of times to run each case, the fastest run is reported. Default is 1.')
+    parser.add_argument('--work-dir', default=str(REPO_DIR / '.bench'), help='Directory for the generated sources, which are reused across runs, and the outputs. Default is .bench in the repository.')
+    parser.add_argument('--keep-outputs', action='store_true', default=False, help='Keep the outputs of the tools instead of deleting them after each scenario.')
+    parser.add_argument('--output', help='Results JSON file. Default is <work-dir>/results/<time>-<commit>.json.')
+    args = parser.parse_args(args)
+
+    overrides = { k: v for k, v in [('max_zoom', args.max_zoom), ('tile_size', args.tile_size), ('dup_ratio', args.dup_ratio)] if v is not None }
+    scenarios = {}
+    for name in args.scenario or ['small']:
+        scenario = dict(SCENARIOS[name])
+        scenario['spec'] = dict(scenario['spec'], **overrides)
+        if args.size_limit is not None:
+            scenario['size_limit'] = args.size_limit
+        scenarios[name] = scenario
+
+    extra_args = {
+        'partition': args.partition_args.split(),
+        'partition-basic': args.partition_basic_args.split(),
+        'download-mosaic': args.download_mosaic_args.split(),
+    }
+
+    runner = BenchmarkRunner(args.work_dir, repeat=args.repeat, keep_outputs=args.keep_outputs)
+    for name, scenario in scenarios.items():
+        runner.run_scenario(name, scenario, args.source_format or SOURCE_FORMATS, args.tool or TOOLS, extra_args)
+
+    out_file = args.output
+    if out_file is None:
+        commit, _ = get_git_info()
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+        out_file = Path(args.work_dir) / 'results' / f'{stamp}-{(commit or "nogit")[:10]}.json'
+    runner.write_results(out_file, scenarios)
+
+    over_budget = [ r['name'] for r in runner.results if r.get('within_budget') is False ]
+    if over_budget:
+        print(f'{len(over_budget)} runs went over their memory budget: {", ".join(over_budget)}')
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,130 @@
+import sys
+import json
+import time
+import resource
+import threading
+import importlib
+
+from pathlib import Path
+
+
+# the module of each tool, the tools time their own phases in their --metrics-file
+TOOL_MODULES = {
+    'partition': 'pmtiles_mosaic.partition',
+    'partition-basic': 'pmtiles_mosaic.partition_basic',
+    'download-mosaic': 'pmtiles_mosaic.download_mosaic',
+}
+
+
+def get_metrics_file(args):
+    for i, arg in enumerate(args):
+        if arg == '--metrics-file' and i + 1 < len(args):
+            return args[i + 1]
+        if arg.startswith('--metrics-file='):
+            return arg.split('=', 1)[1]
+    return None
+
+def get_anon_rss_kb(pid='self'):
+    # the resident memory not backed by a file, unlike ru_maxrss this leaves
+    # out the pages of the memory mapped sources, index and spill files
+    try:
+        for line in Path(f'/proc/{pid}/status').read_text().splitlines():
+            if line.startswith('RssAnon:'):
+                return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+def get_anon_pss_kb(pid='self'):
+    # the same, but with the pages a forked worker still shares with its parent split
+    # between them, so that the processes can be added up without counting those twice
+    try:
+        for line in Path(f'/proc/{pid}/smaps_rollup').read_text().splitlines():
+            if line.startswith('Pss_Anon:'):
+                return int(line.split()[1])
+    except OSError:
+        pass
+    return get_anon_rss_kb(pid)
+
+def get_descendant_pids(pid='self'):
+    pids = []
+    for children_file in Path(f'/proc/{pid}/task').glob('*/children'):
+        try:
+            pids.extend(children_file.read_text().split())
+        except OSError:
+            pass
+    for child_pid in list(pids):
+        pids.extend(get_descendant_pids(child_pid))
+    return pids
+
+
+# Samples the anonymous memory of the process and its worker processes added up, in a thread,
+# as the budget of --max-memory is meant to bound it. The worker processes alone are kept too
+class AnonRssSampler:
+    def __init__(self, interval_secs=0.005):
+        self.interval_secs = interval_secs
+        self.baseline_kb = get_anon_pss_kb()
+        self.peak_kb = self.baseline_kb
+        self.peak_workers_kb = 0
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def sample(self):
+        workers_kb = sum(get_anon_pss_kb(pid) for pid in get_descendant_pids())
+        self.peak_kb = max(self.peak_kb, get_anon_pss_kb() + workers_kb)
+        self.peak_workers_kb = max(self.peak_workers_kb, workers_kb)
+
+    def run(self):
+        while not self.stop_event.wait(self.interval_secs):
+            self.sample()
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop_event.set()
+        self.thread.join()
+        self.sample()
+
+
+def run_tool(tool, args):
+    # returns the phase timings and the peak memory use of a run of the tool
+    metrics_file = get_metrics_file(args)
+    if metrics_file is None:
+        raise ValueError('the phase timings are read from the metrics file of the tool, pass --metrics-file')
+    module = importlib.import_module(TOOL_MODULES[tool])
+
+    start = time.perf_counter()
+    with AnonRssSampler() as sampler:
+        if tool == 'download-mosaic':
+            sys.argv = [tool] + args
+            module.cli()
+        else:
+            module.partition_main(args)
+    total = time.perf_counter() - start
+
+    metrics = json.loads(Path(metrics_file).read_text())
+    return {
+        'total_secs': total,
+        'phases': { name: phase['secs'] for name, phase in metrics['phases'].items() },
+        # counters and rates reported by the tool itself
+        'metrics': metrics,
+        # in kilobytes on linux, children are the worker processes
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'peak_children_rss_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        # the process and its workers together, which --max-memory bounds, and
+        # the growth of that over what the interpreter and the imports already hold
+        'baseline_anon_kb': sampler.baseline_kb,
+        'peak_anon_kb': sampler.peak_kb,
+        'peak_anon_growth_kb': sampler.peak_kb - sampler.baseline_kb,
+        'peak_workers_anon_kb': sampler.peak_workers_kb,
+    }
+
+
+# python -m benchmarks.runner <tool> <timings json file> <tool arguments>...
+if __name__ == '__main__':
+    tool, out_file = sys.argv[1], sys.argv[2]
+    result = run_tool(tool, sys.argv[3:])
+    with open(out_file, 'w') as f:
+        json.dump(result, f)
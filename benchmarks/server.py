@@ -0,0 +1,105 @@
+import os
+import re
+import shutil
+import threading
+
+from functools import partial
+from http import HTTPStatus
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+
+RANGE_PATTERN = re.compile(r'bytes=(\d*)-(\d*)$')
+
+
+# Serves a directory the way the release hosts do, with support for single byte ranges,
+# which the downloader uses to fetch a file in several segments at once.
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def send_head(self):
+        range_header = self.headers.get('Range')
+        path = self.translate_path(self.path)
+        if range_header is None or not os.path.isfile(path):
+            return super().send_head()
+
+        file_size = os.path.getsize(path)
+        m = RANGE_PATTERN.match(range_header.strip())
+        if m is None or m.group(1) == m.group(2) == '':
+            self.send_error(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+            return None
+
+        if m.group(1) == '':
+            start = max(0, file_size - int(m.group(2)))
+            end = file_size - 1
+        else:
+            start = int(m.group(1))
+            end = min(int(m.group(2)), file_size - 1) if m.group(2) else file_size - 1
+        if start > end:
+            self.send_error(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+            return None
+
+        f = open(path, 'rb')
+        f.seek(start)
+        self.range_length = end - start + 1
+        self.send_response(HTTPStatus.PARTIAL_CONTENT)
+        self.send_header('Content-Type', self.guess_type(path))
+        self.send_header('Content-Range', f'bytes {start}-{end}/{file_size}')
+        self.send_header('Content-Length', str(self.range_length))
+        self.end_headers()
+        return f
+
+    def end_headers(self):
+        self.send_header('Accept-Ranges', 'bytes')
+        super().end_headers()
+
+    def copyfile(self, source, outputfile):
+        range_length = getattr(self, 'range_length', None)
+        if range_length is None:
+            return super().copyfile(source, outputfile)
+
+        self.range_length = None
+        remaining = range_length
+        while remaining > 0:
+            buf = source.read(min(remaining, 64 * 1024))
+            if not buf:
+                break
+            outputfile.write(buf)
+            remaining -= len(buf)
+
+
+# local stand in for the remote a mosaic is downloaded from, used as a context manager
+class LocalServer:
+    def __init__(self, directory):
+        self.directory = str(directory)
+        self.httpd = None
+        self.thread = None
+
+    def __enter__(self):
+        handler = partial(RangeRequestHandler, directory=self.directory)
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+
+    def get_url(self, file_name):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}/{file_name}'
+
+
+def copy_mosaic(prefix, to_dir):
+    # copies a mosaic and its partitions into the directory to be served
+    prefix = str(prefix)
+    mosaic_file = f'{prefix}.mosaic.json'
+    shutil.copy(mosaic_file, to_dir)
+    parent = os.path.dirname(mosaic_file)
+    base = os.path.basename(prefix)
+    for name in os.listdir(parent):
+        if name.startswith(f'{base}-') and name.endswith('.pmtiles'):
+            shutil.copy(os.path.join(parent, name), to_dir)
+    return os.path.basename(mosaic_file)
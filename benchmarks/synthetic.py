@@ -0,0 +1,202 @@
+import io
+import json
+import gzip
+import random
+import shutil
+import sqlite3
+import hashlib
+
+from pathlib import Path
+
+import mercantile
+from PIL import Image
+from pmtiles.tile import zxy_to_tileid, TileType, Compression
+from pmtiles.writer import Writer as PMTilesWriter
+
+
+SOURCE_FORMATS = ['mbtiles', 'pmtiles', 'dir']
+
+# number of distinct blobs the duplicated tiles are drawn from,
+# like the few empty, all water or all land tiles of a real tileset
+DUPLICATE_POOL_SIZE = 8
+
+RASTER_TILE_SIZE = 256
+RASTER_GRID_SIZE = 16
+
+
+# Parameters of a synthetic tileset. The tiles cover the bounds at every zoom level,
+# so the number of tiles roughly quadruples with each zoom level added.
+class TilesetSpec:
+    def __init__(self, min_zoom=0, max_zoom=10, bounds=(68.0, 6.0, 98.0, 36.0),
+                 tile_size=4096, dup_ratio=0.3, tile_format='pbf', gzipped=False, seed=0):
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        self.bounds = tuple(bounds)
+        self.tile_size = tile_size
+        self.dup_ratio = dup_ratio
+        self.tile_format = tile_format
+        self.gzipped = gzipped
+        self.seed = seed
+
+    def to_dict(self):
+        return {
+            'min_zoom': self.min_zoom,
+            'max_zoom': self.max_zoom,
+            'bounds': list(self.bounds),
+            'tile_size': self.tile_size,
+            'dup_ratio': self.dup_ratio,
+            'tile_format': self.tile_format,
+            'gzipped': self.gzipped,
+            'seed': self.seed,
+        }
+
+    def get_key(self):
+        return hashlib.sha1(json.dumps(self.to_dict(), sort_keys=True).encode()).hexdigest()[:12]
+
+    def get_tiles(self):
+        # in tile id order, which is also the order the pmtiles source is written in
+        tiles = mercantile.tiles(*self.bounds, zooms=range(self.min_zoom, self.max_zoom + 1))
+        return sorted(tiles, key=lambda t: zxy_to_tileid(t.z, t.x, t.y))
+
+    def get_metadata(self):
+        metadata = {
+            'name': f'synthetic-{self.get_key()}',
+            'description': 'Synthetic tileset generated for benchmarking',
+            'format': self.tile_format,
+            'type': 'overlay' if self.tile_format == 'png' else 'baselayer',
+            'version': '1',
+            'minzoom': self.min_zoom,
+            'maxzoom': self.max_zoom,
+            'bounds': ','.join(str(b) for b in self.bounds),
+        }
+        if self.tile_format == 'pbf':
+            metadata['vector_layers'] = [{
+                'id': 'synthetic',
+                'minzoom': self.min_zoom,
+                'maxzoom': self.max_zoom,
+                'fields': {},
+            }]
+        return metadata
+
+
+def get_random_payload(rng, size):
+    # half random bytes and half a repeated pattern, so that the payload
+    # compresses about as well as a real vector tile
+    random_part = rng.randbytes(size // 2)
+    pattern = rng.randbytes(16)
+    return random_part + pattern * ((size - len(random_part)) // 16)
+
+def get_random_png(rng, transparent=False):
+    if transparent:
+        im = Image.new('RGBA', (RASTER_TILE_SIZE, RASTER_TILE_SIZE), (0, 0, 0, 0))
+    else:
+        grid = Image.frombytes('RGBA', (RASTER_GRID_SIZE, RASTER_GRID_SIZE),
+                               rng.randbytes(RASTER_GRID_SIZE * RASTER_GRID_SIZE * 4))
+        im = grid.resize((RASTER_TILE_SIZE, RASTER_TILE_SIZE), Image.NEAREST)
+    out = io.BytesIO()
+    im.save(out, format='PNG')
+    return out.getvalue()
+
+
+class TileGenerator:
+    def __init__(self, spec):
+        self.spec = spec
+        self.rng = random.Random(spec.seed)
+        self.pool = [ self.new_blob(i, duplicate=True) for i in range(DUPLICATE_POOL_SIZE) ]
+
+    def new_blob(self, i=0, duplicate=False):
+        spec = self.spec
+        if spec.tile_format == 'png':
+            # the first duplicated blob is a fully transparent tile, for --exclude-transparent
+            tdata = get_random_png(self.rng, transparent=(duplicate and i == 0))
+        else:
+            # duplicated tiles are small, like the empty or all water tiles they stand for
+            mean_size = spec.tile_size // 16 if duplicate else spec.tile_size
+            size = max(16, int(mean_size * self.rng.uniform(0.25, 1.75)))
+            tdata = get_random_payload(self.rng, size)
+        if spec.gzipped:
+            tdata = gzip.compress(tdata, mtime=0)
+        return tdata
+
+    def all(self):
+        # yields (tile, tdata) in tile id order, the same for the same spec
+        for tile in self.spec.get_tiles():
+            if self.rng.random() < self.spec.dup_ratio:
+                yield tile, self.pool[self.rng.randrange(DUPLICATE_POOL_SIZE)]
+            else:
+                yield tile, self.new_blob()
+
+
+def write_mbtiles(spec, path):
+    con = sqlite3.connect(path)
+    con.execute('create table metadata (name text, value text);')
+    con.execute('create table tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob);')
+    metadata = spec.get_metadata()
+    for k, v in metadata.items():
+        if k == 'vector_layers':
+            continue
+        con.execute('insert into metadata (name, value) values (?, ?);', (k, str(v)))
+    if 'vector_layers' in metadata:
+        con.execute('insert into metadata (name, value) values (?, ?);',
+                    ('json', json.dumps({ 'vector_layers': metadata['vector_layers'] })))
+
+    rows = ( (t.z, t.x, (1 << t.z) - 1 - t.y, tdata) for t, tdata in TileGenerator(spec).all() )
+    con.executemany('insert into tiles (zoom_level, tile_column, tile_row, tile_data) values (?, ?, ?, ?);', rows)
+    con.execute('create unique index tile_index on tiles (zoom_level, tile_column, tile_row);')
+    con.commit()
+    con.close()
+
+def write_pmtiles(spec, path):
+    min_lon, min_lat, max_lon, max_lat = spec.bounds
+    header = {
+        'tile_type': TileType.PNG if spec.tile_format == 'png' else TileType.MVT,
+        'tile_compression': Compression.GZIP if spec.gzipped else Compression.NONE,
+        'min_lon_e7': int(min_lon * 10000000),
+        'min_lat_e7': int(min_lat * 10000000),
+        'max_lon_e7': int(max_lon * 10000000),
+        'max_lat_e7': int(max_lat * 10000000),
+        'center_zoom': (spec.min_zoom + spec.max_zoom) // 2,
+        'center_lon_e7': int(10000000 * (min_lon + max_lon) / 2),
+        'center_lat_e7': int(10000000 * (min_lat + max_lat) / 2),
+    }
+    with open(path, 'wb') as f:
+        writer = PMTilesWriter(f)
+        for t, tdata in TileGenerator(spec).all():
+            writer.write_tile(zxy_to_tileid(t.z, t.x, t.y), tdata)
+        writer.finalize(header, spec.get_metadata())
+
+def write_tiles_dir(spec, path):
+    path.mkdir(parents=True)
+    for t, tdata in TileGenerator(spec).all():
+        tile_file = path / f'{t.z}' / f'{t.x}' / f'{t.y}.{spec.tile_format}'
+        tile_file.parent.mkdir(parents=True, exist_ok=True)
+        tile_file.write_bytes(tdata)
+    (path / 'metadata.json').write_text(json.dumps(spec.get_metadata()))
+
+
+SOURCE_WRITERS = {
+    'mbtiles': ('source.mbtiles', write_mbtiles),
+    'pmtiles': ('source.pmtiles', write_pmtiles),
+    'dir': ('source', write_tiles_dir),
+}
+
+def get_source(spec, source_format, sources_dir):
+    # generates the source once per spec, later runs reuse it
+    file_name, write_source = SOURCE_WRITERS[source_format]
+    spec_dir = Path(sources_dir) / spec.get_key()
+    path = spec_dir / file_name
+    done_marker = spec_dir / f'{file_name}.done'
+    if done_marker.exists():
+        return path
+
+    # left over from an interrupted run
+    if path.is_dir():
+        shutil.rmtree(path)
+    elif path.exists():
+        path.unlink()
+
+    spec_dir.mkdir(parents=True, exist_ok=True)
+    (spec_dir / 'spec.json').write_text(json.dumps(spec.to_dict(), indent=2))
+    write_source(spec, path)
+    done_marker.touch()
+    return path
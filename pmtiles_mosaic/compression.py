@@ -0,0 +1,144 @@
+import gzip
+import zlib
+import threading
+
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+# window bits asking zlib for a gzip header and trailer instead of the zlib ones
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+# more memory for the compression state, which finds slightly better matches than the default of 8
+MAX_MEM_LEVEL = 9
+
+
+def is_gzipped(tdata):
+    return tdata[0:2] == b"\x1f\x8b"
+
+def gzip_tile(tdata):
+    if is_gzipped(tdata):
+        return tdata
+
+    # a fixed mtime keeps the output deterministic, otherwise identical tiles
+    # compressed in different seconds stop being deduplicated by the writer
+    return gzip.compress(tdata, mtime=0)
+
+def recompress_tile(tdata):
+    # Deflates the tile again with the most effort zlib has, also the ones that came
+    # gzipped, often at a lower level. Keeps the tile as it was if that's no smaller.
+    # The output is still gzip, with a zero mtime like gzip_tile
+    raw = tdata
+    if is_gzipped(tdata):
+        try:
+            raw = gzip.decompress(tdata)
+        except (OSError, EOFError, zlib.error):
+            # only looks gzipped, passed through as gzip_tile does
+            return tdata
+    compressor = zlib.compressobj(9, zlib.DEFLATED, GZIP_WBITS, MAX_MEM_LEVEL)
+    compressed = compressor.compress(raw) + compressor.flush()
+    if is_gzipped(tdata) and len(tdata) <= len(compressed):
+        return tdata
+    return compressed
+
+
+# zlib releases the GIL while compressing, so a thread pool can compress
+# batches of tiles ahead of the writer while the main thread keeps reading.
+# Tilesets tend to repeat a few small blobs a lot (empty or all water tiles), so the
+# compressed form of recently seen small tiles is kept around and handed out again.
+# With recompress, tiles that are already gzipped are recompressed as well.
+# Given max_memory, the memo and the tiles waiting in batches are bounded by the bytes
+# they hold as well, to half of it each.
+class TileCompressor:
+    def __init__(self, workers=1, batch_size=64, max_memo_entries=256, max_memo_tile_size=64 * 1024, recompress=False,
+                 max_memory=None):
+        self.workers = workers
+        self.recompress = recompress
+        self.compress_tile = recompress_tile if recompress else gzip_tile
+        self.batch_size = batch_size
+        self.max_memo_entries = max_memo_entries
+        self.max_memo_tile_size = max_memo_tile_size
+        self.max_memo_bytes = None
+        self.max_pending_bytes = None
+        if max_memory is not None:
+            self.max_memo_bytes = max_memory // 2
+            self.max_pending_bytes = max_memory // 2
+        self.memo = OrderedDict()
+        self.memo_bytes = 0
+        self.memo_lock = threading.Lock()
+        self.memo_hits = 0
+        self.memo_misses = 0
+        self.executor = None
+        if workers > 1:
+            self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def compress(self, tdata):
+        if (is_gzipped(tdata) and not self.recompress) or len(tdata) > self.max_memo_tile_size:
+            return self.compress_tile(tdata)
+
+        # keyed on the bytes themselves, so a hit is always an exact match
+        key = bytes(tdata)
+        with self.memo_lock:
+            compressed = self.memo.get(key)
+            if compressed is not None:
+                self.memo_hits += 1
+                self.memo.move_to_end(key)
+                return compressed
+
+        compressed = self.compress_tile(key)
+        with self.memo_lock:
+            self.memo_misses += 1
+            if key not in self.memo:
+                self.memo[key] = compressed
+                self.memo_bytes += len(key) + len(compressed)
+            while self.memo and (len(self.memo) > self.max_memo_entries or
+                                 (self.max_memo_bytes is not None and self.memo_bytes > self.max_memo_bytes)):
+                old_key, old_compressed = self.memo.popitem(last=False)
+                self.memo_bytes -= len(old_key) + len(old_compressed)
+        return compressed
+
+    def _compress_batch(self, batch):
+        return [ (item, self.compress(tdata)) for item, tdata in batch ]
+
+    def compress_all(self, items):
+        # items are (item, tdata) pairs, they are yielded back in the same order with tdata gzipped
+        if self.executor is None:
+            for item, tdata in items:
+                yield item, self.compress(tdata)
+            return
+
+        max_pending = 2 * self.workers
+        # batches are cut short when their tiles are big, so that every worker still gets some
+        max_batch_bytes = None
+        if self.max_pending_bytes is not None:
+            max_batch_bytes = max(1, self.max_pending_bytes // max_pending)
+        # futures with the input size of their batch
+        pending = deque()
+        pending_bytes = 0
+        batch = []
+        batch_bytes = 0
+        for pair in items:
+            batch.append(pair)
+            batch_bytes += len(pair[1])
+            if len(batch) < self.batch_size and (max_batch_bytes is None or batch_bytes < max_batch_bytes):
+                continue
+
+            pending.append((self.executor.submit(self._compress_batch, batch), batch_bytes))
+            pending_bytes += batch_bytes
+            batch = []
+            batch_bytes = 0
+            while len(pending) >= max_pending or (self.max_pending_bytes is not None and pending_bytes > self.max_pending_bytes):
+                future, num_bytes = pending.popleft()
+                pending_bytes -= num_bytes
+                yield from future.result()
+
+        if batch:
+            pending.append((self.executor.submit(self._compress_batch, batch), batch_bytes))
+
+        while pending:
+            future, _ = pending.popleft()
+            yield from future.result()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
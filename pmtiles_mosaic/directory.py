@@ -0,0 +1,157 @@
+import gzip
+import zlib
+
+import numpy as np
+
+from .spill import iter_chunks
+from .compression import GZIP_WBITS
+
+# gzip header and trailer around the deflate stream
+GZIP_FRAMING_SIZE = 18
+COMPRESS_CHUNK_SIZE = 16 * 1024
+# entries are encoded at most this many at a time
+DIRECTORY_CHUNK_SIZE = 1024 * 1024
+
+# constants mirroring the layout choices made by pmtiles.writer
+PMTILES_HEADER_SIZE = 127
+PMTILES_ROOT_DIR_MAX_SIZE = 16384 - PMTILES_HEADER_SIZE
+PMTILES_MIN_LEAF_SIZE = 4096
+
+
+# Array based equivalents of the directory serialization in pmtiles.tile and pmtiles.writer.
+# They produce the same bytes, only without going through the entries one varint at a time.
+
+def encode_varints(values):
+    values = np.asarray(values, dtype=np.uint64)
+
+    num_bytes = np.ones(len(values), dtype=np.int64)
+    rest = values >> np.uint64(7)
+    while rest.any():
+        num_bytes += (rest > 0)
+        rest >>= np.uint64(7)
+
+    ends = np.cumsum(num_bytes)
+    starts = ends - num_bytes
+    out = np.empty(int(ends[-1]) if len(ends) else 0, dtype=np.uint8)
+    for k in range(int(num_bytes.max()) if len(values) else 0):
+        mask = num_bytes > k
+        group = (values[mask] >> np.uint64(7 * k)) & np.uint64(0x7F)
+        more = num_bytes[mask] > k + 1
+        out[starts[mask] + k] = group | (more.astype(np.uint64) << np.uint64(7))
+    return out.tobytes()
+
+
+def get_directory_columns(tile_ids, run_lengths, lengths, offsets, previous=None):
+    # the values stored in the four columns of a directory, for entries sorted by tile id.
+    # previous is the (tile_id, offset, length) of the entry before them, when they
+    # are a chunk out of the middle of the directory
+    tile_ids = tile_ids.astype(np.uint64)
+    offsets = offsets.astype(np.uint64)
+    lengths = lengths.astype(np.uint64)
+
+    # an offset that follows right after the previous entry's data is written as 0
+    contiguous = np.zeros(len(offsets), dtype=bool)
+    contiguous[1:] = offsets[1:] == offsets[:-1] + lengths[:-1]
+    prev_tile_id = np.uint64(0)
+    if previous is not None and len(offsets) > 0:
+        prev_tile_id, prev_offset, prev_length = previous
+        contiguous[0] = offsets[0] == prev_offset + prev_length
+    encoded_offsets = offsets + np.uint64(1)
+    encoded_offsets[contiguous] = 0
+
+    tile_id_deltas = np.diff(tile_ids, prepend=np.uint64(prev_tile_id))
+    return tile_id_deltas, run_lengths, lengths, encoded_offsets
+
+
+def encode_directory_arrays(tile_ids, run_lengths, lengths, offsets):
+    # arrays are expected to be sorted by tile id
+    columns = get_directory_columns(tile_ids, run_lengths, lengths, offsets)
+    return encode_varints([len(tile_ids)]) + b''.join(encode_varints(c) for c in columns)
+
+
+def iter_encoded_directory(num_entries, get_entries, chunk_size):
+    # the same bytes as encode_directory_arrays, a chunk of entries at a time.
+    # get_entries(start, end) returns the tile ids, run lengths, lengths and offsets
+    # of the entries from start to end in tile id order
+    yield encode_varints([num_entries])
+    for column in range(4):
+        previous = None
+        for start, end in iter_chunks(num_entries, chunk_size):
+            tile_ids, run_lengths, lengths, offsets = get_entries(start, end)
+            yield encode_varints(get_directory_columns(tile_ids, run_lengths, lengths, offsets, previous)[column])
+            previous = (tile_ids[-1], offsets[-1], lengths[-1])
+
+
+def serialize_directory_arrays(tile_ids, run_lengths, lengths, offsets):
+    return gzip.compress(encode_directory_arrays(tile_ids, run_lengths, lengths, offsets))
+
+
+def compress_chunks(chunks, max_size=None):
+    # gzips the concatenation of chunks. Deflate output only grows as more input goes in,
+    # so compressing stops, returning None, as soon as the output so far reaches max_size
+    compressor = zlib.compressobj(9, zlib.DEFLATED, GZIP_WBITS)
+    out = []
+    out_size = GZIP_FRAMING_SIZE
+    for chunk in chunks:
+        for start in range(0, len(chunk), COMPRESS_CHUNK_SIZE):
+            compressed = compressor.compress(chunk[start:start + COMPRESS_CHUNK_SIZE])
+            out.append(compressed)
+            out_size += len(compressed)
+            if max_size is not None and out_size >= max_size:
+                return None
+    out.append(compressor.flush())
+    return b''.join(out)
+
+
+def optimize_directories(num_entries, get_entries, target_root_len, min_leaf_size, chunk_size=DIRECTORY_CHUNK_SIZE,
+                         leaves_file=None, leaf_sizes_cache=None, num_stable=0):
+    # lays out the root and leaf directories like pmtiles.writer.optimize_directories, with the
+    # entries read through get_entries, as in iter_encoded_directory, a chunk or a leaf at a time.
+    # Returns the root directory and the total size of the leaves, which are written to leaves_file when given.
+    # Leaf sizes, along with their first tile id, can be cached across calls by (start, leaf size)
+    # for leaves within the first num_stable entries, which the caller guarantees to stay the same
+    root = compress_chunks(iter_encoded_directory(num_entries, get_entries, chunk_size), target_root_len)
+    if root is not None and len(root) < target_root_len:
+        return root, 0
+
+    leaf_size = min_leaf_size
+    while True:
+        if leaves_file is not None:
+            leaves_file.seek(0)
+            leaves_file.truncate()
+
+        first_tile_ids = []
+        leaf_sizes = []
+        for s in range(0, num_entries, leaf_size):
+            key = (s, leaf_size)
+            if leaf_sizes_cache is not None and key in leaf_sizes_cache:
+                first_tile_id, size = leaf_sizes_cache[key]
+            else:
+                entries = get_entries(s, min(s + leaf_size, num_entries))
+                leaf = serialize_directory_arrays(*entries)
+                if leaves_file is not None:
+                    leaves_file.write(leaf)
+                first_tile_id, size = int(entries[0][0]), len(leaf)
+                if leaf_sizes_cache is not None and s + leaf_size <= num_stable:
+                    leaf_sizes_cache[key] = (first_tile_id, size)
+            first_tile_ids.append(first_tile_id)
+            leaf_sizes.append(size)
+        leaf_sizes = np.array(leaf_sizes, dtype=np.uint64)
+        leaf_offsets = np.cumsum(leaf_sizes) - leaf_sizes
+
+        root = serialize_directory_arrays(np.array(first_tile_ids, dtype=np.uint64),
+                                          np.zeros(len(leaf_sizes), dtype=np.uint64),
+                                          leaf_sizes,
+                                          leaf_offsets)
+        if len(root) < target_root_len:
+            return root, int(leaf_sizes.sum())
+        leaf_size *= 2
+
+
+def get_directories_size(num_entries, get_entries, target_root_len, min_leaf_size, chunk_size=DIRECTORY_CHUNK_SIZE,
+                         leaf_sizes_cache=None, num_stable=0):
+    # total size of the root and leaf directories
+    root, leaves_size = optimize_directories(num_entries, get_entries, target_root_len, min_leaf_size,
+                                             chunk_size=chunk_size, leaf_sizes_cache=leaf_sizes_cache,
+                                             num_stable=num_stable)
+    return len(root) + leaves_size
@@ -56,6 +56,13 @@ class DiskTilesSource(LoggerMixin):
             yield (tile, fstats.st_size)
 
 
+    def get_tile_count(self):
+        # only known by walking the whole tree
+        return None
+
+    def has_cheap_random_reads(self):
+        return True
+
     def cleanup(self):
         pass
 
@@ -26,8 +26,13 @@ from pmtiles.reader import Reader, MmapSource, all_tiles
 from pmtiles.writer import Writer
 from pmtiles.tile import zxy_to_tileid, Compression, TileType
 
+from .metrics import Metrics
+from .progress import Progress
 from .logger import LoggerMixin, get_logger
 
+# 2 is 1 with slices found by tile id range, which doesn't change how they get merged
+SUPPORTED_MOSAIC_VERSIONS = [1, 2]
+
 # heavily copied from https://github.com/protomaps/PMTiles/blob/main/python/pmtiles/convert.py
 # and https://github.com/mapbox/mbutil/blob/master/mbutil/util.py
 
@@ -205,11 +210,12 @@ def is_local(url):
  
 
 class Merger(LoggerMixin):
-    def __init__(self, mosaic_url, archive_type, output_file, request_timeout_secs, num_http_retries, force=False, logger=None):
+    def __init__(self, mosaic_url, archive_type, output_file, request_timeout_secs, num_http_retries, force=False, logger=None, metrics=None):
         self.request_timeout_secs = request_timeout_secs
         self.num_http_retries = num_http_retries
         self.force = force
         self.logger = logger
+        self.metrics = metrics if metrics is not None else Metrics('download-mosaic')
 
         self.silent_pypdl_logger = logging.getLogger('pypdl_silent')
         self.silent_pypdl_logger.addHandler(logging.NullHandler())
@@ -263,15 +269,19 @@ class Merger(LoggerMixin):
 
     def download_file(self, url, file):
         self.log_info(f'downloading {url} to {file}')
-        downloader = pypdl.Pypdl(logger=self.silent_pypdl_logger)
-        timeout = aiohttp.ClientTimeout(
-            connect=self.request_timeout_secs,
-            sock_read=self.request_timeout_secs
-        )
-        downloader.start(url=url, 
-                        file_path=str(file),
-                        retries=self.num_http_retries, 
-                        timeout=timeout)
+        with self.metrics.phase('download') as phase:
+            downloader = pypdl.Pypdl(logger=self.silent_pypdl_logger)
+            timeout = aiohttp.ClientTimeout(
+                connect=self.request_timeout_secs,
+                sock_read=self.request_timeout_secs
+            )
+            downloader.start(url=url, 
+                            file_path=str(file),
+                            retries=self.num_http_retries, 
+                            timeout=timeout)
+            phase.add('files')
+            if file.exists():
+                phase.add('bytes', file.stat().st_size)
 
     def init_tracker(self):
         if not self.tracker_file.exists():
@@ -335,14 +345,25 @@ class Merger(LoggerMixin):
     def add_pmtiles(self, pmtiles_fname):
 
         self.log_info(f'adding {pmtiles_fname} to archive')
-        with open(pmtiles_fname, "r+b") as f:
+        with self.metrics.phase('merge') as phase, open(pmtiles_fname, "r+b") as f:
             source = MmapSource(f)
             reader = Reader(source)
     
+            progress = Progress(f'Merging {Path(pmtiles_fname).name}',
+                                total=reader.header()['addressed_tiles_count'] or None,
+                                logger=self.logger)
+            num_tiles = 0
+            num_bytes = 0
             for zxy, tile_data in all_tiles(reader.get_bytes):
                 self.archive_writer.add_to_archive(zxy, tile_data)
+                num_tiles += 1
+                num_bytes += len(tile_data)
+                progress.update(1, len(tile_data))
+            progress.done()
 
             self.archive_writer.commit()
+            phase.add('tiles', num_tiles)
+            phase.add('bytes', num_bytes)
 
     def prepare(self):
         if 'prepare' in self.done_stages:
@@ -357,8 +378,8 @@ class Merger(LoggerMixin):
             self.force_cleanup()
 
         self.populate_mosaic(self.mosaic_url)
-        if self.mosaic_data.get('version', None) != 1:
-            raise ValueError('Unsupported mosaic format: version must be 1')
+        if self.mosaic_data.get('version', None) not in SUPPORTED_MOSAIC_VERSIONS:
+            raise ValueError(f'Unsupported mosaic format: version must be one of {SUPPORTED_MOSAIC_VERSIONS}')
         self.mosaic_version = self.mosaic_data['version']
 
         if self.output_file.exists() and not self.tracker_file.exists():
@@ -373,12 +394,15 @@ class Merger(LoggerMixin):
 
 
         slice_data = self.mosaic_data.get('slices', {})
+        self.metrics.set('slices', len(slice_data))
 
-        for k in slice_data.keys():
+        for i, k in enumerate(slice_data.keys()):
 
+            self.log_info(f'partition {i + 1}/{len(slice_data)}: {k}')
             pmtiles_url = self.get_pmtiles_url(k)
             if k in self.done_stages:
                 self.log_info(f'Stage {k} already done, skipping')
+                self.metrics.add('slices_skipped')
                 continue
 
             pmtiles_file = self.get_pmtiles_file(pmtiles_url)
@@ -399,7 +423,8 @@ class Merger(LoggerMixin):
                 pmtiles_file.unlink()
 
         metadata, header = self.get_metadata_and_header()
-        self.archive_writer.finalize(metadata, header)
+        with self.metrics.phase('finalize'):
+            self.archive_writer.finalize(metadata, header)
 
     def cleanup(self):
         if self.tracker_file.exists():
@@ -420,6 +445,7 @@ def cli():
     parser.add_argument('--request-timeout-secs', '-t', type=int, default=60, help='Timeout for HTTP requests in seconds')
     parser.add_argument('--num-http-retries', '-r', type=int, default=3, help='Number of retries for HTTP requests')
     parser.add_argument('--force', '-f', action='store_true', help='Clear all the existing leftover files and start the run from scratch.')
+    parser.add_argument('--metrics-file', help='Write the timings of the download, merge and finalize phases, with tile and byte rates, to this JSON file at the end of the run.')
     parser.add_argument('--log-level', '-l', type=str, default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], help='Set the logging level.')
     args = parser.parse_args()
 
@@ -452,16 +478,24 @@ def cli():
         out_fname = mosaic_fname[:-len('.mosaic.json')] + '.' + archive_type
         output_file = Path(out_fname)
 
+    metrics = Metrics('download-mosaic')
     merger = Merger(args.mosaic_url,
                     archive_type, 
                     output_file, 
                     args.request_timeout_secs, 
                     args.num_http_retries,
                     force=args.force,
-                    logger=logger)
-
-    merger.process()
-    merger.cleanup()
+                    logger=logger,
+                    metrics=metrics)
+
+    try:
+        merger.process()
+        merger.cleanup()
+        metrics.completed = True
+    finally:
+        # written for failed runs too, with completed set to false
+        if args.metrics_file is not None:
+            metrics.write(args.metrics_file)
 
     logger.info('Done!!!')
 
@@ -0,0 +1,85 @@
+import json
+
+from pathlib import Path
+
+from .logger import LoggerMixin
+
+
+# Record of the partitions written so far, so that a run that got killed can be picked
+# up again. One JSON line per written partition is appended as soon as its file is
+# complete, after a first line describing the run, which a resumed run has to match.
+# The plan is deterministic for the same tiles and settings, so a resumed run plans
+# again and skips the partitions the journal has.
+class PartitionJournal(LoggerMixin):
+    def __init__(self, journal_file, run_key, logger=None):
+        self.journal_file = Path(journal_file)
+        self.run_key = run_key
+        self.logger = logger
+        self.entries = {}
+        self.file = None
+
+    def open(self):
+        if self.journal_file.exists():
+            self.load()
+
+        if len(self.entries) > 0:
+            self.log_info(f'Resuming from {self.journal_file}, {len(self.entries)} partitions already written')
+
+        # rewritten from what could be read back, so nothing gets appended to a torn line
+        self.file = open(self.journal_file, 'w')
+        self.append({ 'run': self.run_key })
+        for entry in self.entries.values():
+            self.append(entry)
+
+    def load(self):
+        lines = self.journal_file.read_text().splitlines()
+        if len(lines) == 0 or json.loads(lines[0]).get('run') != self.run_key:
+            self.log_info(f'Journal {self.journal_file} is from a run with other sources or settings, starting over')
+            return
+
+        for line in lines[1:]:
+            # the last line can be cut short by the kill
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                break
+            self.entries[entry['name']] = entry
+
+    def append(self, data):
+        self.file.write(json.dumps(data) + '\n')
+        self.file.flush()
+
+    def record(self, pmtiles_file_name, context, num_tiles, header, size):
+        entry = {
+            'name': Path(pmtiles_file_name).name,
+            'context': [ list(r) for r in context ],
+            'num_tiles': num_tiles,
+            'header': header,
+            'size': size,
+        }
+        self.append(entry)
+        self.entries[entry['name']] = entry
+
+    def get_written_size(self, pmtiles_file_name, context, num_tiles, header):
+        # the size of the partition if an earlier run wrote exactly this one, None otherwise
+        entry = self.entries.get(Path(pmtiles_file_name).name)
+        if entry is None:
+            return None
+
+        if (entry['context'] != json.loads(json.dumps([ list(r) for r in context ])) or
+                entry['num_tiles'] != num_tiles or entry['header'] != header):
+            return None
+
+        path = Path(pmtiles_file_name)
+        if not path.exists() or path.stat().st_size != entry['size']:
+            return None
+        return entry['size']
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def remove(self):
+        self.close()
+        self.journal_file.unlink(missing_ok=True)
@@ -28,7 +28,7 @@ class MBTilesSource(LoggerMixin):
         data = self.get_tile_data(tile)
         return len(data)
  
-    def all_sizes_z(self, z):
+    def all_z_sizes(self, z):
         res = self.con.execute(f'select tile_column, tile_row, length(tile_data) from tiles where zoom_level={z};')
         while True:
             t = res.fetchone()
@@ -50,7 +50,7 @@ class MBTilesSource(LoggerMixin):
             tile = mercantile.Tile(x=x, y=y, z=z)
             yield (tile, data)
 
-    def all_z_sizes(self):
+    def all_sizes(self):
         res = self.con.execute('select zoom_level, tile_column, tile_row, length(tile_data) from tiles;')
         while True:
             t = res.fetchone()
@@ -61,6 +61,17 @@ class MBTilesSource(LoggerMixin):
             tile = mercantile.Tile(x=x, y=y, z=z)
             yield (tile, tile_size)
 
+    def get_tile_count(self):
+        return self.con.execute('select count(*) from tiles;').fetchone()[0]
+
+    def has_cheap_random_reads(self):
+        # a lookup by zoom, column and row only avoids a full scan with an index on the tiles,
+        # views over the map and images tables have theirs underneath
+        kind = self.con.execute("select type from sqlite_master where name='tiles';").fetchone()
+        if kind is not None and kind[0] == 'view':
+            return True
+        return len(self.con.execute("pragma index_list('tiles');").fetchall()) > 0
+
     def cleanup(self):
         self.con.close()
 
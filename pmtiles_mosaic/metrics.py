@@ -0,0 +1,78 @@
+import json
+import time
+
+from pathlib import Path
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+
+class PhaseMetrics:
+    def __init__(self):
+        self.secs = 0.0
+        self.amounts = {}
+
+    def add(self, name, value=1):
+        self.amounts[name] = self.amounts.get(name, 0) + value
+
+    def to_dict(self):
+        out = { 'secs': self.secs }
+        for name, value in self.amounts.items():
+            out[name] = value
+            out[f'{name}_per_sec'] = value / self.secs if self.secs > 0 else None
+        return out
+
+
+# Structured counterpart of the log lines, for charting runs.
+# Phases time the major steps of a run and count what went through them (tiles, bytes),
+# from which rates are derived. Counters hold everything else worth tracking.
+# Only totals are kept, hot loops add their counts once they are done.
+class Metrics:
+    def __init__(self, tool):
+        self.tool = tool
+        self.started_at = datetime.now(timezone.utc).isoformat()
+        self.start = time.perf_counter()
+        self.phases = {}
+        self.counters = {}
+        self.completed = False
+
+    def get_phase(self, name):
+        if name not in self.phases:
+            self.phases[name] = PhaseMetrics()
+        return self.phases[name]
+
+    @contextmanager
+    def phase(self, name):
+        # a phase entered more than once adds up
+        phase = self.get_phase(name)
+        start = time.perf_counter()
+        try:
+            yield phase
+        finally:
+            phase.secs += time.perf_counter() - start
+
+    def add(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, name, value):
+        self.counters[name] = value
+
+    def set_hit_rate(self, name, hits, misses):
+        self.counters[f'{name}_hits'] = hits
+        self.counters[f'{name}_misses'] = misses
+        self.counters[f'{name}_hit_rate'] = hits / (hits + misses) if hits + misses > 0 else None
+
+    def to_dict(self):
+        return {
+            'version': 1,
+            'tool': self.tool,
+            'started_at': self.started_at,
+            'total_secs': time.perf_counter() - self.start,
+            'completed': self.completed,
+            'phases': { name: phase.to_dict() for name, phase in self.phases.items() },
+            'counters': dict(self.counters),
+        }
+
+    def write(self, path):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(self.to_dict(), indent=2))
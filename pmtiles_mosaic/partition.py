@@ -4,27 +4,49 @@
 #     "mercantile",
 #     "pmtiles",
 #     "pillow",
+#     "numpy",
 # ]
 # ///
 
+import os
 import re
 import sys
 import json
 import gzip
 import copy
-import tempfile
+import shutil
 import argparse
 
 from pathlib import Path
 
-import io
-
-import mercantile
-from PIL import Image
-from pmtiles.tile import zxy_to_tileid, TileType, Compression
-from pmtiles.writer import Writer as PMTilesWriter
+import numpy as np
+from pmtiles.tile import TileType, Compression
 
 from .tile_sources import create_source_from_paths
+from .compression import TileCompressor
+from .directory import PMTILES_HEADER_SIZE, PMTILES_ROOT_DIR_MAX_SIZE, PMTILES_MIN_LEAF_SIZE
+from .slice_writer import SizeOnlyPMTilesWriter, SliceTask, SliceWriterPool, write_slice_file
+from .tile_cache import TileCache, TileCacheDir, get_sources_fingerprint
+from .transparency import TransparencyChecker
+from .spill import SpillArea, iter_chunks, get_anon_memory, get_working_memory, get_min_max_memory
+from .metrics import Metrics
+from .progress import Progress
+from .previous_mosaic import PreviousMosaic
+from .journal import PartitionJournal
+from .tile_index import (
+    TileIndexBuilder,
+    group_rows,
+    group_rows_external,
+    sort_rows_external,
+    get_repeated_hashes,
+    get_may_repeat,
+    get_ancestor_coords,
+    get_zoom_extents_from_arrays,
+    get_zoom_extents_from_index,
+    merge_zoom_extents,
+    update_zoom_extents,
+    get_extent_bounds,
+)
 from .logger import LoggerMixin, get_logger
 
 
@@ -45,6 +67,27 @@ HEADER_EXPORT_KEYS = SLICE_HEADER_EXPORT_KEYS + [
     'tile_compression',
 ]
 
+# run lengths are varint encoded, 5 bytes covers anything below 2^35
+MAX_RUN_LENGTH_VARINT_SIZE = 5
+# gzip header and trailer are 12 bytes larger than the zlib ones
+GZIP_EXTRA_OVERHEAD = 12
+# per leaf: entry count varint, gzip framing and the root entry pointing to it
+LEAF_OVERHEAD = 5 + 13 + GZIP_EXTRA_OVERHEAD + 4 * 10
+
+# rows are turned into python objects at most this many at a time
+ROWS_CHUNK_SIZE = 1024 * 1024
+
+# the hilbert strategy fills slices with blocks of rows of these sizes, the block that
+# overflows a slice is retried as smaller blocks
+HILBERT_BLOCK_SIZES = [4096, 64, 1]
+
+# mosaics whose slices are found by tile id range get a version of their own, as
+# readers of version 1 would look tiles up by the overlapping bounds of the slices
+MOSAIC_VERSION = 1
+TILE_ID_RANGE_MOSAIC_VERSION = 2
+
+# balancing searches for the smallest size limit that needs no more slices, down to this fraction of the limit
+BALANCE_PRECISION = 200
 
 
 def parse_size(size_str):
@@ -83,6 +126,21 @@ def parse_size(size_str):
 
     return intended_size
 
+def parse_memory_size(size_str):
+    # a number of bytes with an optional unit, no presets or lower bound like partition sizes.
+    # Whether the budget leaves enough room is only known once the sources are open
+    size_str = str(size_str).strip().upper()
+    match = re.match(r'^(\d+)([GKM]?)$', size_str)
+    if not match:
+        raise argparse.ArgumentTypeError(f"Invalid memory size: {size_str}, expected a number of bytes with an optional unit (K, M, G)")
+
+    value, unit = match.groups()
+    memory_size = int(value) * { 'G': 1024 * 1024 * 1024, 'M': 1024 * 1024, 'K': 1024, '': 1 }[unit]
+    if memory_size == 0:
+        raise argparse.ArgumentTypeError(f"Memory size must be more than 0, got {size_str}")
+
+    return memory_size
+
 def get_pmtiles_file_name(to_pmtiles_prefix, suffix):
     if suffix == '':
         out_pmtiles_file = f'{to_pmtiles_prefix}.pmtiles'
@@ -91,47 +149,51 @@ def get_pmtiles_file_name(to_pmtiles_prefix, suffix):
 
     return out_pmtiles_file
 
-def get_bounds(tiles):
+def varint_size(value):
+    return max(1, (value.bit_length() + 6) // 7)
 
-    bounds = [ mercantile.bounds(t) for t in tiles ]
+def entry_size_upper_bound(tile_id, length, offset):
+    # the tile id is delta encoded after sorting, the delta can never exceed the id itself
+    return (varint_size(tile_id) +
+            MAX_RUN_LENGTH_VARINT_SIZE +
+            varint_size(length) +
+            varint_size(offset + 1))
 
-    max_x = bounds[0].east
-    min_x = bounds[0].west
-    max_y = bounds[0].north
-    min_y = bounds[0].south
-    for b in bounds:
-        if b.east > max_x:
-            max_x = b.east
+def compressed_size_upper_bound(size):
+    # zlib's compressBound(), adjusted for gzip framing
+    return size + (size >> 12) + (size >> 14) + (size >> 25) + 13 + GZIP_EXTRA_OVERHEAD
 
-        if b.west < min_x:
-            min_x = b.west
+def directory_size_upper_bound(num_entries, entries_size):
+    # worst case is when the directory gets split into leaves of the smallest size
+    # with a root directory that is as big as it is allowed to get
+    max_leaves = (num_entries + PMTILES_MIN_LEAF_SIZE - 1) // PMTILES_MIN_LEAF_SIZE
+    return (compressed_size_upper_bound(entries_size + MAX_RUN_LENGTH_VARINT_SIZE) +
+            max_leaves * LEAF_OVERHEAD +
+            PMTILES_ROOT_DIR_MAX_SIZE)
 
-        if b.north > max_y:
-            max_y = b.north
+def get_info_from_extents(extents):
+    min_z = min(extents.keys())
+    max_z = max(extents.keys())
 
-        if b.south < min_y:
-            min_y = b.south
+    higher_bounds = get_extent_bounds(max_z, extents[max_z])
+    lower_bounds = get_extent_bounds(min_z, extents[min_z])
 
-    return (min_y, min_x, max_y, max_x)
-
-
-def get_info(tiles):
-    tiles_by_z = {}
+    return min_z, max_z, lower_bounds, higher_bounds
 
-    for t in tiles:
-        if t.z not in tiles_by_z:
-            tiles_by_z[t.z] = []
 
-        tiles_by_z[t.z].append(t)
+def get_union_info_from_extents(extents):
+    # bounds covering the tiles of all zoom levels, for slices whose zoom
+    # levels don't nest inside each other spatially
+    min_z, max_z, _, _ = get_info_from_extents(extents)
 
-    min_z = min(tiles_by_z.keys())
-    max_z = max(tiles_by_z.keys())
+    all_bounds = [ get_extent_bounds(z, extent) for z, extent in extents.items() ]
+    bounds = (min(b[0] for b in all_bounds),
+              min(b[1] for b in all_bounds),
+              max(b[2] for b in all_bounds),
+              max(b[3] for b in all_bounds))
 
-    higher_bounds = get_bounds(tiles_by_z[max_z])
-    lower_bounds = get_bounds(tiles_by_z[min_z])
+    return min_z, max_z, bounds, bounds
 
-    return min_z, max_z, lower_bounds, higher_bounds
- 
 
 def get_header_base(metadata):
 
@@ -168,14 +230,11 @@ def get_header_base(metadata):
     }
     return header
 
-def get_header(tiles, header_base, use_lower_zoom_for_bounds=False, tiles_info=None):
+def get_header(header_base, tiles_info, use_lower_zoom_for_bounds=False):
 
     header = {}
     header.update(header_base)
 
-    if tiles_info is None:
-        tiles_info = get_info(tiles)
-
     min_zoom, max_zoom, lower_bounds, higher_bounds = tiles_info
 
     lower_min_lat, lower_min_lon, lower_max_lat, lower_max_lon = lower_bounds
@@ -205,15 +264,9 @@ def convert_header(header, filter_keys):
     return new_header
 
          
-def get_header_and_metadata(header_base, metadata, tiles):
-    tiles_info = get_info(tiles)
-    header = get_header(tiles, header_base, use_lower_zoom_for_bounds=False, tiles_info=tiles_info)
-    header_for_mosaic = get_header(tiles, header_base, use_lower_zoom_for_bounds=True, tiles_info=tiles_info)
-
+def get_clamped_metadata(metadata, min_zoom, max_zoom):
     metadata = copy.deepcopy(metadata)
 
-    min_zoom = header['min_zoom']
-    max_zoom = header['max_zoom']
     if 'vector_layers' in metadata:
         for layer in metadata['vector_layers']:
             if layer['maxzoom'] > max_zoom:
@@ -221,125 +274,171 @@ def get_header_and_metadata(header_base, metadata, tiles):
             if layer['minzoom'] < min_zoom:
                 layer['minzoom'] = min_zoom
 
+    return metadata
+
+def get_header_and_metadata(header_base, metadata, tiles_info):
+    header = get_header(header_base, tiles_info, use_lower_zoom_for_bounds=False)
+    header_for_mosaic = get_header(header_base, tiles_info, use_lower_zoom_for_bounds=True)
+
+    metadata = get_clamped_metadata(metadata, header['min_zoom'], header['max_zoom'])
+
     return header, header_for_mosaic, metadata
 
 
+# The writer state only ever grows between checkpoints, so a checkpoint just
+# records where each piece of state ended. The only in place mutation the
+# pmtiles writer does is bumping the run length of the last entry.
+# Zoom extents can't be truncated, but there are only a handful of them.
 class WriterCheckpoint:
-    def __init__(self, writer, tiles):
-        self.tile_entries = copy.copy(writer.tile_entries)
-        self.hash_to_offset = copy.copy(writer.hash_to_offset)
+    def __init__(self, writer, num_tiles, extents):
+        self.num_tile_entries = writer.num_entries
+        self.last_run_length = writer.last_run_length
+        self.num_hashes = len(writer.hash_to_offset)
+        self.num_contents = writer.num_contents
         self.offset = writer.offset
         self.addressed_tiles = writer.addressed_tiles
         self.clustered = writer.clustered
-        self.tiles = copy.copy(tiles)
-        self.size = 0
-
-
-class CheckpointablePMTilesWriter(LoggerMixin):
-    def __init__(self, header_base, metadata, logger=None, exclude_transparent=False):
+        self.num_tiles = num_tiles
+        self.extents = { z: list(extent) for z, extent in extents.items() }
+        self.num_row_chunks = 0
+        self.entries_size = 0
+        self.size = None
+
+
+# Accumulates the tiles of a slice while planning. Only the index is consulted,
+# tile sizes and content hashes are enough to know the exact size of the slice.
+# With a spill area, the entries of a big slice go to disk, and only the content
+# hashes among repeated_hashes are remembered for deduplication.
+class SliceEstimator(LoggerMixin):
+    def __init__(self, tile_index, header_base, metadata, logger=None, chunk_size=ROWS_CHUNK_SIZE, metrics=None,
+                 spill=None, repeated_hashes=None):
+        self.tile_index = tile_index
         self.header_base = header_base
-        self.should_be_compressed = (header_base.get('tile_compression', Compression.NONE) == Compression.GZIP)
         self.metadata = metadata
         self.logger = logger
-        self.exclude_transparent = exclude_transparent
-        self.tile_type = header_base.get('tile_type')
-
-        self.header_f = tempfile.TemporaryFile()
-        self.writer = PMTilesWriter(self.header_f)
-        self.tiles = []
+        self.chunk_size = chunk_size
+        self.metrics = metrics
+        self.repeated_hashes = repeated_hashes
+
+        self.writer = SizeOnlyPMTilesWriter(spill=spill)
+        self.num_tiles = 0
+        self.extents = {}
+        self.row_chunks = []
         self.last_checkpoint = None
         self._cached_size = 0
         self._is_size_cached = True
 
+        # running upper bound of the serialized size of all directory entries
+        self.entries_size = 0
+        # metadata only depends on the zoom range through the vector layer clamping
+        self.metadata_sizes = {}
+
+    def add_rows(self, rows, size_limit=None):
+        # rows go in a chunk at a time. With a size limit, adding stops early once the
+        # slice is certain not to fit, it is going to be rolled back anyway
+        for start, end in iter_chunks(len(rows), self.chunk_size):
+            self.add_rows_chunk(rows[start:end])
+            if size_limit is not None and self.get_size_bounds()[0] > size_limit:
+                break
 
-    def is_transparent_empty(self, tdata, tile_type):
+    def add_rows_chunk(self, rows):
+        self._is_size_cached = False
+        index = self.tile_index
 
-        img_format = 'PNG' if tile_type == TileType.PNG else 'WEBP'
+        tile_ids = index.tile_id[rows].tolist()
+        sizes = index.size[rows].tolist()
+        hashes = index.content_hash[rows]
+        may_repeat = get_may_repeat(hashes, self.repeated_hashes).tolist()
+        hashes = hashes.tolist()
 
-        try:
-            with Image.open(io.BytesIO(tdata), formats=[img_format]) as im:
-                # Check for transparency
-                if im.mode in ('RGBA', 'LA') or (im.mode == 'P' and 'transparency' in im.info):
-                    # Get alpha channel
-                    if im.mode != 'A':
-                        alpha = im.getchannel('A')
-                    else:
-                        alpha = im
-                    min_alpha, max_alpha = alpha.getextrema()
-                    return max_alpha == 0
-        except Exception:
-            self.log_warning("Error checking transparency", exc_info=True)
+        writer = self.writer
+        for tile_id, size, hsh, repeat in zip(tile_ids, sizes, hashes, may_repeat):
+            num_entries = writer.num_entries
+            writer.add_tile(tile_id, size, hsh, repeat)
+            if writer.num_entries > num_entries:
+                self.entries_size += entry_size_upper_bound(tile_id, size, writer.last[1])
 
-        return False
+        self.num_tiles += len(rows)
+        merge_zoom_extents(self.extents, get_zoom_extents_from_arrays(index.z[rows], index.x[rows], index.y[rows]))
+        self.row_chunks.append(rows)
 
+    def checkpoint(self):
+        self.last_checkpoint = WriterCheckpoint(self.writer, self.num_tiles, self.extents)
+        self.last_checkpoint.num_row_chunks = len(self.row_chunks)
+        self.last_checkpoint.entries_size = self.entries_size
+        if self._is_size_cached:
+            self.last_checkpoint.size = self._cached_size
+        return self.last_checkpoint
 
 
-    def write_tile(self, tile, tdata):
-        self._is_size_cached = False
-        is_compressed = (tdata[0:2] == b"\x1f\x8b")
-
-        if self.exclude_transparent and self.tile_type in [TileType.PNG, TileType.WEBP]:
-            if is_compressed:
-                # decompress first
-                tdata_uncompressed = gzip.decompress(tdata)
-                if self.is_transparent_empty(tdata_uncompressed, self.tile_type):
-                    return
-            else:
-                if self.is_transparent_empty(tdata, self.tile_type):
-                    return
+    def rollback(self, checkpoint=None):
+        # state only grows, so any earlier checkpoint can be rolled back to, not just the last one
+        if checkpoint is None:
+            checkpoint = self.last_checkpoint
 
-        self.tiles.append(tile)
-        tile_id = zxy_to_tileid(tile.z, tile.x, tile.y)
+        if checkpoint is None:
+            raise Exception("No checkpoint to rollback to")
 
-        if self.should_be_compressed and not is_compressed:
-            tdata = gzip.compress(tdata)
+        if self.metrics is not None:
+            self.metrics.add('rollbacks')
 
-        self.writer.write_tile(tile_id, tdata)
+        self.num_tiles = checkpoint.num_tiles
+        self.extents = { z: list(extent) for z, extent in checkpoint.extents.items() }
+        del self.row_chunks[checkpoint.num_row_chunks:]
 
-    def checkpoint(self):
-        if not self._is_size_cached:
-            self._cached_size = self._calculate_size()
-            self._is_size_cached = True
+        self.writer.truncate(checkpoint.num_tile_entries, checkpoint.last_run_length)
 
-        self.last_checkpoint = WriterCheckpoint(self.writer, self.tiles)
-        self.last_checkpoint.size = self._cached_size
+        # dicts keep insertion order, so the hashes added since the checkpoint are the last ones
+        hash_to_offset = self.writer.hash_to_offset
+        while len(hash_to_offset) > checkpoint.num_hashes:
+            hash_to_offset.popitem()
 
+        self.writer.num_contents = checkpoint.num_contents
+        self.writer.offset = checkpoint.offset
+        self.writer.addressed_tiles = checkpoint.addressed_tiles
+        self.writer.clustered = checkpoint.clustered
 
-    def rollback(self):
-        if self.last_checkpoint is None:
-            raise Exception("No checkpoint to rollback to")
+        self.entries_size = checkpoint.entries_size
+        self._is_size_cached = checkpoint.size is not None
+        if self._is_size_cached:
+            self._cached_size = checkpoint.size
 
-        self.tiles = copy.copy(self.last_checkpoint.tiles)
 
-        self.writer.tile_entries = copy.copy(self.last_checkpoint.tile_entries)
-        self.writer.hash_to_offset = copy.copy(self.last_checkpoint.hash_to_offset)
-        self.writer.offset = self.last_checkpoint.offset
-        self.writer.addressed_tiles = self.last_checkpoint.addressed_tiles
-        self.writer.clustered = self.last_checkpoint.clustered
+    def get_info(self):
+        return get_info_from_extents(self.extents)
 
-        self.writer.tile_f.seek(self.writer.offset)
-        self.writer.tile_f.truncate(self.writer.offset)
+    def is_empty(self):
+        return self.num_tiles == 0
 
-        self._cached_size = self.last_checkpoint.size
-        self._is_size_cached = True
+    def get_metadata_size(self, extents=None):
+        if extents is None:
+            extents = self.extents
+        zoom_range = (min(extents.keys()), max(extents.keys()))
+        if zoom_range not in self.metadata_sizes:
+            metadata = get_clamped_metadata(self.metadata, *zoom_range)
+            self.metadata_sizes[zoom_range] = len(gzip.compress(json.dumps(metadata).encode()))
+        return self.metadata_sizes[zoom_range]
 
+    def get_size_bounds(self):
+        if self.num_tiles == 0:
+            return 0, 0
 
-    def is_empty(self):
-        return len(self.tiles) == 0
+        lower = PMTILES_HEADER_SIZE + self.get_metadata_size() + self.writer.offset
+        upper = lower + directory_size_upper_bound(self.writer.num_entries, self.entries_size)
+        return lower, upper
 
-    def finalize(self, pmtiles_fname):
-        self.writer.f.close()
-        Path(pmtiles_fname).parent.mkdir(parents=True, exist_ok=True)
-        self.writer.f = open(pmtiles_fname, 'wb')
-        header, header_for_mosaic, metadata = get_header_and_metadata(self.header_base, self.metadata, self.tiles)
-        self.writer.finalize(header, metadata)
-        return header_for_mosaic
+    def exceeds_size(self, size_limit):
+        # only pay for sizing the directories when the running bounds can't decide
+        lower, upper = self.get_size_bounds()
+        if upper <= size_limit:
+            return False
 
-    def get_size(self):
-        # TODO: is this required?
-        if self.last_checkpoint and len(self.tiles) == len(self.last_checkpoint.tiles):
-            return self.last_checkpoint.size
+        if lower > size_limit:
+            return True
+
+        return self.get_size() > size_limit
 
+    def get_size(self):
         if self._is_size_cached:
             return self._cached_size
 
@@ -348,39 +447,91 @@ class CheckpointablePMTilesWriter(LoggerMixin):
         return self._cached_size
 
     def _calculate_size(self):
-        # Estiamating header size will fail if there are no tiles, shortcircuiting here
-        if len(self.tiles) == 0:
+        if self.num_tiles == 0:
             return 0
 
-        header = get_header(self.tiles, self.header_base, use_lower_zoom_for_bounds=True)
-
-        prev_tile_f = self.writer.tile_f
-        prev_f = self.writer.f
+        if self.metrics is not None:
+            self.metrics.add('trial_finalizes')
+        return (PMTILES_HEADER_SIZE +
+                self.writer.get_directories_size() +
+                self.get_metadata_size() +
+                self.writer.offset)
 
-        self.writer.tile_f = tempfile.TemporaryFile()
-        new_f = tempfile.TemporaryFile()
-        self.writer.f = new_f
+    def get_size_at(self, checkpoint):
+        # exact size of the slice as it was at an earlier checkpoint, without rolling back to it
+        if checkpoint.size is not None:
+            return checkpoint.size
 
-        self.writer.finalize(header, self.metadata)
-
-        self.writer.tile_f = prev_tile_f
-        self.writer.f = prev_f
-
-        sz = self.writer.offset + new_f.tell()
-        new_f.close()
+        if checkpoint.num_tiles == 0:
+            return 0
 
-        return sz
+        if self.metrics is not None:
+            self.metrics.add('trial_finalizes')
+        directories_size = self.writer.get_directories_size(checkpoint.num_tile_entries,
+                                                            checkpoint.last_run_length)
+        checkpoint.size = (PMTILES_HEADER_SIZE +
+                           directories_size +
+                           self.get_metadata_size(checkpoint.extents) +
+                           checkpoint.offset)
+        return checkpoint.size
 
     def close(self):
         if self.last_checkpoint is not None:
             del self.last_checkpoint
+        self.writer.close()
+
+
+class PlannedSlice:
+    def __init__(self, name, context, rows, num_tiles, tiles_info, size, tile_id_range=None, replaces=None):
+        self.name = name
+        self.context = context
+        self.rows = rows
+        self.num_tiles = num_tiles
+        self.tiles_info = tiles_info
+        self.size = size
+        self.tile_id_range = tile_id_range
+        # the partition of the previous mosaic this one is moved over once the new mosaic is written
+        self.replaces = replaces
+
+    @property
+    def mosaic_name(self):
+        return Path(self.replaces if self.replaces is not None else self.name).name
+
+
+# Consecutive blocks of rows[start:stop], sliced out on demand
+class RowBlocks:
+    def __init__(self, rows, start, stop, block_size):
+        self.rows = rows
+        self.start = start
+        self.stop = stop
+        self.block_size = block_size
+
+    def __len__(self):
+        return (self.stop - self.start + self.block_size - 1) // self.block_size
+
+    def get_start(self, i):
+        return min(self.start + i * self.block_size, self.stop)
+
+    def __getitem__(self, i):
+        start = self.get_start(i)
+        return self.rows[start:min(start + self.block_size, self.stop)]
 
 
 class Partitioner(LoggerMixin):
-    def __init__(self, reader, to_pmtiles_prefix, size_limit_bytes, should_cache, logger=None, exclude_transparent=False):
+    def __init__(self, reader, to_pmtiles_prefix, size_limit_bytes, should_cache, logger=None, exclude_transparent=False, workers=1, source_paths=None, cache_dir=None, max_memory=None, strategy='zxy', balance=False, incremental=False, resume=False, recompress=False, metrics=None):
+        # the tile cache and the journal are only valid for the sources they were made from
+        if source_paths is None and (cache_dir is not None or resume):
+            raise ValueError('source_paths is needed with cache_dir or resume, to tell whether the sources changed')
+
         self.reader = reader
         self.logger = logger
+        self.metrics = metrics if metrics is not None else Metrics('partition')
+        self.strategy = strategy
+        self.balance = balance
+        self.incremental = incremental
         self.exclude_transparent = exclude_transparent
+        self.workers = workers
+        self.source_paths = source_paths
 
         self.max_zoom_level = reader.max_zoom
         self.min_zoom_level = reader.min_zoom
@@ -393,219 +544,392 @@ class Partitioner(LoggerMixin):
         self.size_limit_bytes = size_limit_bytes
         self.should_cache = should_cache
 
+        self.should_be_compressed = (self.header_base['tile_compression'] == Compression.GZIP)
+
         self.part_count = 0
+        self.planned_slices = []
         self.headers = []
         self.partition_names = []
 
-        self.all_tiles = []
-
-        self.cache_dict = {}
-        self.cache_file = tempfile.TemporaryFile()
-        self.cache_offset = 0
-
+        self.tile_index = None
+        self.source_extents = {}
+        self.source_bytes_read = 0
+        self.plan_progress = None
+        self.index_from_cache = False
+
+        # set when an incremental run goes ahead against the previous mosaic
+        self.previous_mosaic = None
+        self.kept_slices = {}
+        self.slice_order = []
+        self.stale_files = []
+        self.free_part_number = 0
+
+        self.tile_cache = None
+        self.cache_dir = None
+        if cache_dir is not None:
+            # anything that changes the prepared tiles has to be part of the fingerprint
+            fingerprint = {
+                'sources': get_sources_fingerprint(source_paths),
+                'exclude_transparent': exclude_transparent,
+                'recompress': recompress,
+            }
+            self.cache_dir = TileCacheDir(cache_dir, fingerprint)
+
+        self.journal = None
+        if resume:
+            # anything that changes the plan has to be part of the key
+            run_key = {
+                'sources': get_sources_fingerprint(source_paths),
+                'size_limit': size_limit_bytes,
+                'strategy': strategy,
+                'balance': balance,
+                'exclude_transparent': exclude_transparent,
+                'incremental': incremental,
+                'recompress': recompress,
+            }
+            self.journal = PartitionJournal(f'{to_pmtiles_prefix}.journal.jsonl', run_key, logger=logger)
+
+        # what the process holds by now is taken off the budget, the rest is split between the working sets
+        self.spill = None
+        self.max_memory = max_memory
+        compressor_memory = None
+        if max_memory is not None:
+            self.spill = SpillArea(max_memory)
+            compressor_memory = self.spill.compressor_memory
+        # contents that repeat in the index, only sorted out to bound the planning state under a budget
+        self.repeated_hashes = None
+
+        self.recompress = recompress
+        self.compressor = TileCompressor(workers=workers, recompress=recompress, max_memory=compressor_memory)
+
+        self.transparency_checker = None
+        if exclude_transparent and TransparencyChecker.applies_to(self.header_base['tile_type']):
+            self.transparency_checker = TransparencyChecker(self.header_base['tile_type'],
+                                                            workers=workers,
+                                                            logger=logger)
+
+
+    @property
+    def chunk_size(self):
+        if self.spill is not None:
+            return self.spill.chunk_size
+        return ROWS_CHUNK_SIZE
+
+    @property
+    def object_chunk_size(self):
+        # rows turned into python objects take several times the space of their numpy arrays
+        if self.spill is not None:
+            return self.spill.object_chunk_size
+        return ROWS_CHUNK_SIZE
+
+    def group_rows_by(self, rows, get_keys):
+        if self.spill is None or self.spill.fits_in_memory(len(rows)):
+            return group_rows(rows, get_keys(rows))
+        return group_rows_external(rows, get_keys, self.spill)
+
+    def concatenate_rows(self, row_chunks):
+        if self.spill is None:
+            return np.concatenate(row_chunks)
+        return self.spill.concatenate(row_chunks)
 
     def get_current_partition_filename(self):
         return get_pmtiles_file_name(self.to_pmtiles_prefix, f'part{self.part_count:04d}')
 
-    def cache_tile(self, tile, tdata):
-        tile_id = zxy_to_tileid(tile.z, tile.x, tile.y)
-        if tile_id in self.cache_dict:
-            return
-
-        self.cache_dict[tile_id] = (self.cache_offset, len(tdata))
-        self.cache_file.write(tdata)
-        self.cache_offset += len(tdata)
-
-    def get_tile_data(self, tile):
+    def get_tile_data(self, row, tile):
         if not self.should_cache:
             return self.reader.get_tile_data(tile)
 
-        tile_id = zxy_to_tileid(tile.z, tile.x, tile.y)
-        if tile_id not in self.cache_dict:
-            raise Exception(f'Tile {tile} not found in cache')
+        return self.tile_cache.get(int(self.tile_index.offset[row]), int(self.tile_index.size[row]))
+
+    def track_source_reads(self, items, progress):
+        for tile, tdata in items:
+            self.source_bytes_read += len(tdata)
+            progress.update(1, len(tdata))
+            yield tile, tdata
+
+    def track_source_extents(self, items):
+        for tile, tdata in items:
+            update_zoom_extents(self.source_extents, tile)
+            yield tile, tdata
 
-        offset, size = self.cache_dict[tile_id]
-        self.cache_file.seek(offset)
-        return self.cache_file.read(size)
+    def prepared_tiles(self, progress):
+        # tiles exactly as they will be stored in the partitions
+        items = self.track_source_reads(self.reader.all(), progress)
+
+        if self.transparency_checker is not None:
+            # excluded tiles still count towards the bounds of the whole tileset
+            items = self.transparency_checker.filter_all(self.track_source_extents(items))
+
+        # compression runs ahead of the indexing on the worker threads
+        if self.should_be_compressed:
+            items = self.compressor.compress_all(items)
+
+        return items
+
+    def load_cached_tiles(self):
+        loaded = self.cache_dir.load()
+        if loaded is None:
+            self.log_info(f'No usable tile cache in {self.cache_dir.cache_dir}')
+            self.metrics.set('tile_cache_reused', False)
+            return False
+
+        self.tile_index, self.tile_cache, extra = loaded
+        self.source_extents = { int(z): extent for z, extent in extra.get('source_extents', {}).items() }
+        self.log_info(f'Using {len(self.tile_index)} tiles from the tile cache in {self.cache_dir.cache_dir}')
+        self.index_from_cache = True
+        self.metrics.set('tile_cache_reused', True)
+        return True
 
     def collect_tiles(self):
+        if self.cache_dir is not None and self.load_cached_tiles():
+            return
+
         caching_msg = ''
         if self.should_cache:
             caching_msg = ' and caching them as well'
+            if self.cache_dir is not None:
+                self.tile_cache = self.cache_dir.create_tile_cache()
+            else:
+                self.tile_cache = TileCache.create()
 
         self.log_info(f'Collecting tiles from source{caching_msg}...')
 
-        count = 0
+        builder = TileIndexBuilder(spill=self.spill)
+        # counted as the tiles are read from the source
+        progress = Progress('Collecting tiles', total=self.reader.get_tile_count(), logger=self.logger)
+        for tile, tdata in self.prepared_tiles(progress):
+            offset = 0
+            if self.should_cache:
+                offset = self.tile_cache.append(tdata)
+            # the pmtiles writer deduplicates on hash(), so the plan has to as well
+            builder.append(tile, len(tdata), offset, hash(tdata))
+        progress.done()
+
+        self.tile_index = builder.build()
+        if builder.num_spilled > 0:
+            self.log_info(f'Tile index of {len(self.tile_index)} tiles spilled to {self.spill.dir}')
         if self.should_cache:
-            for tile, tdata in self.reader.all():
-                if count % 100000 == 0:
-                    self.log_info(f'Handled {count} tiles...')
-                self.all_tiles.append(tile)
-                self.cache_tile(tile, tdata)
-                count += 1
-        else:
-            for tile, tsize in self.reader.all_sizes():
-                if count % 100000 == 0:
-                    self.log_info(f'Handled {count} tiles...')
-                self.all_tiles.append(tile)
-                count += 1
+            self.tile_cache.seal()
+
+        if self.transparency_checker is not None:
+            checker = self.transparency_checker
+            self.log_info(f'Transparency checks: {checker.misses} images decoded, {checker.hits} served from cache')
+            self.metrics.set_hit_rate('transparency_cache', checker.hits, checker.misses)
+            checker.close()
+
+        if self.cache_dir is not None:
+            self.cache_dir.save(self.tile_index, { 'source_extents': self.source_extents })
+            self.log_info(f'Saved the tile cache to {self.cache_dir.cache_dir}')
 
-    def complete_current_slice(self, curr_slice_writer, context, pmtiles_file_name=None):
+    def complete_current_slice(self, curr_slice, context, pmtiles_file_name=None, tile_id_range=None, replaces=None):
         if pmtiles_file_name is None:
             pmtiles_file_name = self.get_current_partition_filename()
 
-        self.log_info(f'Finalizing partition {pmtiles_file_name} with {len(curr_slice_writer.tiles)} tiles, context: {context}')
-        header = curr_slice_writer.finalize(pmtiles_file_name)
-        curr_slice_writer.close()
-        self.headers.append(header)
-        self.partition_names.append(Path(pmtiles_file_name).name)
+        if tile_id_range is not None:
+            tiles_info = get_union_info_from_extents(curr_slice.extents)
+        else:
+            tiles_info = curr_slice.get_info()
+
+        size = curr_slice.get_size()
+        self.log_info(f'Planned partition {pmtiles_file_name} with {curr_slice.num_tiles} tiles and {size} bytes, context: {context}')
+        planned_slice = PlannedSlice(pmtiles_file_name, context, self.concatenate_rows(curr_slice.row_chunks),
+                                     curr_slice.num_tiles, tiles_info, size, tile_id_range=tile_id_range,
+                                     replaces=replaces)
+        curr_slice.close()
+        self.planned_slices.append(planned_slice)
         self.part_count += 1
+        if self.plan_progress is not None:
+            self.plan_progress.update(planned_slice.num_tiles)
  
-    def create_new_writer(self):
-        return CheckpointablePMTilesWriter(self.header_base, self.src_metadata,
-                                           logger=self.logger,
-                                           exclude_transparent=self.exclude_transparent)
-
-    def partition_by_y(self, from_zoom_level, to_zoom_level, x_tiles, context):
-        self.log_info(f'Partitioning by x for context: {context}, {from_zoom_level=}-->{to_zoom_level=}')
+    def create_new_estimator(self):
+        return SliceEstimator(self.tile_index, self.header_base, self.src_metadata,
+                              logger=self.logger, chunk_size=self.object_chunk_size, metrics=self.metrics,
+                              spill=self.spill, repeated_hashes=self.repeated_hashes)
+
+    def fill_slice(self, curr_slice, stripes, start, limit=None):
+        # Adds stripes from start onwards to the slice for as long as they fit, and returns
+        # the index of the first stripe left out.
+        # Stripes go in without any exact measurement while the size bounds allow them to fit.
+        # The exact boundary is then binary searched over the checkpoints of the stripes the
+        # bounds couldn't decide on, so only a handful of exact sizes are ever computed.
+        if limit is None:
+            limit = self.size_limit_bytes
+        checkpoints = []
+        known_fit = start
+        end = start
+        while end < len(stripes):
+            checkpoints.append(curr_slice.checkpoint())
+            curr_slice.add_rows(stripes[end], limit)
+            end += 1
+
+            lower, upper = curr_slice.get_size_bounds()
+            if upper <= limit:
+                known_fit = end
+                continue
+
+            if lower > limit:
+                break
 
-        tiles_by_y = {}
-        for t in x_tiles:
-            if t.z == from_zoom_level:
-                pt = t
+        def size_at(count):
+            if count == end:
+                # the lower bound is as good as the exact size when it's already over
+                lower, _ = curr_slice.get_size_bounds()
+                if lower > limit:
+                    return lower
+                return curr_slice.get_size()
+            return curr_slice.get_size_at(checkpoints[count - start])
+
+        # Sizes grow about linearly with the stripes, so once there is a size known on either
+        # side of the boundary, the next guess is interpolated between them. Whenever a guess
+        # fails to halve the range, the next one halves it instead.
+        lo = known_fit
+        hi = end
+        lo_size = None
+        over_size = None
+        should_halve = False
+        while lo < hi:
+            if should_halve or lo_size is None or over_size is None:
+                mid = (lo + hi + 1) // 2
             else:
-                pt = mercantile.parent(t, zoom=from_zoom_level)
-            if pt.y not in tiles_by_y:
-                tiles_by_y[pt.y] = []
-            tiles_by_y[pt.y].append(t)
-
-        y_levels = sorted(tiles_by_y.keys())
-
-        curr_slice_writer = self.create_new_writer()
+                mid = lo + (limit - lo_size) * (hi + 1 - lo) // (over_size - lo_size)
+                mid = min(max(mid, lo + 1), hi)
 
+            prev_range = hi - lo
+            size = size_at(mid)
+            if size <= limit:
+                lo, lo_size = mid, size
+            else:
+                hi, over_size = mid - 1, size
+            should_halve = not should_halve and (hi - lo) > prev_range // 2
+
+        if lo < end:
+            curr_slice.rollback(checkpoints[lo - start])
+        return lo
+
+    def get_stripe_slices(self, stripes, limit, oversize=None, on_slice=None, max_slices=None):
+        # Greedily fills slices with consecutive stripes and returns the (start, end) of each,
+        # with start == end for a stripe that doesn't fit in a slice on its own.
+        # With oversize given, those are the only stripes allowed not to fit, None is returned
+        # if any other doesn't, or if it takes more than max_slices slices.
+        # on_slice(curr_slice, start, end) takes over each filled slice, with curr_slice None
+        # for the stripes that don't fit.
+        slices = []
         i = 0
-        start_y = None
-        while i < len(y_levels):
-            y = y_levels[i]
-            y_tiles = tiles_by_y[y]
-
-            if start_y is None:
-                start_y = y
-
-            curr_slice_writer.checkpoint()
-
-            # write all tiles in this y stripe to the current slice writer
-            for t in y_tiles:
-                curr_slice_writer.write_tile(t, self.get_tile_data(t))
-
-
-            size_till_now = curr_slice_writer.get_size()
-            if size_till_now > self.size_limit_bytes:
-
-                curr_slice_writer.rollback()
+        while i < len(stripes):
+            if max_slices is not None and len(slices) >= max_slices:
+                return None
+            curr_slice = None
+            end = i
+            if oversize is None or i not in oversize:
+                curr_slice = self.create_new_estimator()
+                end = self.fill_slice(curr_slice, stripes, i, limit)
+
+            if end == i:
+                if oversize is not None and i not in oversize:
+                    return None
+                if curr_slice is not None:
+                    curr_slice.close()
+                    curr_slice = None
+                end = i + 1
+
+            slices.append((i, i if curr_slice is None else end))
+            if on_slice is not None:
+                on_slice(curr_slice, i, end)
+            elif curr_slice is not None:
+                curr_slice.close()
+            i = end
+        return slices
+
+    def get_balanced_limit(self, num_slices, get_slices):
+        # The smallest size limit that still needs no more than num_slices slices. Greedy filling
+        # already makes as few slices as possible, with a lower limit it spreads the same number
+        # of slices more evenly instead of leaving a near empty one at the end.
+        # get_slices(limit, max_slices) returns the slices made with limit, or None if it
+        # can't be done in max_slices slices.
+        lo = 0
+        hi = self.size_limit_bytes
+        while hi - lo > max(1, self.size_limit_bytes // BALANCE_PRECISION):
+            mid = (lo + hi) // 2
+            if get_slices(mid, num_slices) is not None:
+                hi = mid
+            else:
+                lo = mid
+        self.log_info(f'Balanced size limit for {num_slices} slices: {hi} bytes')
+        return hi
+
+    def pack_stripes(self, axis, levels, stripes, context, split_stripe):
+        # split_stripe(i, context) deals with a stripe that doesn't fit in a slice on its own
+        def on_slice(curr_slice, start, end):
+            if curr_slice is None:
+                split_stripe(start, context + [(axis, levels[start], levels[start])])
+                return
+            self.complete_current_slice(curr_slice, context + [(axis, levels[start], levels[end - 1])])
 
-                if not curr_slice_writer.is_empty():
-                    new_context = context + [('y', start_y, y_levels[i - 1])]
-                    self.complete_current_slice(curr_slice_writer, new_context)
+        if not self.balance:
+            self.get_stripe_slices(stripes, self.size_limit_bytes, on_slice=on_slice)
+            return
 
-                    curr_slice_writer = self.create_new_writer()
-                    start_y = None
-                    continue
+        slices = self.get_stripe_slices(stripes, self.size_limit_bytes)
+        oversize = { start for start, end in slices if start == end }
+        limit = self.size_limit_bytes
+        if len(slices) - len(oversize) > 1:
+            limit = self.get_balanced_limit(len(slices),
+                                            lambda limit, max_slices: self.get_stripe_slices(stripes, limit, oversize,
+                                                                                             max_slices=max_slices))
+        self.get_stripe_slices(stripes, limit, oversize, on_slice=on_slice)
 
-                new_context = context + [('y', start_y, y_levels[i - 1])]
-                self.partition_by_z(from_zoom_level, to_zoom_level, y_tiles, new_context)
+    def partition_by_y(self, from_zoom_level, to_zoom_level, x_rows, context):
+        self.log_info(f'Partitioning by y for context: {context}, {from_zoom_level=}-->{to_zoom_level=}')
 
-            i += 1
+        index = self.tile_index
+        y_levels, sorted_rows, y_boundaries = self.group_rows_by(
+            x_rows, lambda rows: get_ancestor_coords(index.z[rows], index.y[rows], from_zoom_level))
+        y_stripes = [ sorted_rows[y_boundaries[i]:y_boundaries[i + 1]] for i in range(len(y_levels)) ]
 
-        if not curr_slice_writer.is_empty():
-            new_context = context + [('y', start_y, y_levels[i - 1])]
-            self.complete_current_slice(curr_slice_writer, new_context)
+        self.pack_stripes('y', y_levels, y_stripes, context,
+                          lambda i, new_context: self.partition_by_z(from_zoom_level, to_zoom_level, y_stripes[i], new_context))
 
-    def partition_by_x(self, from_zoom_level, to_zoom_level, tiles_by_z, context):
+    def partition_by_x(self, from_zoom_level, to_zoom_level, rows_by_z, context):
         self.log_info(f'Partitioning by x for context: {context}, {from_zoom_level=}-->{to_zoom_level=}')
 
-        tiles_by_x = {}
-        for zoom_level in range(from_zoom_level, to_zoom_level + 1):
-            for tile in tiles_by_z[zoom_level]:
-
-                if tile.z == from_zoom_level:
-                    pt = tile
-                else:
-                    pt = mercantile.parent(tile, zoom=from_zoom_level)
-                if pt.x not in tiles_by_x:
-                    tiles_by_x[pt.x] = []
-                tiles_by_x[pt.x].append(tile)
-
-        x_levels = sorted(tiles_by_x.keys())
-
-        curr_slice_writer = self.create_new_writer()
-
-        i = 0
-        start_x = None
-        while i < len(x_levels):
-            x = x_levels[i]
-            x_tiles = tiles_by_x[x]
-
-            if start_x is None:
-                start_x = x
-
-            curr_slice_writer.checkpoint()
-
-            # write all tiles in this x stripe to the current slice writer
-            for t in x_tiles:
-                curr_slice_writer.write_tile(t, self.get_tile_data(t))
-
-            size_till_now = curr_slice_writer.get_size()
-            if size_till_now > self.size_limit_bytes:
-
-                curr_slice_writer.rollback()
-
-                if not curr_slice_writer.is_empty():
-                    new_context = context + [('x', start_x, x_levels[i - 1])]
-                    self.complete_current_slice(curr_slice_writer, new_context)
-
-                    curr_slice_writer = self.create_new_writer()
-                    start_x = None
-                    continue
-
-                new_context = context + [('x', start_x, x_levels[i - 1])]
-                self.partition_by_y(from_zoom_level, to_zoom_level, x_tiles, new_context)
-
-            i += 1
+        z_rows = [ rows_by_z[z] for z in range(from_zoom_level, to_zoom_level + 1) if z in rows_by_z ]
+        index = self.tile_index
+        x_levels, sorted_rows, x_boundaries = self.group_rows_by(
+            self.concatenate_rows(z_rows),
+            lambda rows: get_ancestor_coords(index.z[rows], index.x[rows], from_zoom_level))
+        x_stripes = [ sorted_rows[x_boundaries[i]:x_boundaries[i + 1]] for i in range(len(x_levels)) ]
 
-        if not curr_slice_writer.is_empty():
-            new_context = context + [('x', start_x, x_levels[i - 1])]
-            self.complete_current_slice(curr_slice_writer, new_context)
+        self.pack_stripes('x', x_levels, x_stripes, context,
+                          lambda i, new_context: self.partition_by_y(from_zoom_level, to_zoom_level, x_stripes[i], new_context))
 
-    def partition_by_z(self, from_zoom_level, to_zoom_level, tiles, context):
+    def partition_by_z(self, from_zoom_level, to_zoom_level, rows, context):
 
-        self.log_info(f'Partitioning by x for context: {context}, {from_zoom_level=}-->{to_zoom_level=}')
+        self.log_info(f'Partitioning by z for context: {context}, {from_zoom_level=}-->{to_zoom_level=}')
 
-        tiles_by_z = {}
-        for tile in tiles:
-            if tile.z not in tiles_by_z:
-                tiles_by_z[tile.z] = []
-            tiles_by_z[tile.z].append(tile)
+        z_levels, sorted_rows, z_boundaries = self.group_rows_by(rows, lambda rows: self.tile_index.z[rows])
+        rows_by_z = {}
+        for i, z in enumerate(z_levels):
+            rows_by_z[z] = sorted_rows[z_boundaries[i]:z_boundaries[i + 1]]
 
-        top_slice_writer = self.create_new_writer()
+        top_slice = self.create_new_estimator()
 
         top_slice_max_level = None
         for zoom_level in range(from_zoom_level, to_zoom_level + 1):
             self.log_debug(f'Trying to add zoom level {zoom_level} to top slice for context: {context}')
-            top_slice_writer.checkpoint()
+            top_slice.checkpoint()
 
 
-            self.log_debug(f'Adding zoom level {zoom_level} with {len(tiles_by_z[zoom_level])} tiles to top slice for context: {context}')
-            for tile in tiles_by_z[zoom_level]:
-                top_slice_writer.write_tile(tile, self.get_tile_data(tile))
+            z_rows = rows_by_z.get(zoom_level, rows[:0])
+            self.log_debug(f'Adding zoom level {zoom_level} with {len(z_rows)} tiles to top slice for context: {context}')
+            top_slice.add_rows(z_rows, self.size_limit_bytes)
 
             
 
 
-            size_till_now = top_slice_writer.get_size()
-            self.log_debug(f'Size after adding zoom level {zoom_level} is {size_till_now} bytes for context: {context}')
-            if size_till_now > self.size_limit_bytes:
-                top_slice_writer.rollback()
+            size_lower, size_upper = top_slice.get_size_bounds()
+            self.log_debug(f'Size after adding zoom level {zoom_level} is between {size_lower} and {size_upper} bytes for context: {context}')
+            if top_slice.exceeds_size(self.size_limit_bytes):
+                top_slice.rollback()
                 top_slice_max_level = zoom_level - 1
                 break
 
@@ -613,14 +937,14 @@ class Partitioner(LoggerMixin):
         if top_slice_max_level is None:
             top_slice_max_level = to_zoom_level
 
-        if not top_slice_writer.is_empty():
+        if not top_slice.is_empty():
 
             new_context = context + [('z', from_zoom_level, top_slice_max_level)]
             if top_slice_max_level == to_zoom_level and len(context) == 0:
                 pmtiles_file_name = get_pmtiles_file_name(self.to_pmtiles_prefix, '')
-                self.complete_current_slice(top_slice_writer, new_context, pmtiles_file_name=pmtiles_file_name)
+                self.complete_current_slice(top_slice, new_context, pmtiles_file_name=pmtiles_file_name)
             else:
-                self.complete_current_slice(top_slice_writer, new_context)
+                self.complete_current_slice(top_slice, new_context)
 
             if top_slice_max_level == to_zoom_level:
                 return
@@ -628,16 +952,466 @@ class Partitioner(LoggerMixin):
         new_from_zoom_level = top_slice_max_level + 1
 
         # TODO: think this case through.. you need to stop somewhere and give up
-        if len(tiles) <= 1:
+        if len(rows) <= 1:
             raise Exception(f'Cannot drill down further, context: {context}')
 
         new_context = context + [('z', new_from_zoom_level, to_zoom_level)]
-        self.partition_by_x(new_from_zoom_level, to_zoom_level, tiles_by_z, new_context)
+        self.partition_by_x(new_from_zoom_level, to_zoom_level, rows_by_z, new_context)
+
+    def sort_rows_by_tile_id(self, rows):
+        index = self.tile_index
+        if self.spill is None or self.spill.fits_in_memory(len(rows)):
+            return rows[np.argsort(index.tile_id[rows], kind='stable')]
+        return sort_rows_external(rows, index.tile_id, self.spill)
+
+    def get_tile_id_slices(self, sorted_rows, limit, on_slice=None, max_slices=None):
+        # (start, end) of the consecutive rows that go in each slice, or None if a single tile
+        # doesn't fit or it takes more than max_slices slices.
+        # on_slice(curr_slice, start, end) takes over each filled slice
+        num_rows = len(sorted_rows)
+        slices = []
+        i = 0
+        while i < num_rows:
+            if max_slices is not None and len(slices) >= max_slices:
+                return None
+            curr_slice = self.create_new_estimator()
+            start = i
+            stop = num_rows
+            # the block that doesn't fit anymore is tried again as smaller blocks
+            for block_size in HILBERT_BLOCK_SIZES:
+                blocks = RowBlocks(sorted_rows, i, stop, block_size)
+                end = self.fill_slice(curr_slice, blocks, 0, limit)
+                i = blocks.get_start(end)
+                if end == len(blocks):
+                    break
+                stop = min(i + block_size, stop)
+
+            if i == start:
+                curr_slice.close()
+                return None
+
+            slices.append((start, i))
+            if on_slice is not None:
+                on_slice(curr_slice, start, i)
+            else:
+                curr_slice.close()
+        return slices
+
+    def partition_by_tile_id(self, rows):
+        # Cuts the rows in tile id order, which is the order the pmtiles writer lays tiles out in,
+        # into consecutive ranges that each fill a slice as much as possible
+        self.log_info('Partitioning by tile id ranges')
+
+        sorted_rows = self.sort_rows_by_tile_id(rows)
+        tile_ids = self.tile_index.tile_id
+        num_rows = len(sorted_rows)
+
+        planned_rows = [0]
+
+        def on_slice(curr_slice, start, end):
+            planned_rows[0] = end
+            tile_id_range = (int(tile_ids[sorted_rows[start]]), int(tile_ids[sorted_rows[end - 1]]))
+            pmtiles_file_name = None
+            if start == 0 and end == num_rows:
+                pmtiles_file_name = get_pmtiles_file_name(self.to_pmtiles_prefix, '')
+            self.complete_current_slice(curr_slice, [('tile_id', *tile_id_range)],
+                                        pmtiles_file_name=pmtiles_file_name, tile_id_range=tile_id_range)
+
+        limit = self.size_limit_bytes
+        if self.balance:
+            slices = self.get_tile_id_slices(sorted_rows, limit)
+            if slices is not None and len(slices) > 1:
+                limit = self.get_balanced_limit(len(slices),
+                                                lambda limit, max_slices: self.get_tile_id_slices(sorted_rows, limit,
+                                                                                                  max_slices=max_slices))
+
+        if self.get_tile_id_slices(sorted_rows, limit, on_slice=on_slice) is None:
+            raise Exception(f'Tile {self.tile_index.get_tile(sorted_rows[planned_rows[0]])} does not fit in a partition on its own')
+
+    def load_previous_mosaic(self):
+        previous = PreviousMosaic.load(self.to_pmtiles_prefix, logger=self.logger)
+        if previous is None:
+            self.log_info(f'No previous mosaic at {self.to_pmtiles_prefix}.mosaic.json, partitioning everything')
+            return None
+
+        if previous.uses_tile_id_ranges() != (self.strategy == 'hilbert'):
+            self.log_info(f'Previous mosaic {previous.mosaic_file} was not made with the {self.strategy} strategy, partitioning everything')
+            return None
+
+        missing_files = previous.get_missing_files()
+        if len(missing_files) > 0:
+            self.log_info(f'{len(missing_files)} partitions of the previous mosaic are missing, like {missing_files[0]}, partitioning everything')
+            return None
+
+        return previous
+
+    def assign_to_previous_slices(self, previous, all_rows):
+        # all_rows are all the rows of the index in order, so the keys line up with them
+        index = self.tile_index
+        if self.spill is None or self.spill.fits_in_memory(len(all_rows), 8):
+            keys = np.empty(len(all_rows), dtype=np.int64)
+        else:
+            keys = self.spill.new_array(len(all_rows), np.int64)
+
+        for start, end in iter_chunks(len(all_rows), self.chunk_size):
+            rows = np.asarray(all_rows[start:end])
+            keys[start:end] = previous.assign(index.z[rows], index.x[rows], index.y[rows], index.tile_id[rows])
+        return keys
+
+    def get_content_hashes(self, rows):
+        if not self.index_from_cache:
+            return self.tile_index.content_hash[rows]
+
+        # hash() is salted per process, the hashes saved with the tile cache by an
+        # earlier run can't be compared with the ones of the previous partitions
+        index = self.tile_index
+        return np.array([ hash(bytes(self.tile_cache.get(offset, size)))
+                          for offset, size in zip(index.offset[rows].tolist(), index.size[rows].tolist()) ],
+                        dtype=np.int64)
+
+    def is_unchanged(self, previous_slice, sorted_rows):
+        tile_ids, hashes, header, metadata = previous_slice.read_contents()
+
+        index = self.tile_index
+        if len(tile_ids) != len(sorted_rows) or not np.array_equal(tile_ids, index.tile_id[sorted_rows]):
+            return False
+        if not np.array_equal(hashes, self.get_content_hashes(sorted_rows)):
+            return False
+
+        # same tiles, but the source metadata or tile type might still have changed
+        extents = get_zoom_extents_from_arrays(index.z[sorted_rows], index.x[sorted_rows], index.y[sorted_rows])
+        if previous_slice.tile_id_range is not None:
+            tiles_info = get_union_info_from_extents(extents)
+        else:
+            tiles_info = get_info_from_extents(extents)
+        new_header, _, new_metadata = get_header_and_metadata(self.header_base, self.src_metadata, tiles_info)
+
+        if json.loads(json.dumps(new_metadata)) != metadata:
+            return False
+        return convert_header(new_header, HEADER_EXPORT_KEYS) == convert_header(header, HEADER_EXPORT_KEYS)
+
+    def split_tile_id_range(self, previous_slice, sorted_rows, context):
+        tile_ids = self.tile_index.tile_id
+        num_rows = len(sorted_rows)
+        min_tile_id, max_tile_id = previous_slice.tile_id_range
+
+        # the pieces together still cover the whole range of the slice they replace
+        next_start = [min_tile_id]
+
+        def on_slice(curr_slice, start, end):
+            range_end = max_tile_id if end == num_rows else int(tile_ids[sorted_rows[end - 1]])
+            tile_id_range = (next_start[0], range_end)
+            next_start[0] = range_end + 1
+            self.complete_current_slice(curr_slice, context + [('tile_id', *tile_id_range)], tile_id_range=tile_id_range)
+
+        if self.get_tile_id_slices(sorted_rows, self.size_limit_bytes, on_slice=on_slice) is None:
+            raise Exception(f'A tile of {previous_slice.name} does not fit in a partition on its own')
+
+    def plan_previous_slice(self, previous_slice, rows):
+        sorted_rows = self.sort_rows_by_tile_id(rows)
+        if self.is_unchanged(previous_slice, sorted_rows):
+            self.log_info(f'Keeping partition {previous_slice.path} with {len(rows)} tiles, unchanged')
+            self.kept_slices[previous_slice.name] = previous_slice.entry
+            self.slice_order.append(previous_slice.name)
+            self.metrics.add('slices_kept')
+            self.plan_progress.update(len(rows))
+            return
+
+        context = [('previous', previous_slice.name)]
+        curr_slice = self.create_new_estimator()
+        curr_slice.add_rows(sorted_rows, self.size_limit_bytes)
+        if not curr_slice.exceeds_size(self.size_limit_bytes):
+            # the previous mosaic still points at the partition, so it is written next to
+            # it and only moved over it once the new mosaic is written
+            self.slice_order.append(previous_slice.name)
+            self.complete_current_slice(curr_slice, context, pmtiles_file_name=f'{previous_slice.path}.tmp',
+                                        tile_id_range=previous_slice.tile_id_range, replaces=previous_slice.path)
+            self.metrics.add('slices_rewritten')
+            return
+        curr_slice.close()
+
+        self.log_info(f'Partition {previous_slice.path} outgrew the size limit, splitting it')
+        self.stale_files.append(previous_slice.path)
+        self.metrics.add('slices_split')
+
+        # the pieces get partition numbers no earlier run used
+        first_piece = len(self.planned_slices)
+        self.part_count = self.free_part_number
+        if previous_slice.tile_id_range is not None:
+            self.split_tile_id_range(previous_slice, sorted_rows, context)
+        else:
+            h = previous_slice.header
+            self.partition_by_z(h['min_zoom'], h['max_zoom'], sorted_rows, context)
+        self.free_part_number = self.part_count
+        self.slice_order.extend(Path(ps.name).name for ps in self.planned_slices[first_piece:])
+
+    def plan_incremental(self, all_rows):
+        # Diffs the tiles against the slices of the previous mosaic. Unchanged slices are kept
+        # as they are, changed ones are rewritten and the ones that don't fit anymore
+        # are split. Returns False, with nothing planned, when it has to start from scratch
+        previous = self.load_previous_mosaic()
+        if previous is None:
+            return False
+
+        keys = self.assign_to_previous_slices(previous, all_rows)
+        slice_ids, sorted_rows, boundaries = self.group_rows_by(all_rows, lambda rows: keys[rows])
+        if len(slice_ids) > 0 and slice_ids[0] == -1:
+            self.log_info(f'{boundaries[1]} tiles fall outside the partitions of the previous mosaic, partitioning everything')
+            return False
+
+        self.log_info(f'Diffing {len(self.tile_index)} tiles against the {len(previous.slices)} partitions of {previous.mosaic_file}')
+        self.previous_mosaic = previous
+        self.free_part_number = previous.get_next_part_number(self.to_pmtiles_prefix)
+
+        rows_by_slice = {}
+        for i, slice_id in enumerate(slice_ids):
+            rows_by_slice[slice_id] = sorted_rows[boundaries[i]:boundaries[i + 1]]
+
+        for i, previous_slice in enumerate(previous.slices):
+            rows = rows_by_slice.get(i)
+            if rows is None:
+                self.log_info(f'Partition {previous_slice.path} has no tiles left, removing it')
+                self.stale_files.append(previous_slice.path)
+                self.metrics.add('slices_removed')
+                continue
+            self.plan_previous_slice(previous_slice, rows)
+        return True
+
+    def plan(self):
+        with self.metrics.phase('collect') as phase:
+            self.collect_tiles()
+            phase.add('tiles', len(self.tile_index))
+            phase.add('bytes_read', self.source_bytes_read)
+
+        with self.metrics.phase('plan') as phase:
+            if self.spill is not None:
+                self.repeated_hashes = get_repeated_hashes(self.tile_index.content_hash, self.spill)
+
+            # moves on as partitions get completed
+            self.plan_progress = Progress('Planning partitions', total=len(self.tile_index), logger=self.logger)
+            if self.spill is not None:
+                all_rows = self.spill.arange(len(self.tile_index))
+            else:
+                all_rows = self.tile_index.all_rows()
+
+            # an incremental run that can't go by the previous mosaic plans everything from scratch
+            planned = self.incremental and self.plan_incremental(all_rows)
+            if not planned:
+                if self.strategy == 'hilbert':
+                    self.partition_by_tile_id(all_rows)
+                else:
+                    self.partition_by_z(self.min_zoom_level, self.max_zoom_level, all_rows, [])
+            self.plan_progress.done()
+            phase.add('tiles', len(self.tile_index))
+
+        self.metrics.set('partitions', len(self.planned_slices))
+
+    def iter_slice_tiles(self, rows, progress):
+        # ((tile_id, may_repeat), tdata) pairs
+        index = self.tile_index
+        for start, end in iter_chunks(len(rows), self.object_chunk_size):
+            chunk = np.asarray(rows[start:end])
+            tile_ids = index.tile_id[chunk].tolist()
+            may_repeat = get_may_repeat(index.content_hash[chunk], self.repeated_hashes).tolist()
+            tiles = index.get_tiles(chunk)
+            for row, tile, tile_id, repeat in zip(chunk.tolist(), tiles, tile_ids, may_repeat):
+                tdata = self.get_tile_data(row, tile)
+                progress.update(1, len(tdata))
+                yield (tile_id, repeat), tdata
+
+    def get_slice_tiles(self, rows, progress):
+        items = self.iter_slice_tiles(rows, progress)
+
+        # the cache already holds the tiles as they are to be stored
+        if self.should_be_compressed and not self.should_cache:
+            items = self.compressor.compress_all(items)
+
+        return ( (tile_id, tdata, repeat) for (tile_id, repeat), tdata in items )
+
+    def get_slice_headers(self, planned_slice):
+        return get_header_and_metadata(self.header_base, self.src_metadata, planned_slice.tiles_info)
+
+    def get_slice_task(self, planned_slice):
+        header, _, metadata = self.get_slice_headers(planned_slice)
+        rows = planned_slice.rows
+        index = self.tile_index
+        if self.spill is not None:
+            rows_file = self.spill.new_file('.npy')
+            np.save(rows_file, rows)
+            return SliceTask(planned_slice.name, header, metadata, rows_file=rows_file,
+                             should_be_compressed=self.should_be_compressed)
+
+        tile_ids = index.tile_id[rows].tolist()
+        if self.should_cache:
+            return SliceTask(planned_slice.name, header, metadata, tile_ids,
+                             offsets=index.offset[rows].tolist(),
+                             sizes=index.size[rows].tolist())
+
+        tiles = list(zip(index.z[rows].tolist(), index.x[rows].tolist(), index.y[rows].tolist()))
+        return SliceTask(planned_slice.name, header, metadata, tile_ids,
+                         tiles=tiles, should_be_compressed=self.should_be_compressed)
+
+    def complete_slice_write(self, planned_slice, header_for_mosaic, size):
+        pmtiles_file_name = planned_slice.name
+        if size != planned_slice.size:
+            self.log_warning(f'Partition {pmtiles_file_name} is {size} bytes, planned for {planned_slice.size} bytes')
+
+        self.headers.append(header_for_mosaic)
+        self.partition_names.append(planned_slice.mosaic_name)
+
+        if self.journal is not None:
+            self.journal.record(pmtiles_file_name, planned_slice.context, planned_slice.num_tiles,
+                                convert_header(header_for_mosaic, SLICE_HEADER_EXPORT_KEYS), size)
+
+        phase = self.metrics.get_phase('write')
+        phase.add('tiles', planned_slice.num_tiles)
+        phase.add('bytes_written', size)
+
+    def get_written_size(self, planned_slice):
+        # the size of the partition if an earlier run of a resumed one already wrote it
+        if self.journal is None:
+            return None
+
+        _, header_for_mosaic, _ = self.get_slice_headers(planned_slice)
+        return self.journal.get_written_size(planned_slice.name, planned_slice.context, planned_slice.num_tiles,
+                                             convert_header(header_for_mosaic, SLICE_HEADER_EXPORT_KEYS))
+
+    def skip_written_slice(self, planned_slice, size, progress):
+        self.log_info(f'Skipping partition {planned_slice.name}, written by an earlier run')
+        _, header_for_mosaic, _ = self.get_slice_headers(planned_slice)
+        self.headers.append(header_for_mosaic)
+        self.partition_names.append(planned_slice.mosaic_name)
+        self.metrics.add('slices_resumed')
+        progress.update(planned_slice.num_tiles, size)
+
+    def write_slice(self, planned_slice, progress):
+        pmtiles_file_name = planned_slice.name
+        self.log_info(f'Writing partition {pmtiles_file_name} with {planned_slice.num_tiles} tiles, context: {planned_slice.context}')
+
+        header, header_for_mosaic, metadata = self.get_slice_headers(planned_slice)
+        size = write_slice_file(pmtiles_file_name, header, metadata, self.get_slice_tiles(planned_slice.rows, progress),
+                                spill=self.spill)
+        self.complete_slice_write(planned_slice, header_for_mosaic, size)
+
+    def get_writer_workers(self):
+        # the number of writer processes and the memory they share. Under a budget, a forked
+        # writer starts out holding about what the planner holds now, on top of which it
+        # needs its own working memory, so only as many writers as fit are used
+        if self.spill is None:
+            return self.workers, None
+
+        held_memory = get_anon_memory()
+        writer_memory = get_working_memory(self.max_memory, held_memory)
+        workers = min(self.workers, max(writer_memory, 0) // get_min_max_memory(held_memory))
+        if 1 < self.workers and workers < self.workers:
+            self.log_info(f'The memory budget leaves room for {workers} of the {self.workers} writer processes')
+        return workers, writer_memory
+
+    def can_write_in_parallel(self, workers):
+        if workers <= 1 or len(self.planned_slices) <= 1:
+            return False
+
+        # workers need their own way to get to the tile data
+        return self.should_cache or self.source_paths is not None
+
+    def get_saved_index_path(self):
+        if self.cache_dir is not None:
+            return self.cache_dir.index_dir
+
+        index_path = self.spill.dir / 'index'
+        self.tile_index.save(index_path)
+        return index_path
+
+    def write_partitions_in_parallel(self, progress, workers, writer_memory):
+        # no threads should be around when the worker processes get forked
+        self.compressor.close()
+
+        cache_path = None
+        if self.should_cache:
+            cache_path = self.tile_cache.path
+
+        # under a budget, tasks are rows of the index, which the workers map from disk
+        index_path = None
+        spill_dir = None
+        if self.spill is not None:
+            index_path = self.get_saved_index_path()
+            spill_dir = self.spill.dir
+
+        pool = SliceWriterPool(workers, source_paths=self.source_paths,
+                               cache_path=cache_path, recompress=self.recompress, logger=self.logger,
+                               index_path=index_path, repeated_hashes=self.repeated_hashes,
+                               max_memory=writer_memory, spill_dir=spill_dir)
+        written_sizes = [ self.get_written_size(planned_slice) for planned_slice in self.planned_slices ]
+        pending = [ planned_slice for planned_slice, size in zip(self.planned_slices, written_sizes) if size is None ]
+        tasks = ( self.get_slice_task(planned_slice) for planned_slice in pending )
+        sizes = pool.write_all(tasks, len(pending))
+        # partitions are completed in plan order, the pool hands back the sizes in the order of the tasks
+        for planned_slice, written_size in zip(self.planned_slices, written_sizes):
+            if written_size is not None:
+                self.skip_written_slice(planned_slice, written_size, progress)
+                continue
+
+            size = next(sizes)
+            _, header_for_mosaic, _ = self.get_slice_headers(planned_slice)
+            self.log_info(f'Wrote partition {planned_slice.name} with {planned_slice.num_tiles} tiles, context: {planned_slice.context}')
+            self.complete_slice_write(planned_slice, header_for_mosaic, size)
+            # the workers don't report back until a whole partition is written
+            progress.update(planned_slice.num_tiles, size)
+
+    def write_partitions(self):
+        with self.metrics.phase('write'):
+            if self.journal is not None:
+                self.journal.open()
+
+            progress = Progress('Writing partitions', total=sum(ps.num_tiles for ps in self.planned_slices), logger=self.logger)
+            workers, writer_memory = self.get_writer_workers()
+            if self.can_write_in_parallel(workers):
+                self.write_partitions_in_parallel(progress, workers, writer_memory)
+            else:
+                for planned_slice in self.planned_slices:
+                    written_size = self.get_written_size(planned_slice)
+                    if written_size is not None:
+                        self.skip_written_slice(planned_slice, written_size, progress)
+                    else:
+                        self.write_slice(planned_slice, progress)
+            progress.done()
+
+    def cleanup(self):
+        if self.journal is not None:
+            self.journal.close()
+        self.metrics.set_hit_rate('compression_memo', self.compressor.memo_hits, self.compressor.memo_misses)
+        self.compressor.close()
+        if self.transparency_checker is not None:
+            self.transparency_checker.close()
+        if self.tile_cache is not None:
+            self.tile_cache.close()
+        if self.spill is not None:
+            self.spill.close()
 
     def partition(self):
-        self.collect_tiles()
+        self.plan()
+        self.write_partitions()
 
-        self.partition_by_z(self.min_zoom_level, self.max_zoom_level, self.all_tiles, [])
+    def write_plan_file(self):
+        plan_data = {
+            'version': 1,
+            'size_limit': self.size_limit_bytes,
+            'slices': [],
+        }
+        for planned_slice in self.planned_slices:
+            header = get_header(self.header_base, planned_slice.tiles_info, use_lower_zoom_for_bounds=True)
+            plan_data['slices'].append({
+                'name': planned_slice.mosaic_name,
+                'ranges': [ list(r) for r in planned_slice.context ],
+                'num_tiles': planned_slice.num_tiles,
+                'estimated_size': planned_slice.size,
+                'header': convert_header(header, SLICE_HEADER_EXPORT_KEYS),
+            })
+
+        out_plan_file = f'{self.to_pmtiles_prefix}.plan.json'
+        with open(out_plan_file, 'w') as f:
+            json.dump(plan_data, f, indent=2)
+        self.log_info(f'Wrote plan with {len(self.planned_slices)} partitions to {out_plan_file}')
 
     def write_mosaic_file(self, mosaic_data):
 
@@ -647,27 +1421,68 @@ class Partitioner(LoggerMixin):
         self.log_info(f'Wrote mosaic file to {out_mosaic_file}')
 
     def finalize(self):
-        if self.part_count <= 1:
-            return
-
-        self.log_info(f'Finalizing {self.part_count} partitions')
-        header = get_header(self.all_tiles, self.header_base, use_lower_zoom_for_bounds=False)
-        header = convert_header(header, HEADER_EXPORT_KEYS)
-        mosaic_data = {
-            'version': 1,
-            'metadata': self.src_metadata,
-            'header': header,
-            'slices': {}
-        }
+        with self.metrics.phase('finalize'):
+            # an incremental run always has a mosaic to update
+            if self.previous_mosaic is None and self.part_count <= 1:
+                self.remove_journal()
+                return
 
-        for i, partition_name in enumerate(self.partition_names):
-            header = self.headers[i]
-            header = convert_header(header, SLICE_HEADER_EXPORT_KEYS)
-            mosaic_data['slices'][partition_name] = {
+            if self.previous_mosaic is not None:
+                self.log_info(f'Finalizing {len(self.partition_names) + len(self.kept_slices)} partitions, '
+                              f'{len(self.kept_slices)} kept as they were and {len(self.partition_names)} written')
+            else:
+                self.log_info(f'Finalizing {len(self.partition_names)} partitions')
+            extents = get_zoom_extents_from_index(self.tile_index, self.chunk_size)
+            merge_zoom_extents(extents, self.source_extents)
+            tiles_info = get_info_from_extents(extents)
+            header = get_header(self.header_base, tiles_info, use_lower_zoom_for_bounds=False)
+            header = convert_header(header, HEADER_EXPORT_KEYS)
+            mosaic_data = {
+                'version': MOSAIC_VERSION,
+                'metadata': self.src_metadata,
                 'header': header,
+                'slices': {}
             }
 
-        self.write_mosaic_file(mosaic_data)
+            for i, partition_name in enumerate(self.partition_names):
+                header = self.headers[i]
+                header = convert_header(header, SLICE_HEADER_EXPORT_KEYS)
+                mosaic_data['slices'][partition_name] = {
+                    'header': header,
+                }
+                tile_id_range = self.planned_slices[i].tile_id_range
+                if tile_id_range is not None:
+                    mosaic_data['slices'][partition_name]['min_tile_id'] = tile_id_range[0]
+                    mosaic_data['slices'][partition_name]['max_tile_id'] = tile_id_range[1]
+
+            if self.previous_mosaic is not None:
+                mosaic_data['slices'].update(self.kept_slices)
+                mosaic_data['slices'] = { name: mosaic_data['slices'][name] for name in self.slice_order }
+
+            if any('min_tile_id' in entry for entry in mosaic_data['slices'].values()):
+                mosaic_data['version'] = TILE_ID_RANGE_MOSAIC_VERSION
+
+            self.write_mosaic_file(mosaic_data)
+            self.replace_rewritten_files()
+            self.remove_stale_files()
+            self.remove_journal()
+
+    def remove_journal(self):
+        # the run is complete, nothing is left to resume
+        if self.journal is not None:
+            self.journal.remove()
+
+    def replace_rewritten_files(self):
+        # only once the mosaic matches their new contents
+        for planned_slice in self.planned_slices:
+            if planned_slice.replaces is not None:
+                os.replace(planned_slice.name, planned_slice.replaces)
+
+    def remove_stale_files(self):
+        # only once the mosaic no longer points at them
+        for path in self.stale_files:
+            self.log_info(f'Removing partition {path}')
+            path.unlink(missing_ok=True)
 
 def partition_main(args):
     parser = argparse.ArgumentParser()
@@ -675,7 +1490,17 @@ def partition_main(args):
     parser.add_argument('--to-pmtiles', required=True, help='Output PMTiles file.')
     parser.add_argument('--size-limit', default='github_release', type=parse_size, help='Maximum size of each partition. Can be a number in bytes or a preset: github_release (2G), github_file (100M), cloudflare_object (512M). Can also be a number with optional units (K, M, G). Default is github_release (2G).')
     parser.add_argument('--no-cache', action='store_true', default=False, help='Cache tiles locally for speed')
+    parser.add_argument('--cache-dir', help='Directory to keep the tile cache in across runs. A later run against unchanged sources reuses it and skips reading the sources.')
     parser.add_argument('--exclude-transparent', action='store_true', default=False, help='Exclude transparent empty tiles from raster sources (PNG, WEBP).')
+    parser.add_argument('--workers', type=int, default=1, help='Number of workers. Used to compress vector tiles and to check raster tiles for transparency with --exclude-transparent while collecting tiles, and as the number of processes writing partitions in parallel. Default is 1, which does the work inline.')
+    parser.add_argument('--recompress', action='store_true', default=False, help='Compress vector tiles with the most effort zlib has, including the ones that come already gzipped, keeping the original when it is no larger. Smaller tiles can mean fewer partitions. Done on the --workers threads.')
+    parser.add_argument('--strategy', default='zxy', choices=['zxy', 'hilbert'], help='How to cut the tiles into partitions. zxy splits by zoom levels, then x and y stripes. hilbert cuts the tile id order into consecutive ranges, which are recorded in the mosaic. Default is zxy.')
+    parser.add_argument('--balance', action='store_true', default=False, help='Spread the tiles more evenly over the same, smallest possible, number of partitions instead of filling each partition up before starting the next. Takes several planning passes.')
+    parser.add_argument('--max-memory', type=parse_memory_size, help='Memory budget for the run, a number of bytes with an optional unit (K, M, G), e.g. 8G, bounding the memory not backed by files of the process and of its writer processes. What the process holds up front, the interpreter, its libraries and the open sources, comes off the budget and the rest is split between the working sets. Once the tile index outgrows its share, the index and the working arrays of the planner are spilled to temporary files and processed a chunk at a time, and so are the directory entries of the partition being planned or written. Only one entry per distinct repeated tile content of a partition is kept in memory regardless. Fewer writer processes than --workers are used if the budget has no room for all of them. Unbounded by default.')
+    parser.add_argument('--incremental', action='store_true', default=False, help='Update the mosaic left at <prefix>.mosaic.json by an earlier run instead of starting over. Partitions whose tiles are unchanged are kept as they are, changed ones are rewritten and ones that outgrew the size limit are split. Falls back to a full run when tiles fall outside the earlier partitions.')
+    parser.add_argument('--resume', action='store_true', default=False, help='Keep a journal of the written partitions in <prefix>.journal.jsonl, and pick up from it if an earlier run with the same sources and settings got interrupted, skipping the partitions it already wrote. Unless --cache-dir or --no-cache is given, the tile cache is kept in <prefix>.cache until the run completes, so the sources are not read again either.')
+    parser.add_argument('--plan-only', action='store_true', default=False, help='Only plan the partitions and write the plan to <prefix>.plan.json, without writing any PMTiles files.')
+    parser.add_argument('--metrics-file', help='Write the timings of each phase, tile and byte rates, and counters like cache hits to this JSON file at the end of the run.')
     parser.add_argument('--log-level', '-l', type=str, default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], help='Set the logging level.')
     args = parser.parse_args(args)
 
@@ -685,15 +1510,46 @@ def partition_main(args):
         parser.error("Output PMTiles file must end with '.pmtiles'")
     to_pmtiles_prefix = args.to_pmtiles.removesuffix('.pmtiles')
 
+    if args.cache_dir is not None and args.no_cache:
+        parser.error("--cache-dir can't be used with --no-cache")
+
+    # a resumed run also needs the tiles collected by the interrupted one
+    cache_dir = args.cache_dir
+    own_cache_dir = args.resume and cache_dir is None and not args.no_cache
+    if own_cache_dir:
+        cache_dir = f'{to_pmtiles_prefix}.cache'
+
     reader = create_source_from_paths(args.from_source, logger=logger)
 
+    if args.max_memory is not None:
+        held_memory = get_anon_memory()
+        min_max_memory = get_min_max_memory(held_memory)
+        if args.max_memory < min_max_memory:
+            parser.error(f'--max-memory must be at least {min_max_memory} bytes, the process already holds {held_memory} bytes')
+
     logger.info(f'Size limit: {args.size_limit} bytes')
 
-    partitioner = Partitioner(reader, to_pmtiles_prefix, args.size_limit, not args.no_cache, logger=logger, exclude_transparent=args.exclude_transparent)
+    metrics = Metrics('partition')
+    partitioner = Partitioner(reader, to_pmtiles_prefix, args.size_limit, not args.no_cache, logger=logger, exclude_transparent=args.exclude_transparent, workers=args.workers, source_paths=args.from_source, cache_dir=cache_dir, max_memory=args.max_memory, strategy=args.strategy, balance=args.balance, incremental=args.incremental, resume=args.resume, recompress=args.recompress, metrics=metrics)
 
-    partitioner.partition()
+    try:
+        partitioner.plan()
 
-    partitioner.finalize()
+        if args.plan_only:
+            partitioner.write_plan_file()
+        else:
+            partitioner.write_partitions()
+            partitioner.finalize()
+
+        partitioner.cleanup()
+        if own_cache_dir:
+            logger.info(f'Removing the tile cache in {cache_dir}')
+            shutil.rmtree(cache_dir)
+        metrics.completed = True
+    finally:
+        # written for failed runs too, with completed set to false
+        if args.metrics_file is not None:
+            metrics.write(args.metrics_file)
 
 def cli():
     partition_main(sys.argv[1:])
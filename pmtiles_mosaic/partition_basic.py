@@ -3,22 +3,33 @@
 # dependencies = [
 #     "mercantile",
 #     "pmtiles",
+#     "numpy",
 # ]
 # ///
 
 import json
-import gzip
 import copy
 import argparse
 import re
 import sys
 from pathlib import Path
 
-import mercantile
+import numpy as np
 from pmtiles.tile import zxy_to_tileid, TileType, Compression
 from pmtiles.writer import Writer as PMTilesWriter
 
 from .tile_sources import create_source_from_paths
+from .compression import TileCompressor
+from .slice_writer import SliceTask, SliceWriterPool
+from .metrics import Metrics
+from .progress import Progress
+from .tile_index import (
+    TileIndexBuilder,
+    group_rows,
+    get_ancestor_coords,
+    get_zoom_extents_from_arrays,
+    get_extent_bounds,
+)
 from .logger import LoggerMixin, get_logger
 
 BASE_SIZE_FOR_DELTA = 2 * 1024 * 1024 * 1024 # 2GB
@@ -109,9 +120,21 @@ def get_pmtiles_file_name(to_pmtiles_prefix, suffix):
     return out_pmtiles_file
 
 class Partitioner(LoggerMixin):
-    def __init__(self, reader, to_pmtiles_prefix, size_limit_bytes, logger=None):
+    def __init__(self, reader, to_pmtiles_prefix, size_limit_bytes, logger=None, workers=1, source_paths=None, balance=False, dedup=False, recompress=False, metrics=None):
         self.reader = reader
         self.logger = logger
+        self.metrics = metrics if metrics is not None else Metrics('partition-basic')
+        self.workers = workers
+        self.source_paths = source_paths
+        self.balance = balance
+        self.dedup = dedup
+        self.recompress = recompress
+
+        # an index of all tiles with their sizes, and with dedup, the hash of their
+        # content and the distinct (hash, size) blobs of each x stripe
+        self.tile_index = None
+        self.stripe_blobs = None
+        self.source_bytes_read = 0
 
         self.max_zoom_level = reader.max_zoom
         self.min_zoom_level = reader.min_zoom
@@ -119,25 +142,49 @@ class Partitioner(LoggerMixin):
         self.to_pmtiles_prefix = to_pmtiles_prefix
         self.size_limit_bytes = size_limit_bytes
 
-        self.tiles_to_slice_idx = {}
+        # the slice each row of the tile index is planned into, -1 for none yet,
+        # a column next to the index instead of a dict keyed by every tile
+        self.slice_idx = None
 
         self.slices = []
         self.expected_slice_sizes = []
 
-    def get_layer_tiles_and_sizes(self, zoom_level):
-        tiles = []
-        size = 0
-
-        for tile, tsize in self.reader.all_z_sizes(zoom_level):
-            tiles.append(tile)
-            size += tsize
-
-        return tiles, size
-
-    def add_to_current_slice(self, tiles, expected_bucket_size, partition_name=None):
+    def collect_tile_index(self):
+        # a single pass over the source, which both the top slice and the x stripes are planned from.
+        # With dedup it goes over the tile data, the pmtiles writer stores each distinct
+        # blob once per file, and tells them apart by hash()
+        builder = TileIndexBuilder()
+        if self.dedup:
+            self.log_info('Collecting tile sizes and content hashes')
+            progress = Progress('Hashing tiles', total=self.reader.get_tile_count(), logger=self.logger)
+            for tile, tdata in self.reader.all():
+                builder.append(tile, len(tdata), 0, hash(tdata))
+                self.source_bytes_read += len(tdata)
+                progress.update(1, len(tdata))
+        else:
+            self.log_info('Collecting tile sizes')
+            progress = Progress('Collecting tile sizes', total=self.reader.get_tile_count(), logger=self.logger)
+            for tile, tsize in self.reader.all_sizes():
+                builder.append(tile, tsize)
+                progress.update()
+        progress.done()
+        self.tile_index = builder.build()
+        self.slice_idx = np.full(len(self.tile_index), -1, dtype=np.int32)
+
+    def get_distinct_blobs(self, rows):
+        # (hash, size) of each distinct blob among the rows
+        index = self.tile_index
+        hashes, first_idx = np.unique(index.content_hash[rows], return_index=True)
+        return list(zip(hashes.tolist(), index.size[rows][first_idx].tolist()))
+
+    def get_rows_by_z(self):
+        index = self.tile_index
+        z_levels, sorted_rows, z_boundaries = group_rows(index.all_rows(), index.z)
+        return { z: sorted_rows[z_boundaries[i]:z_boundaries[i + 1]] for i, z in enumerate(z_levels) }
+
+    def add_to_current_slice(self, rows, expected_bucket_size, partition_name=None):
         curr_idx = len(self.slices)
-        for t in tiles:
-            self.tiles_to_slice_idx[t] = curr_idx
+        self.slice_idx[rows] = curr_idx
 
         if partition_name is None:
             partition_name = f'part{curr_idx:04d}'
@@ -151,19 +198,30 @@ class Partitioner(LoggerMixin):
 
         size_till_now = 0
 
-        tiles = []
+        index = self.tile_index
+        rows_by_z = self.get_rows_by_z()
+        seen_hashes = set()
+
+        rows = []
         expected_bucket_size = 0
         curr_level = self.min_zoom_level
         while curr_level <= self.max_zoom_level:
 
-            curr_level_tiles, curr_level_size = self.get_layer_tiles_and_sizes(curr_level)
+            curr_level_rows = rows_by_z.get(curr_level, np.zeros(0, dtype=np.int64))
+            if self.dedup:
+                # blobs already in the lower levels don't take up any more space
+                curr_level_blobs = self.get_distinct_blobs(curr_level_rows)
+                curr_level_size = sum(size for hsh, size in curr_level_blobs if hsh not in seen_hashes)
+                seen_hashes.update(hsh for hsh, _ in curr_level_blobs)
+            else:
+                curr_level_size = int(index.size[curr_level_rows].sum(dtype=np.uint64))
 
             size_till_now += curr_level_size
 
             if size_till_now > self.size_limit_bytes:
                 break
 
-            tiles.extend(curr_level_tiles)
+            rows.append(curr_level_rows)
             expected_bucket_size += curr_level_size
             curr_level += 1
 
@@ -172,86 +230,160 @@ class Partitioner(LoggerMixin):
             if curr_level == self.max_zoom_level + 1:
                 partition_name = ''
 
-            self.add_to_current_slice(tiles, expected_bucket_size,
+            self.add_to_current_slice(np.concatenate(rows), expected_bucket_size,
                                       partition_name=partition_name)
 
         return curr_level - 1
 
     def get_x_stripes(self, min_stripe_level):
-        tiles_by_x = {}
+        rows_by_x = {}
         sizes_by_x = {}
-    
-        for t, tsize in self.reader.all_sizes():
-            if t.z < min_stripe_level:
-                continue
-    
-            if t.z == min_stripe_level:
-                pt = t
+
+        index = self.tile_index
+        rows = np.flatnonzero(index.z >= min_stripe_level)
+
+        x_keys = get_ancestor_coords(index.z[rows], index.x[rows], min_stripe_level)
+        x_levels, sorted_rows, x_boundaries = group_rows(rows, x_keys)
+        if len(x_levels) == 0:
+            return sizes_by_x, rows_by_x
+
+        if self.dedup:
+            self.stripe_blobs = {}
+            for i, x in enumerate(x_levels):
+                x_rows = sorted_rows[x_boundaries[i]:x_boundaries[i + 1]]
+                self.stripe_blobs[x] = self.get_distinct_blobs(x_rows)
+                sizes_by_x[x] = sum(size for _, size in self.stripe_blobs[x])
+                rows_by_x[x] = x_rows
+            return sizes_by_x, rows_by_x
+
+        x_sizes = np.add.reduceat(index.size[sorted_rows].astype(np.uint64), x_boundaries[:-1]).tolist()
+        for i, x in enumerate(x_levels):
+            sizes_by_x[x] = x_sizes[i]
+            rows_by_x[x] = sorted_rows[x_boundaries[i]:x_boundaries[i + 1]]
+
+        return sizes_by_x, rows_by_x
+
+    def get_added_size(self, x, x_size, bucket_hashes):
+        # the size a stripe adds to a bucket, which with dedup leaves out the blobs already in it
+        if self.stripe_blobs is None:
+            return x_size
+        return sum(size for hsh, size in self.stripe_blobs[x] if hsh not in bucket_hashes)
+
+    def add_bucket_hashes(self, x, bucket_hashes):
+        if self.stripe_blobs is not None:
+            bucket_hashes.update(hsh for hsh, _ in self.stripe_blobs[x])
+
+
+    def get_balanced_size_limit(self, sizes_by_x):
+        # the smallest bucket size limit that needs no more buckets than the actual size limit,
+        # so the same number of buckets is filled evenly instead of leaving a near empty last one
+        x_coords = sorted(sizes_by_x.keys())
+        x_sizes = [ sizes_by_x[x] for x in x_coords ]
+
+        def count_buckets(size_limit):
+            count = 0
+            current_bucket_size = None
+            bucket_hashes = set()
+            for x, x_size in zip(x_coords, x_sizes):
+                added_size = self.get_added_size(x, x_size, bucket_hashes)
+                if current_bucket_size is None or current_bucket_size + added_size > size_limit:
+                    count += 1
+                    current_bucket_size = 0
+                    bucket_hashes = set()
+                    added_size = x_size
+                current_bucket_size += added_size
+                self.add_bucket_hashes(x, bucket_hashes)
+            return count
+
+        num_buckets = count_buckets(self.size_limit_bytes)
+        # with dedup, blobs shared across stripes make buckets smaller than the sum of
+        # their stripes, so only the largest stripe is a lower bound
+        lo = max(x_sizes)
+        if self.stripe_blobs is None:
+            lo = max(lo, sum(x_sizes) // num_buckets)
+        hi = self.size_limit_bytes
+        if lo >= hi:
+            return hi
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if count_buckets(mid) <= num_buckets:
+                hi = mid
             else:
-                pt = mercantile.parent(t, zoom=min_stripe_level)
-    
-            if pt.x not in tiles_by_x:
-                tiles_by_x[pt.x] = []
-            tiles_by_x[pt.x].append(t)
-    
-            if pt.x not in sizes_by_x:
-                sizes_by_x[pt.x] = 0
-            sizes_by_x[pt.x] += tsize
-    
-        return sizes_by_x, tiles_by_x
+                lo = mid + 1
+        return lo
 
+    def get_buckets(self, sizes_by_x, rows_by_x, size_limit=None):
+        if size_limit is None:
+            size_limit = self.size_limit_bytes
 
-    def get_buckets(self, sizes_by_x, tiles_by_x):
         buckets = []
-        all_bucket_tiles = []
+        all_bucket_rows = []
         expected_bucket_sizes = []
     
         x_coords = sorted(sizes_by_x.keys())
         if not x_coords:
-            return [], []
+            return [], [], []
     
-        current_bucket_tiles = []
+        current_bucket_rows = []
         current_bucket_size = 0
         current_bucket_range = None
+        bucket_hashes = set()
     
         for x in x_coords:
-            x_size = sizes_by_x[x]
-            x_tiles = tiles_by_x[x]
+            x_size = self.get_added_size(x, sizes_by_x[x], bucket_hashes)
+            x_rows = rows_by_x[x]
     
             # if the current bucket has tiles and adding the next stripe would exceed the size limit,
             # then finalize the current bucket and start a new one.
-            if current_bucket_range is not None and (current_bucket_size + x_size > self.size_limit_bytes):
-                if current_bucket_size > self.size_limit_bytes:
-                    raise Exception(f'Current bucket size {current_bucket_size} exceeds size limit {self.size_limit_bytes}, the striping algorithm failed')
+            if current_bucket_range is not None and (current_bucket_size + x_size > size_limit):
+                if current_bucket_size > size_limit:
+                    raise Exception(f'Current bucket size {current_bucket_size} exceeds size limit {size_limit}, the striping algorithm failed')
                 buckets.append(current_bucket_range)
-                all_bucket_tiles.append(current_bucket_tiles)
+                all_bucket_rows.append(np.concatenate(current_bucket_rows))
                 expected_bucket_sizes.append(current_bucket_size)
     
-                current_bucket_tiles = []
+                current_bucket_rows = []
                 current_bucket_size = 0
                 current_bucket_range = None
+                bucket_hashes = set()
+                x_size = sizes_by_x[x]
     
             if current_bucket_range is None:  # Starting a new bucket
                 current_bucket_range = (x, x)
     
-            current_bucket_tiles.extend(x_tiles)
+            current_bucket_rows.append(x_rows)
             current_bucket_size += x_size
             current_bucket_range = (current_bucket_range[0], x)
+            self.add_bucket_hashes(x, bucket_hashes)
     
         # Add the last bucket if it has any tiles.
-        if current_bucket_tiles:
-            if current_bucket_size > self.size_limit_bytes:
-                raise Exception(f'Current bucket size {current_bucket_size} exceeds size limit {self.size_limit_bytes}, the striping algorithm failed')
+        if current_bucket_rows:
+            if current_bucket_size > size_limit:
+                raise Exception(f'Current bucket size {current_bucket_size} exceeds size limit {size_limit}, the striping algorithm failed')
             buckets.append(current_bucket_range)
-            all_bucket_tiles.append(current_bucket_tiles)
+            all_bucket_rows.append(np.concatenate(current_bucket_rows))
             expected_bucket_sizes.append(current_bucket_size)
     
     
-        return buckets, all_bucket_tiles, expected_bucket_sizes
+        return buckets, all_bucket_rows, expected_bucket_sizes
 
 
     def partition(self):
 
+        with self.metrics.phase('collect') as phase:
+            self.collect_tile_index()
+            phase.add('tiles', len(self.tile_index))
+            if self.dedup:
+                phase.add('bytes_read', self.source_bytes_read)
+
+        with self.metrics.phase('plan') as phase:
+            self.plan_slices()
+            phase.add('tiles', int(np.count_nonzero(self.slice_idx >= 0)))
+
+        self.metrics.set('partitions', len(self.slices))
+
+    def plan_slices(self):
         top_slice_max_level = self.create_top_slice()
 
         self.log_info(f'Top slice max zoom level: {top_slice_max_level}')
@@ -263,59 +395,34 @@ class Partitioner(LoggerMixin):
         from_level = top_slice_max_level + 1
 
         self.log_info(f'Getting x stripes from zoom level {from_level}')
-        x_stripe_sizes, x_stripe_tiles = self.get_x_stripes(from_level)
+        x_stripe_sizes, x_stripe_rows = self.get_x_stripes(from_level)
+        size_limit = self.size_limit_bytes
+        if self.balance and x_stripe_sizes:
+            size_limit = self.get_balanced_size_limit(x_stripe_sizes)
+            self.log_info(f'Balanced size limit: {size_limit} bytes')
         self.log_info('Getting buckets')
-        buckets, bucket_tiles, expected_bucket_sizes = self.get_buckets(x_stripe_sizes, x_stripe_tiles)
+        buckets, bucket_rows, expected_bucket_sizes = self.get_buckets(x_stripe_sizes, x_stripe_rows, size_limit)
     
         for i,bucket in enumerate(buckets):
-            self.add_to_current_slice(bucket_tiles[i], expected_bucket_sizes[i])
-
-    def get_bounds(self, tiles):
-    
-        bounds = [ mercantile.bounds(t) for t in tiles ]
-    
-        max_x = bounds[0].east
-        min_x = bounds[0].west
-        max_y = bounds[0].north
-        min_y = bounds[0].south
-        for b in bounds:
-            if b.east > max_x:
-                max_x = b.east
-    
-            if b.west < min_x:
-                min_x = b.west
-    
-            if b.north > max_y:
-                max_y = b.north
-    
-            if b.south < min_y:
-                min_y = b.south
-    
-        return (min_y, min_x, max_y, max_x)
-
+            self.add_to_current_slice(bucket_rows[i], expected_bucket_sizes[i])
 
-    def get_info(self, tiles):
-        tiles_by_z = {}
+    def get_info(self, rows):
+        index = self.tile_index
+        extents = get_zoom_extents_from_arrays(index.z[rows], index.x[rows], index.y[rows])
 
-        for t in tiles:
-            if t.z not in tiles_by_z:
-                tiles_by_z[t.z] = []
+        min_z = min(extents.keys())
+        max_z = max(extents.keys())
 
-            tiles_by_z[t.z].append(t)
-
-        min_z = min(tiles_by_z.keys())
-        max_z = max(tiles_by_z.keys())
-
-        higher_bounds = self.get_bounds(tiles_by_z[max_z])
-        lower_bounds = self.get_bounds(tiles_by_z[min_z])
+        higher_bounds = get_extent_bounds(max_z, extents[max_z])
+        lower_bounds = get_extent_bounds(min_z, extents[min_z])
 
         return min_z, max_z, lower_bounds, higher_bounds
  
 
-    def get_header(self, tiles, use_lower_zoom_for_bounds=False, tiles_info=None):
+    def get_header(self, rows, use_lower_zoom_for_bounds=False, tiles_info=None):
 
         if tiles_info is None:
-            tiles_info = self.get_info(tiles)
+            tiles_info = self.get_info(rows)
 
         min_zoom, max_zoom, lower_bounds, higher_bounds = tiles_info
 
@@ -365,11 +472,11 @@ class Partitioner(LoggerMixin):
 
         return header
          
-    def get_header_and_metadata(self, tiles):
-        tiles_info = self.get_info(tiles)
+    def get_header_and_metadata(self, rows):
+        tiles_info = self.get_info(rows)
 
-        header = self.get_header(tiles, use_lower_zoom_for_bounds=False, tiles_info=tiles_info)
-        header_for_mosaic = self.get_header(tiles, use_lower_zoom_for_bounds=True, tiles_info=tiles_info)
+        header = self.get_header(rows, use_lower_zoom_for_bounds=False, tiles_info=tiles_info)
+        header_for_mosaic = self.get_header(rows, use_lower_zoom_for_bounds=True, tiles_info=tiles_info)
 
         src_metadata = self.reader.get_metadata()
 
@@ -398,57 +505,128 @@ class Partitioner(LoggerMixin):
 
     def write_partitions(self):
 
-        # go through all tiles and create a list of all tiles and a mapping from tile to slice index
+        # group the planned rows of the tile index by slice
         # could have calculate bounds here, but easier/more readable to do it later
-        all_tiles = []
-        tiles_by_idx = {}
-
-        for t, idx in self.tiles_to_slice_idx.items():
-            if idx not in tiles_by_idx:
-                tiles_by_idx[idx] = []
-
-            tiles_by_idx[idx].append(t)
-
-            all_tiles.append(t)
+        index = self.tile_index
+        all_rows = np.flatnonzero(self.slice_idx >= 0)
+        slice_ids, sorted_rows, boundaries = group_rows(all_rows, self.slice_idx[all_rows])
+        rows_by_idx = { idx: sorted_rows[boundaries[i]:boundaries[i + 1]] for i, idx in enumerate(slice_ids) }
 
         headers = []
         headers_for_mosaic = []
         metadatas = []
-        writers = []
         out_pmtiles_files = []
         for i,slice in enumerate(self.slices):
-            tiles = tiles_by_idx[i]
-
-            header, header_for_mosaic, metadata = self.get_header_and_metadata(tiles)
+            header, header_for_mosaic, metadata = self.get_header_and_metadata(rows_by_idx[i])
             headers.append(header)
             headers_for_mosaic.append(header_for_mosaic)
             metadatas.append(metadata)
 
             out_pmtiles_file = get_pmtiles_file_name(self.to_pmtiles_prefix, slice)
             out_pmtiles_files.append(out_pmtiles_file)
-            Path(out_pmtiles_file).parent.mkdir(exist_ok=True, parents=True)
-
-            writer = PMTilesWriter(open(out_pmtiles_file, 'wb'))
-            writers.append(writer)
 
-        full_header = self.get_header(all_tiles, use_lower_zoom_for_bounds=False)
+        full_header = self.get_header(all_rows, use_lower_zoom_for_bounds=False)
         full_metadata = self.reader.get_metadata()
+        should_be_compressed = (full_header['tile_compression'] == Compression.GZIP)
+
+        with self.metrics.phase('write') as phase:
+            if self.can_write_in_parallel():
+                tasks = []
+                for i, out_pmtiles_file in enumerate(out_pmtiles_files):
+                    # each worker fetches its own tiles, so they might as well be written clustered
+                    rows = rows_by_idx[i]
+                    rows = rows[np.argsort(index.tile_id[rows], kind='stable')]
+                    tasks.append(SliceTask(out_pmtiles_file, headers[i], metadatas[i],
+                                           index.tile_id[rows].tolist(),
+                                           tiles=list(zip(index.z[rows].tolist(), index.x[rows].tolist(), index.y[rows].tolist())),
+                                           should_be_compressed=should_be_compressed))
+
+                pool = SliceWriterPool(self.workers, source_paths=self.source_paths, recompress=self.recompress, logger=self.logger)
+                progress = Progress('Writing partitions', total=len(all_rows), logger=self.logger)
+                for task, size in zip(tasks, pool.write_all(tasks)):
+                    progress.update(len(task.tile_ids), size)
+                progress.done()
+            else:
+                self.write_partitions_from_scan(out_pmtiles_files, headers, metadatas, should_be_compressed)
+
+            for i, slice in enumerate(self.slices):
+                out_pmtiles_file = out_pmtiles_files[i]
+                file_size = Path(out_pmtiles_file).stat().st_size
+                delta = file_size - self.expected_slice_sizes[i]
+                self.log_info(f'Partition {slice} written to {out_pmtiles_file} with size {file_size} bytes, expected size was {self.expected_slice_sizes[i]} bytes, delta: {delta} bytes')
+                phase.add('bytes_written', file_size)
+            phase.add('tiles', len(all_rows))
+
+        with self.metrics.phase('finalize'):
+            mosaic_data = {
+                'version': 1,
+                'metadata': full_metadata,
+                'header': convert_header(full_header, HEADER_EXPORT_KEYS),
+                'slices': {}
+            }
 
-        done = set()
-        for tile, tdata in self.reader.all():
-            if tile in done:
-                continue
+            for i,slice in enumerate(self.slices):
+                out_pmtiles_file = out_pmtiles_files[i]
+                key = Path(out_pmtiles_file).name
+                header = headers_for_mosaic[i]
+                mosaic_data['slices'][key] = {
+                    'header': convert_header(header, SLICE_HEADER_EXPORT_KEYS)
+                }
+
+            self.write_mosaic_file(mosaic_data)
+
+    def can_write_in_parallel(self):
+        if self.workers <= 1 or len(self.slices) <= 1 or self.source_paths is None:
+            return False
+
+        # the workers fetch their tiles one at a time, which is far slower than
+        # a single scan on sources that can't look tiles up cheaply
+        if not self.reader.has_cheap_random_reads():
+            self.log_info('Source is slow to read at random, writing all partitions from a single scan instead')
+            return False
+        return True
+
+    def write_partitions_from_scan(self, out_pmtiles_files, headers, metadatas, should_be_compressed):
+        # all writers are fed from a single pass over the source
+        writers = []
+        for out_pmtiles_file in out_pmtiles_files:
+            Path(out_pmtiles_file).parent.mkdir(exist_ok=True, parents=True)
+            writer = PMTilesWriter(open(out_pmtiles_file, 'wb'))
+            writers.append(writer)
 
-            idx = self.tiles_to_slice_idx[tile]
+        # the scanned tiles are looked up in the index by tile id
+        index = self.tile_index
+        order = np.argsort(index.tile_id, kind='stable')
+        sorted_tile_ids = index.tile_id[order]
+        done = np.zeros(len(index), dtype=bool)
+        def pending_tiles():
+            for tile, tdata in self.reader.all():
+                tile_id = zxy_to_tileid(tile.z, tile.x, tile.y)
+                pos = np.searchsorted(sorted_tile_ids, np.uint64(tile_id))
+                if pos == len(sorted_tile_ids) or sorted_tile_ids[pos] != tile_id:
+                    raise Exception(f'Tile {tile} was not in the source when the partitions were planned, did the source change?')
+                row = order[pos]
+                if done[row]:
+                    continue
+                done[row] = True
+                yield (tile_id, int(self.slice_idx[row])), tdata
+
+        tiles_and_data = pending_tiles()
+
+        # compression runs ahead of the writers on the worker threads
+        compressor = TileCompressor(workers=self.workers, recompress=self.recompress)
+        if should_be_compressed:
+            tiles_and_data = compressor.compress_all(tiles_and_data)
+
+        progress = Progress('Writing partitions', total=len(index), logger=self.logger)
+        for (tile_id, idx), tdata in tiles_and_data:
             writer = writers[idx]
-            header = headers[idx]
-            should_be_compressed = (header['tile_compression'] == Compression.GZIP)
-            if should_be_compressed and tdata[0:2] != b"\x1f\x8b":
-                tdata = gzip.compress(tdata)
-            
-            tile_id = zxy_to_tileid(tile.z, tile.x, tile.y)
             writer.write_tile(tile_id, tdata)
-            done.add(tile)
+            progress.update(1, len(tdata))
+        progress.done()
+
+        self.metrics.set_hit_rate('compression_memo', compressor.memo_hits, compressor.memo_misses)
+        compressor.close()
 
         for i, slice in enumerate(self.slices):
             out_pmtiles_file = out_pmtiles_files[i]
@@ -457,28 +635,9 @@ class Partitioner(LoggerMixin):
             header = headers[i]
             metadata = metadatas[i]
             writer.finalize(header, metadata)
-            file_size = Path(out_pmtiles_file).stat().st_size
-            delta = file_size - self.expected_slice_sizes[i]
-            self.log_info(f'Partition {slice} written to {out_pmtiles_file} with size {file_size} bytes, expected size was {self.expected_slice_sizes[i]} bytes, delta: {delta} bytes')
-
-        mosaic_data = {
-            'version': 1,
-            'metadata': full_metadata,
-            'header': convert_header(full_header, HEADER_EXPORT_KEYS),
-            'slices': {}
-        }
-
-        for i,slice in enumerate(self.slices):
-            out_pmtiles_file = out_pmtiles_files[i]
-            key = Path(out_pmtiles_file).name
-            header = headers_for_mosaic[i]
-            mosaic_data['slices'][key] = {
-                'header': convert_header(header, SLICE_HEADER_EXPORT_KEYS)
-            }
-
-        self.write_mosaic_file(mosaic_data)
+            writer.f.close()
 
-# TODO: this code doesn't account for tile redundency and compression that may happen when writing to pmtiles 
+# TODO: this code doesn't account for compression that may happen when writing to pmtiles, nor for tile redundency without --dedup
 # TODO: maybe keep track of delta size based on the number of tiles being added into each partition instead fixing it ahead of time.
 # TODO: handle cases where vertical striping fails because some single x stripe is too large
 #       may be slice that x strip by y, if that also doesn't fix it and we have a single x,y area whcih is too big, drill down by z
@@ -488,6 +647,11 @@ def partition_main(args):
     parser.add_argument('--to-pmtiles', required=True, help='Output PMTiles file.')
     parser.add_argument('--size-limit', default='github_release', type=parse_size, help='Maximum size of each partition. Can be a number in bytes or a preset: github_release (2G), github_file (100M), cloudflare_object (512M). Can also be a number with optional units (K, M, G). Default is github_release (2G).')
     parser.add_argument('--delta-estimate', required=False, type=int, help='Estimated delta above tile data. This is used to calculate the final size of each partition. if not provided it will be calculated based on the size limit.. approximately 5MB for 2GB size limit.')
+    parser.add_argument('--workers', type=int, default=1, help='Number of threads used to compress vector tiles ahead of the writers. With more than one, and a source that can be read at random cheaply (indexed MBTiles files or tile directories), partitions are instead written in parallel by as many processes, each reading its tiles from the source on its own. Default is 1, which compresses inline.')
+    parser.add_argument('--dedup', action='store_true', default=False, help='Size partitions the way the pmtiles writer stores them, with each distinct tile content counted once per partition. Reads all the tile data once up front instead of just the tile sizes.')
+    parser.add_argument('--recompress', action='store_true', default=False, help='Compress vector tiles with the most effort zlib has, including the ones that come already gzipped, keeping the original when it is no larger. Partitions are still sized from the source tile sizes.')
+    parser.add_argument('--balance', action='store_true', default=False, help='Spread the x stripes evenly over the same, smallest possible, number of partitions instead of filling each partition up before starting the next.')
+    parser.add_argument('--metrics-file', help='Write the timings of each phase, tile and byte rates, and counters to this JSON file at the end of the run.')
     parser.add_argument('--log-level', '-l', type=str, default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], help='Set the logging level.')
     args = parser.parse_args(args)
 
@@ -503,11 +667,18 @@ def partition_main(args):
     adjusted_size_limit = adjust_size_limit(size_limit_bytes, logger, args.delta_estimate)
     logger.info(f'Partitioning with size limit: {adjusted_size_limit} bytes')
 
-    partitioner = Partitioner(reader, to_pmtiles_prefix, args.size_limit, logger=logger)
+    metrics = Metrics('partition-basic')
+    partitioner = Partitioner(reader, to_pmtiles_prefix, args.size_limit, logger=logger, workers=args.workers, source_paths=args.from_source, balance=args.balance, dedup=args.dedup, recompress=args.recompress, metrics=metrics)
 
-    partitioner.partition()
+    try:
+        partitioner.partition()
 
-    partitioner.write_partitions()
+        partitioner.write_partitions()
+        metrics.completed = True
+    finally:
+        # written for failed runs too, with completed set to false
+        if args.metrics_file is not None:
+            metrics.write(args.metrics_file)
 
 def cli():
     partition_main(sys.argv[1:])
@@ -69,6 +69,15 @@ class PMTilesSource(LoggerMixin):
             tile = mercantile.Tile(x=t[1], y=t[2], z=t[0])
             yield (tile, size)
 
+    def get_tile_count(self):
+        # not all writers fill it in
+        count = self.reader.header()['addressed_tiles_count']
+        return count if count > 0 else None
+
+    def has_cheap_random_reads(self):
+        # every lookup walks the directories down from the root and reads them again
+        return False
+
     def cleanup(self):
         self.file.close()
 
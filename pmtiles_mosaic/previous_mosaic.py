@@ -0,0 +1,116 @@
+import re
+import json
+
+from pathlib import Path
+
+import numpy as np
+from pmtiles.reader import MmapSource, Reader as PMTilesReader
+from pmtiles.tile import deserialize_header, deserialize_directory
+
+from .logger import LoggerMixin
+
+
+def get_tile_centers_e7(z, x, y):
+    # longitudes and latitudes of the tile centers, in the e7 units of the mosaic headers
+    n = np.exp2(z.astype(np.float64))
+    lon = (x.astype(np.float64) + 0.5) / n * 360.0 - 180.0
+    lat = np.degrees(np.arctan(np.sinh(np.pi * (1.0 - 2.0 * (y.astype(np.float64) + 0.5) / n))))
+    return lon * 10000000, lat * 10000000
+
+
+def traverse_entries(get_bytes, header, dir_offset, dir_length):
+    for entry in deserialize_directory(get_bytes(dir_offset, dir_length)):
+        if entry.run_length > 0:
+            yield entry
+        else:
+            yield from traverse_entries(get_bytes, header,
+                                        header['leaf_directory_offset'] + entry.offset, entry.length)
+
+
+# A slice of the mosaic written by an earlier run, as recorded in the mosaic file
+class PreviousSlice:
+    def __init__(self, name, path, entry):
+        self.name = name
+        self.path = path
+        self.entry = entry
+        self.header = entry['header']
+        self.tile_id_range = None
+        if 'min_tile_id' in entry:
+            self.tile_id_range = (entry['min_tile_id'], entry['max_tile_id'])
+
+    def contains(self, z, x, y, tile_id):
+        # the lookup a client does to find the slice of a tile
+        if self.tile_id_range is not None:
+            return (tile_id >= self.tile_id_range[0]) & (tile_id <= self.tile_id_range[1])
+
+        h = self.header
+        lon, lat = get_tile_centers_e7(z, x, y)
+        return ((z >= h['min_zoom']) & (z <= h['max_zoom']) &
+                (lon >= h['min_lon_e7']) & (lon <= h['max_lon_e7']) &
+                (lat >= h['min_lat_e7']) & (lat <= h['max_lat_e7']))
+
+    def read_contents(self):
+        # the tile ids of the slice in ascending order with the hash() of their data,
+        # along with the header and metadata of the file.
+        # Runs and deduplicated tiles share their data, which is only read and hashed once
+        with open(self.path, 'rb') as f:
+            reader = PMTilesReader(MmapSource(f))
+            get_bytes = reader.get_bytes
+            header = deserialize_header(get_bytes(0, 127))
+            metadata = reader.metadata()
+
+            tile_ids = []
+            hashes = []
+            hash_by_offset = {}
+            for entry in traverse_entries(get_bytes, header, header['root_offset'], header['root_length']):
+                hsh = hash_by_offset.get(entry.offset)
+                if hsh is None:
+                    hsh = hash(get_bytes(header['tile_data_offset'] + entry.offset, entry.length))
+                    hash_by_offset[entry.offset] = hsh
+                tile_ids.extend(range(entry.tile_id, entry.tile_id + entry.run_length))
+                hashes.extend([hsh] * entry.run_length)
+
+        return np.array(tile_ids, dtype=np.uint64), np.array(hashes, dtype=np.int64), header, metadata
+
+
+# The mosaic left behind by an earlier run with the same output prefix, which an
+# incremental run diffs the new tiles against
+class PreviousMosaic(LoggerMixin):
+    def __init__(self, mosaic_file, mosaic_data, logger=None):
+        self.mosaic_file = mosaic_file
+        self.mosaic_data = mosaic_data
+        self.logger = logger
+
+        base_dir = Path(mosaic_file).parent
+        self.slices = [ PreviousSlice(name, base_dir / name, entry)
+                        for name, entry in mosaic_data['slices'].items() ]
+
+    @classmethod
+    def load(cls, to_pmtiles_prefix, logger=None):
+        mosaic_file = Path(f'{to_pmtiles_prefix}.mosaic.json')
+        if not mosaic_file.exists():
+            return None
+        with open(mosaic_file) as f:
+            return cls(mosaic_file, json.load(f), logger=logger)
+
+    def uses_tile_id_ranges(self):
+        return any(s.tile_id_range is not None for s in self.slices)
+
+    def get_missing_files(self):
+        return [ s.path for s in self.slices if not s.path.exists() ]
+
+    def get_next_part_number(self, to_pmtiles_prefix):
+        # partitions split off from a slice get numbers no earlier partition used
+        pattern = re.compile(re.escape(Path(to_pmtiles_prefix).name) + r'-part(\d+)\.pmtiles$')
+        numbers = [ int(m.group(1)) for m in (pattern.match(s.name) for s in self.slices) if m is not None ]
+        return max(numbers, default=-1) + 1
+
+    def assign(self, z, x, y, tile_id):
+        # the index of the slice each tile falls in, first match wins, -1 for tiles outside all of them
+        keys = np.full(len(z), -1, dtype=np.int64)
+        for i, previous_slice in enumerate(self.slices):
+            unassigned = (keys == -1)
+            if not unassigned.any():
+                break
+            keys[unassigned & previous_slice.contains(z, x, y, tile_id)] = i
+        return keys
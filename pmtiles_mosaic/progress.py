@@ -0,0 +1,77 @@
+import time
+
+from .logger import LoggerMixin
+
+
+# seconds between progress lines
+PROGRESS_INTERVAL_SECS = 15
+# the clock is only read once this many items have gone by since the last look
+CHECK_EVERY = 4096
+
+
+def format_duration(secs):
+    secs = int(secs)
+    return f'{secs // 3600}:{(secs // 60) % 60:02d}:{secs % 60:02d}'
+
+def format_bytes(num_bytes):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if num_bytes < 1024:
+            return f'{num_bytes:.1f} {unit}'
+        num_bytes /= 1024
+    return f'{num_bytes:.1f} TB'
+
+
+# Periodic progress lines for a long running loop, with rates and, when the total
+# is known, an ETA. update() is called from the hot loops, so it only adds to the
+# counts and compares, the clock is read every CHECK_EVERY items at most.
+class Progress(LoggerMixin):
+    def __init__(self, name, total=None, unit='tiles', logger=None, interval=PROGRESS_INTERVAL_SECS):
+        self.name = name
+        self.total = total
+        self.unit = unit
+        self.logger = logger
+        self.interval = interval
+
+        self.count = 0
+        self.num_bytes = 0
+        self.start = time.monotonic()
+        self.last_report = self.start
+        self.next_check = CHECK_EVERY
+
+    def update(self, count=1, num_bytes=0):
+        self.count += count
+        self.num_bytes += num_bytes
+        if self.count >= self.next_check:
+            self.check()
+
+    def check(self):
+        self.next_check = self.count + CHECK_EVERY
+        now = time.monotonic()
+        if now - self.last_report >= self.interval:
+            self.last_report = now
+            self.report(now)
+
+    def get_message(self, now):
+        elapsed = max(now - self.start, 1e-9)
+        rate = self.count / elapsed
+
+        if self.total:
+            msg = f'{self.name}: {self.count}/{self.total} {self.unit} ({min(self.count / self.total, 1.0):.1%})'
+        else:
+            msg = f'{self.name}: {self.count} {self.unit}'
+        msg += f', {rate:.0f} {self.unit}/s'
+        if self.num_bytes > 0:
+            msg += f', {format_bytes(self.num_bytes / elapsed)}/s'
+        return msg, rate
+
+    def report(self, now):
+        msg, rate = self.get_message(now)
+        # totals can be estimates, past them there is nothing sensible to say
+        if self.total and rate > 0 and self.count < self.total:
+            msg += f', ETA {format_duration((self.total - self.count) / rate)}'
+        self.log_info(msg)
+
+    def done(self):
+        now = time.monotonic()
+        msg, _ = self.get_message(now)
+        self.log_info(f'{msg}, done in {format_duration(now - self.start)}')
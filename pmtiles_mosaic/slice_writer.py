@@ -0,0 +1,361 @@
+import json
+import gzip
+import shutil
+import tempfile
+
+from pathlib import Path
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import mercantile
+from pmtiles.tile import Compression, serialize_header, tileid_to_zxy
+
+from .tile_sources import create_source_from_paths
+from .compression import TileCompressor
+from .directory import (
+    DIRECTORY_CHUNK_SIZE,
+    PMTILES_HEADER_SIZE,
+    PMTILES_ROOT_DIR_MAX_SIZE,
+    PMTILES_MIN_LEAF_SIZE,
+    get_directories_size,
+    optimize_directories,
+)
+from .spill import SpillArea, GrowableArray, iter_chunks
+from .tile_index import TileIndex, sort_rows_external, get_may_repeat
+from .tile_cache import TileCache
+from .logger import LoggerMixin
+
+ENTRY_DTYPE = np.dtype([('tile_id', np.uint64), ('offset', np.uint64), ('length', np.uint64), ('run_length', np.uint64)])
+# closed entries are batched up as tuples and moved to the entry array this many at a time
+ENTRY_BATCH_SIZE = 4096
+
+
+# Mirrors the bookkeeping of pmtiles.writer.Writer without holding any tile data.
+# Fed the same tile ids, sizes and content hashes in the same order, it ends up
+# with exactly the entries the real writer would, so the directories can be sized
+# without writing anything. Entries are kept in a growable array, which a spill area
+# moves to disk once it gets big, instead of a list of Entry objects. Only the last entry can still change, its
+# run length grows as the same tile repeats, so it is kept apart as a list until the next one starts.
+# Contents that appear only once in the whole tile index can't repeat in a slice either, and are left
+# out of hash_to_offset when the caller says so.
+class SizeOnlyPMTilesWriter:
+    def __init__(self, spill=None):
+        self.spill = spill
+        self.chunk_size = spill.directory_chunk_size if spill is not None else DIRECTORY_CHUNK_SIZE
+        self.entries = GrowableArray(ENTRY_DTYPE, spill=spill)
+        self.num_flushed = 0
+        self.batch = []
+        # [tile_id, offset, length, run_length]
+        self.last = None
+        self.num_entries = 0
+        self.hash_to_offset = {}
+        self.num_contents = 0
+        self.offset = 0
+        self.addressed_tiles = 0
+        self.clustered = True
+        # sizes of serialized leaves, only used while the entries are in tile id order
+        self.leaf_sizes_cache = {}
+
+    @property
+    def last_run_length(self):
+        return self.last[3] if self.last is not None else None
+
+    def add_tile(self, tileid, length, hsh, may_repeat=True):
+        # returns whether the data of the tile is new to the slice and has to be stored
+        last = self.last
+        if last is not None and tileid < last[0]:
+            self.clustered = False
+
+        found = self.hash_to_offset.get(hsh) if may_repeat else None
+        if found is not None:
+            if tileid == last[0] + last[3] and last[1] == found:
+                last[3] += 1
+            else:
+                self.append_entry(tileid, found, length)
+            is_new = False
+        else:
+            self.append_entry(tileid, self.offset, length)
+            if may_repeat:
+                self.hash_to_offset[hsh] = self.offset
+            self.num_contents += 1
+            self.offset += length
+            is_new = True
+
+        self.addressed_tiles += 1
+        return is_new
+
+    def append_entry(self, tile_id, offset, length):
+        if self.last is not None:
+            self.batch.append(tuple(self.last))
+            if len(self.batch) >= ENTRY_BATCH_SIZE:
+                self.flush()
+        self.last = [tile_id, offset, length, 1]
+        self.num_entries += 1
+
+    def flush(self):
+        # the entry array may end with a copy of the last entry, which the closed ones go over
+        self.entries.truncate(self.num_flushed)
+        self.entries.extend(np.array(self.batch, dtype=ENTRY_DTYPE))
+        self.num_flushed += len(self.batch)
+        self.batch = []
+
+    def get_entry_array(self):
+        # all the entries in the order they were added, the last one as it is now
+        self.flush()
+        if self.last is not None:
+            self.entries.extend(np.array([tuple(self.last)], dtype=ENTRY_DTYPE))
+        return self.entries.view()
+
+    def sort_entries(self, tile_ids):
+        # positions of the entries in tile id order
+        if self.spill is None or self.spill.fits_in_memory(len(tile_ids)):
+            return np.argsort(tile_ids, kind='stable')
+        return sort_rows_external(self.spill.arange(len(tile_ids)), tile_ids, self.spill)
+
+    def get_sorted_entries(self, num_entries, last_run_length=None):
+        # get_entries(start, end) over the first num_entries entries in tile id order, for optimize_directories.
+        # The last of them can be given the run length it had at the time
+        entries = self.get_entry_array()[:num_entries]
+        order = None
+        if not self.clustered:
+            order = self.sort_entries(entries['tile_id'])
+        last_position = num_entries - 1
+
+        def get_entries(start, end):
+            if order is None:
+                chunk = entries[start:end]
+                run_lengths = chunk['run_length']
+                if last_run_length is not None and start <= last_position < end:
+                    run_lengths = run_lengths.copy()
+                    run_lengths[last_position - start] = last_run_length
+            else:
+                positions = np.asarray(order[start:end])
+                chunk = entries[positions]
+                run_lengths = chunk['run_length']
+                if last_run_length is not None:
+                    run_lengths = np.where(positions == last_position, np.uint64(last_run_length), run_lengths)
+            return chunk['tile_id'], run_lengths, chunk['length'], chunk['offset']
+
+        return get_entries
+
+    def get_directories_size(self, num_entries=None, last_run_length=None):
+        # the directories of a prefix of the entries can be sized as well,
+        # with the run length the last of them had at the time
+        if num_entries is None:
+            num_entries = self.num_entries
+
+        # all but the last entry are done growing, so leaves made of them can be reused
+        leaf_sizes_cache = self.leaf_sizes_cache if self.clustered else None
+        return get_directories_size(num_entries, self.get_sorted_entries(num_entries, last_run_length),
+                                    PMTILES_ROOT_DIR_MAX_SIZE, PMTILES_MIN_LEAF_SIZE, chunk_size=self.chunk_size,
+                                    leaf_sizes_cache=leaf_sizes_cache, num_stable=num_entries - 1)
+
+    def truncate(self, num_entries, last_run_length=None):
+        # drops the entries from num_entries on, the last one left gets back the given run length
+        entries = self.get_entry_array()
+        self.last = None
+        if num_entries > 0:
+            self.last = list(entries[num_entries - 1].tolist())
+            if last_run_length is not None:
+                self.last[3] = last_run_length
+        self.num_flushed = max(num_entries - 1, 0)
+        self.entries.truncate(self.num_flushed)
+        self.num_entries = num_entries
+
+        # drops the leaves that reach into the entries at and after the new last one
+        self.leaf_sizes_cache = { (start, leaf_size): size for (start, leaf_size), size in self.leaf_sizes_cache.items()
+                                  if start + leaf_size <= num_entries - 1 }
+
+    def close(self):
+        self.entries.release()
+
+
+# Writes a slice the way pmtiles.writer.Writer does, down to the layout of the directories,
+# on top of the bookkeeping of SizeOnlyPMTilesWriter, so that a slice with a lot of tiles
+# doesn't need a python object per tile either
+class SlicePMTilesWriter(SizeOnlyPMTilesWriter):
+    def __init__(self, f, spill=None):
+        super().__init__(spill=spill)
+        self.f = f
+        self.temp_dir = spill.dir if spill is not None else None
+        self.tile_f = tempfile.TemporaryFile(dir=self.temp_dir)
+
+    def write_tile(self, tileid, data, may_repeat=True):
+        if self.add_tile(tileid, len(data), hash(data), may_repeat):
+            self.tile_f.write(data)
+
+    def finalize(self, header, metadata):
+        num_entries = self.num_entries
+        get_entries = self.get_sorted_entries(num_entries)
+
+        header["addressed_tiles_count"] = self.addressed_tiles
+        header["tile_entries_count"] = num_entries
+        header["tile_contents_count"] = self.num_contents
+        header["min_zoom"] = tileid_to_zxy(int(get_entries(0, 1)[0][0]))[0]
+        header["max_zoom"] = tileid_to_zxy(int(get_entries(num_entries - 1, num_entries)[0][0]))[0]
+
+        with tempfile.TemporaryFile(dir=self.temp_dir) as leaves_f:
+            root_bytes, leaves_length = optimize_directories(num_entries, get_entries,
+                                                             PMTILES_ROOT_DIR_MAX_SIZE, PMTILES_MIN_LEAF_SIZE,
+                                                             chunk_size=self.chunk_size, leaves_file=leaves_f)
+
+            compressed_metadata = gzip.compress(json.dumps(metadata).encode())
+            header["clustered"] = self.clustered
+            header["internal_compression"] = Compression.GZIP
+            header["root_offset"] = PMTILES_HEADER_SIZE
+            header["root_length"] = len(root_bytes)
+            header["metadata_offset"] = header["root_offset"] + header["root_length"]
+            header["metadata_length"] = len(compressed_metadata)
+            header["leaf_directory_offset"] = header["metadata_offset"] + header["metadata_length"]
+            header["leaf_directory_length"] = leaves_length
+            header["tile_data_offset"] = header["leaf_directory_offset"] + header["leaf_directory_length"]
+            header["tile_data_length"] = self.offset
+
+            self.f.write(serialize_header(header))
+            self.f.write(root_bytes)
+            self.f.write(compressed_metadata)
+            leaves_f.seek(0)
+            shutil.copyfileobj(leaves_f, self.f)
+        self.tile_f.seek(0)
+        shutil.copyfileobj(self.tile_f, self.f)
+        self.tile_f.close()
+        self.close()
+
+
+def write_slice_file(pmtiles_file_name, header, metadata, tiles_and_data, spill=None):
+    # tiles_and_data yields (tile_id, tdata, may_repeat) triples, may_repeat being whether
+    # the same data can come up again. Returns the size of the written file
+    Path(pmtiles_file_name).parent.mkdir(parents=True, exist_ok=True)
+    with open(pmtiles_file_name, 'wb') as f:
+        writer = SlicePMTilesWriter(f, spill=spill)
+        for tile_id, tdata, may_repeat in tiles_and_data:
+            writer.write_tile(tile_id, tdata, may_repeat)
+        writer.finalize(header, metadata)
+        return f.tell()
+
+
+# Everything a worker process needs to write one slice on its own.
+# Tile data comes either from ranges of the tile cache holding the tiles as they are
+# to be stored, or from the source, in which case tiles are compressed as needed.
+# The tiles are either listed in the task, or are the rows saved to rows_file of the
+# tile index the pool was given, which workers read a chunk at a time.
+class SliceTask:
+    def __init__(self, pmtiles_file_name, header, metadata, tile_ids=None,
+                 tiles=None, offsets=None, sizes=None, should_be_compressed=False, rows_file=None):
+        self.pmtiles_file_name = pmtiles_file_name
+        self.header = header
+        self.metadata = metadata
+        self.tile_ids = tile_ids
+        self.tiles = tiles
+        self.offsets = offsets
+        self.sizes = sizes
+        self.should_be_compressed = should_be_compressed
+        self.rows_file = rows_file
+
+
+# per process state, set up once by the pool initializer
+_worker_state = {}
+
+def _init_worker(source_paths, cache_path, recompress, index_path, repeated_hashes, max_memory, spill_dir):
+    if cache_path is not None:
+        _worker_state['tile_cache'] = TileCache.open(cache_path)
+    else:
+        _worker_state['reader'] = create_source_from_paths(source_paths)
+
+    if index_path is not None:
+        _worker_state['tile_index'] = TileIndex.load(index_path)
+        _worker_state['repeated_hashes'] = repeated_hashes
+
+    _worker_state['spill'] = None
+    compressor_memory = None
+    if max_memory is not None:
+        _worker_state['spill'] = SpillArea(max_memory, base_dir=spill_dir)
+        compressor_memory = _worker_state['spill'].compressor_memory
+
+    if cache_path is None:
+        _worker_state['compressor'] = TileCompressor(recompress=recompress, max_memory=compressor_memory)
+
+def _iter_task_chunks(task):
+    # the tiles of a task as chunks of (tile ids, may repeat flags, offsets, sizes, tiles) lists,
+    # with offsets and sizes for tiles in the tile cache and (z, x, y) tiles otherwise
+    if task.rows_file is None:
+        yield task.tile_ids, [True] * len(task.tile_ids), task.offsets, task.sizes, task.tiles
+        return
+
+    index = _worker_state['tile_index']
+    rows = np.load(task.rows_file, mmap_mode='r')
+    for start, end in iter_chunks(len(rows), _worker_state['spill'].object_chunk_size):
+        chunk = np.asarray(rows[start:end])
+        tile_ids = index.tile_id[chunk].tolist()
+        may_repeat = get_may_repeat(index.content_hash[chunk], _worker_state['repeated_hashes']).tolist()
+        if 'tile_cache' in _worker_state:
+            yield tile_ids, may_repeat, index.offset[chunk].tolist(), index.size[chunk].tolist(), None
+        else:
+            tiles = list(zip(index.z[chunk].tolist(), index.x[chunk].tolist(), index.y[chunk].tolist()))
+            yield tile_ids, may_repeat, None, None, tiles
+
+def _get_task_tiles(task):
+    for tile_ids, may_repeat, offsets, sizes, tiles in _iter_task_chunks(task):
+        if offsets is not None:
+            tile_cache = _worker_state['tile_cache']
+            for tile_id, repeat, offset, size in zip(tile_ids, may_repeat, offsets, sizes):
+                yield tile_id, tile_cache.get(offset, size), repeat
+            continue
+
+        reader = _worker_state['reader']
+        compressor = _worker_state['compressor']
+        for tile_id, repeat, (z, x, y) in zip(tile_ids, may_repeat, tiles):
+            tdata = reader.get_tile_data(mercantile.Tile(x=x, y=y, z=z))
+            if task.should_be_compressed:
+                tdata = compressor.compress(tdata)
+            yield tile_id, tdata, repeat
+
+def _write_task(task):
+    return write_slice_file(task.pmtiles_file_name, task.header, task.metadata, _get_task_tiles(task),
+                            spill=_worker_state['spill'])
+
+
+# Slices are independent once the layout is known, so they are written by a pool
+# of processes, each with its own handle to the source or the cache file.
+# Tasks made of rows need the tile index saved at index_path and, when the planner had
+# a memory budget, the sorted hashes that repeat in it. Workers then split max_memory, what
+# the budget leaves for them, between them, and spill to their own directories under spill_dir.
+class SliceWriterPool(LoggerMixin):
+    def __init__(self, workers, source_paths=None, cache_path=None, recompress=False, logger=None,
+                 index_path=None, repeated_hashes=None, max_memory=None, spill_dir=None):
+        self.workers = workers
+        self.source_paths = source_paths
+        self.cache_path = cache_path
+        self.recompress = recompress
+        self.logger = logger
+        self.index_path = index_path
+        self.repeated_hashes = repeated_hashes
+        self.max_memory = max_memory
+        self.spill_dir = spill_dir
+
+    def write_all(self, tasks, num_tasks=None):
+        # yields the written file size of each task, in the order of the tasks.
+        # tasks can be a generator, only a couple of tasks per worker are in flight at a time
+        if num_tasks is None:
+            num_tasks = len(tasks)
+        if num_tasks == 0:
+            return
+
+        max_workers = min(self.workers, num_tasks)
+        self.log_info(f'Writing {num_tasks} partitions with {max_workers} worker processes')
+        worker_memory = None
+        if self.max_memory is not None:
+            worker_memory = self.max_memory // max_workers
+        initargs = (self.source_paths, self.cache_path, self.recompress,
+                    self.index_path, self.repeated_hashes, worker_memory, self.spill_dir)
+        with ProcessPoolExecutor(max_workers=max_workers,
+                                 initializer=_init_worker,
+                                 initargs=initargs) as executor:
+            pending = deque()
+            for task in tasks:
+                pending.append(executor.submit(_write_task, task))
+                if len(pending) >= 2 * max_workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
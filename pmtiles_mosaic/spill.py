@@ -0,0 +1,175 @@
+import sys
+import tempfile
+
+from pathlib import Path
+
+import numpy as np
+
+# rough per row footprint of the numpy temporaries used while grouping rows:
+# keys, sort order, sorted keys and sorted rows, and the counts and positions of the grouping on disk
+GROUPING_BYTES_PER_ROW = 80
+# rough per entry footprint of encoding a chunk of directory entries: the entry columns,
+# their deltas, the varint bytes and the compressed output
+DIRECTORY_BYTES_PER_ROW = 160
+# rough per row footprint of rows turned into python objects, a tile, its tile id and the lists holding them
+OBJECT_BYTES_PER_ROW = 256
+
+# kept out of the working sets for what isn't accounted for in them: allocator slack,
+# sqlite and zlib buffers, the per slice python objects and the progress and metrics state
+RESERVED_MEMORY = 4 * 1024 * 1024
+# below this the chunks get too small to make progress at a reasonable pace
+MIN_WORKING_MEMORY = 8 * 1024 * 1024
+
+
+def get_anon_memory():
+    # the resident memory of the process not backed by a file. Pages of memory mapped
+    # files are left out, the kernel can write them back and drop them at any time
+    try:
+        for line in Path('/proc/self/status').read_text().splitlines():
+            if line.startswith('RssAnon:'):
+                return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    # elsewhere the peak resident memory is the closest there is, in bytes on macOS and kilobytes otherwise
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def get_working_memory(max_memory, held_memory=None):
+    # the budget covers the whole process, what it already holds, the interpreter, numpy
+    # and the open sources, comes off the top along with the reserve
+    if held_memory is None:
+        held_memory = get_anon_memory()
+    return max_memory - held_memory - RESERVED_MEMORY
+
+
+def get_min_max_memory(held_memory):
+    return held_memory + RESERVED_MEMORY + MIN_WORKING_MEMORY
+
+
+def iter_chunks(length, chunk_size):
+    for start in range(0, length, chunk_size):
+        yield start, min(start + chunk_size, length)
+
+
+# Scratch space on disk for the per tile arrays of a run with a memory budget.
+# Arrays that are too big for the budget are created as memory mapped files,
+# whose pages the kernel can write back and drop at any time, and are worked on
+# a chunk at a time, so the resident working set stays around the chunk size.
+# max_memory bounds the anonymous memory of the whole process, so the working sets
+# share what is left of it after what the process holds by the time the area is made.
+class SpillArea:
+    def __init__(self, max_memory, base_dir=None):
+        self.max_memory = max_memory
+        self.held_memory = get_anon_memory()
+        self.working_memory = get_working_memory(max_memory, self.held_memory)
+        if self.working_memory < MIN_WORKING_MEMORY:
+            raise ValueError(f'A memory budget of {max_memory} bytes leaves too little to work with, '
+                             f'the process already holds {self.held_memory} bytes. '
+                             f'Give at least {get_min_max_memory(self.held_memory)} bytes')
+
+        self.temp_dir = tempfile.TemporaryDirectory(prefix='pmtiles-mosaic-spill-', dir=base_dir)
+        self.dir = Path(self.temp_dir.name)
+        self.num_files = 0
+        self.num_bytes = 0
+
+        # a quarter of the working memory for grouping or sorting rows, and a quarter for
+        # encoding directories, which happens alongside the planning state of a slice.
+        # Rows turned into python objects, the entries of the slice being planned or written
+        # and the tiles held by the compressor get an eighth each, the rest is for the
+        # state of the slice being planned
+        self.chunk_size = max(4 * 1024, (self.working_memory // 4) // GROUPING_BYTES_PER_ROW)
+        self.directory_chunk_size = max(4 * 1024, (self.working_memory // 4) // DIRECTORY_BYTES_PER_ROW)
+        self.object_chunk_size = max(1024, (self.working_memory // 8) // OBJECT_BYTES_PER_ROW)
+        self.compressor_memory = self.working_memory // 8
+
+    def fits_in_memory(self, num_rows, bytes_per_row=GROUPING_BYTES_PER_ROW, share=4):
+        return num_rows * bytes_per_row <= self.working_memory // share
+
+    def new_file(self, suffix='.bin'):
+        self.num_files += 1
+        return self.dir / f'{self.num_files:06d}{suffix}'
+
+    def new_array(self, length, dtype):
+        # empty files can't be mapped
+        if length == 0:
+            return np.zeros(0, dtype=dtype)
+        self.num_bytes += length * np.dtype(dtype).itemsize
+        return np.memmap(self.new_file(), dtype=dtype, mode='w+', shape=(length,))
+
+    def remove_array(self, array):
+        # the file goes away once the last mapping of it does
+        if isinstance(array, np.memmap):
+            self.num_bytes -= array.nbytes
+            Path(array.filename).unlink(missing_ok=True)
+
+    def arange(self, length):
+        if self.fits_in_memory(length, 8):
+            return np.arange(length, dtype=np.int64)
+
+        out = self.new_array(length, np.int64)
+        for start, end in iter_chunks(length, self.chunk_size):
+            out[start:end] = np.arange(start, end, dtype=np.int64)
+        return out
+
+    def concatenate(self, arrays):
+        length = sum(len(a) for a in arrays)
+        if self.fits_in_memory(length, 8):
+            return np.concatenate(arrays)
+
+        out = self.new_array(length, arrays[0].dtype)
+        pos = 0
+        for a in arrays:
+            for start, end in iter_chunks(len(a), self.chunk_size):
+                out[pos + start:pos + end] = a[start:end]
+            pos += len(a)
+        return out
+
+    def close(self):
+        self.temp_dir.cleanup()
+
+
+# An array that rows are appended to a batch at a time, doubling its capacity as it grows.
+# Given a spill area, it moves to a spill file once it outgrows the in memory share of the budget.
+class GrowableArray:
+    def __init__(self, dtype, spill=None):
+        self.dtype = np.dtype(dtype)
+        self.spill = spill
+        self.data = np.zeros(0, dtype=self.dtype)
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def reserve(self, length):
+        if length <= len(self.data):
+            return
+
+        capacity = max(length, 2 * len(self.data), 1024)
+        if self.spill is None or self.spill.fits_in_memory(capacity, self.dtype.itemsize, share=8):
+            data = np.empty(capacity, dtype=self.dtype)
+        else:
+            data = self.spill.new_array(capacity, self.dtype)
+
+        chunk_size = self.spill.chunk_size if self.spill is not None else max(self.length, 1)
+        for start, end in iter_chunks(self.length, chunk_size):
+            data[start:end] = self.data[start:end]
+        self.release()
+        self.data = data
+
+    def extend(self, values):
+        self.reserve(self.length + len(values))
+        self.data[self.length:self.length + len(values)] = values
+        self.length += len(values)
+
+    def truncate(self, length):
+        self.length = min(self.length, length)
+
+    def view(self):
+        return self.data[:self.length]
+
+    def release(self):
+        if self.spill is not None:
+            self.spill.remove_array(self.data)
+        self.data = np.zeros(0, dtype=self.dtype)
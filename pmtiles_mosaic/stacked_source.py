@@ -53,6 +53,16 @@ class StackedTileSource(LoggerMixin):
                 seen.add(tile)
                 yield (tile, size)
 
+    def get_tile_count(self):
+        # tiles present in more than one source are counted more than once
+        counts = [ src.get_tile_count() for src in self.srcs ]
+        if None in counts:
+            return None
+        return sum(counts)
+
+    def has_cheap_random_reads(self):
+        return all(src.has_cheap_random_reads() for src in self.srcs)
+
     def cleanup(self):
         for src in self.srcs:
             src.cleanup()
@@ -0,0 +1,160 @@
+import os
+import glob
+import json
+import mmap
+import hashlib
+import tempfile
+
+from pathlib import Path
+
+from .tile_index import TileIndex, INDEX_COLUMNS
+
+# bump when the layout of the cache directory changes
+CACHE_DIR_VERSION = 3
+
+
+# Append only store of tile blobs. Once sealed, the file is memory mapped and
+# reads are zero copy memoryview slices of the mapping, so reading a tile
+# costs neither a syscall nor a fresh bytes object.
+# Where each tile lives is left to the caller, which keeps offsets and sizes in its index.
+class TileCache:
+    def __init__(self, f, size=0):
+        self.f = f
+        self.size = size
+        self.mapping = None
+        self.view = None
+
+    @classmethod
+    def create(cls, path=None):
+        # without a path the cache lives in a named temp file, removed on close
+        if path is None:
+            return cls(tempfile.NamedTemporaryFile())
+        return cls(open(path, 'w+b'))
+
+    @classmethod
+    def open(cls, path):
+        cache = cls(open(path, 'rb'), size=Path(path).stat().st_size)
+        cache.seal()
+        return cache
+
+    @property
+    def path(self):
+        return self.f.name
+
+    def append(self, tdata):
+        offset = self.size
+        self.f.write(tdata)
+        self.size += len(tdata)
+        return offset
+
+    def seal(self):
+        self.f.flush()
+        # empty files can't be mapped
+        if self.size == 0:
+            return
+        self.mapping = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mapping)
+
+    def get(self, offset, size):
+        return self.view[offset:offset + size]
+
+    def close(self):
+        if self.view is not None:
+            self.view.release()
+            self.view = None
+        if self.mapping is not None:
+            self.mapping.close()
+            self.mapping = None
+        self.f.close()
+
+
+def get_file_fingerprint(path):
+    stats = os.stat(path)
+    # the leading bytes cover the pmtiles header and the sqlite header with its change counter
+    with open(path, 'rb') as f:
+        head = f.read(128)
+
+    return {
+        'path': str(Path(path).resolve()),
+        'size': stats.st_size,
+        'mtime_ns': stats.st_mtime_ns,
+        'header': hashlib.sha256(head).hexdigest(),
+    }
+
+def get_dir_fingerprint(path):
+    num_files = 0
+    total_size = 0
+    latest_mtime_ns = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            stats = os.stat(os.path.join(root, name))
+            num_files += 1
+            total_size += stats.st_size
+            latest_mtime_ns = max(latest_mtime_ns, stats.st_mtime_ns)
+
+    return {
+        'path': str(Path(path).resolve()),
+        'num_files': num_files,
+        'size': total_size,
+        'mtime_ns': latest_mtime_ns,
+    }
+
+def get_sources_fingerprint(source_paths):
+    # follows how create_source_from_paths resolves the paths
+    fingerprints = []
+    for source_path in source_paths:
+        if source_path.endswith('.pmtiles'):
+            for pmtiles_file in sorted(glob.glob(source_path)):
+                fingerprints.append(get_file_fingerprint(pmtiles_file))
+        elif source_path.endswith('.mbtiles'):
+            fingerprints.append(get_file_fingerprint(source_path))
+        else:
+            fingerprints.append(get_dir_fingerprint(source_path))
+    return fingerprints
+
+
+# A tile cache kept in a directory across runs, along with the index describing it.
+# The manifest is written last and removed first, so its presence means the rest is complete.
+class TileCacheDir:
+    def __init__(self, cache_dir, fingerprint):
+        self.cache_dir = Path(cache_dir)
+        self.fingerprint = fingerprint
+
+        self.manifest_file = self.cache_dir / 'manifest.json'
+        self.tiles_file = self.cache_dir / 'tiles.bin'
+        self.index_dir = self.cache_dir / 'index'
+
+    def load(self):
+        # returns the tile index, the tile cache and the extra manifest data, or None if not usable
+        if not self.manifest_file.exists():
+            return None
+
+        manifest = json.loads(self.manifest_file.read_text())
+        if manifest.get('version') != CACHE_DIR_VERSION or manifest.get('fingerprint') != self.fingerprint:
+            return None
+
+        # files lost or cut short since, say by cleaning up the directory half way
+        index_files = [ self.index_dir / f'{name}.npy' for name in INDEX_COLUMNS ]
+        if not all(path.exists() for path in [self.tiles_file, *index_files]):
+            return None
+        if self.tiles_file.stat().st_size != manifest.get('tiles_size'):
+            return None
+
+        tile_index = TileIndex.load(self.index_dir)
+        tile_cache = TileCache.open(self.tiles_file)
+        return tile_index, tile_cache, manifest.get('extra', {})
+
+    def create_tile_cache(self):
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.manifest_file.unlink(missing_ok=True)
+        return TileCache.create(self.tiles_file)
+
+    def save(self, tile_index, extra):
+        tile_index.save(self.index_dir)
+        manifest = {
+            'version': CACHE_DIR_VERSION,
+            'fingerprint': self.fingerprint,
+            'tiles_size': self.tiles_file.stat().st_size,
+            'extra': extra,
+        }
+        self.manifest_file.write_text(json.dumps(manifest))
@@ -0,0 +1,338 @@
+from array import array
+from pathlib import Path
+
+import numpy as np
+import mercantile
+
+from .spill import iter_chunks
+
+
+def zxy_to_tileid_array(z, x, y):
+    # vectorized version of pmtiles.tile.zxy_to_tileid for tiles of a single zoom level
+    if z > 31:
+        raise OverflowError("tile zoom exceeds 64-bit limit")
+
+    acc = ((1 << (2 * z)) - 1) // 3
+    x = x.astype(np.int64)
+    y = y.astype(np.int64)
+    d = np.zeros(len(x), dtype=np.int64)
+    s = (1 << z) // 2
+    while s > 0:
+        rx = ((x & s) > 0).astype(np.int64)
+        ry = ((y & s) > 0).astype(np.int64)
+        d += s * s * ((3 * rx) ^ ry)
+        no_ry = (ry == 0)
+        flip = no_ry & (rx == 1)
+        x = np.where(flip, s - 1 - x, x)
+        y = np.where(flip, s - 1 - y, y)
+        x, y = np.where(no_ry, y, x), np.where(no_ry, x, y)
+        s //= 2
+    return (d + acc).astype(np.uint64)
+
+
+# column name, array typecode and numpy dtype of each column collected by the builder
+BUILDER_COLUMNS = [
+    ('z', 'B', np.uint8),
+    ('x', 'I', np.uint32),
+    ('y', 'I', np.uint32),
+    ('size', 'I', np.uint32),
+    ('offset', 'Q', np.uint64),
+    ('content_hash', 'q', np.int64),
+]
+
+INDEX_COLUMNS = ['z', 'x', 'y', 'tile_id', 'size', 'offset', 'content_hash']
+
+
+def fill_tile_ids(tile_id, z, x, y):
+    for zoom_level in np.unique(z).tolist():
+        mask = (z == zoom_level)
+        tile_id[mask] = zxy_to_tileid_array(zoom_level, x[mask], y[mask])
+
+
+# Compact column store for the tiles of a source, one row per tile.
+# Rows are appended into stdlib arrays while the source is being read
+# and are exposed as numpy arrays once building is done.
+# Given a spill area, the buffered rows are flushed to column files whenever
+# they reach its chunk size, and the built index maps those files instead.
+class TileIndexBuilder:
+    def __init__(self, spill=None):
+        self.spill = spill
+        self.column_files = None
+        self.num_spilled = 0
+        self.reset_buffers()
+
+    def reset_buffers(self):
+        for name, typecode, _ in BUILDER_COLUMNS:
+            setattr(self, name, array(typecode))
+
+    def __len__(self):
+        return self.num_spilled + len(self.z)
+
+    def append(self, tile, size, offset=0, content_hash=0):
+        self.z.append(tile.z)
+        self.x.append(tile.x)
+        self.y.append(tile.y)
+        self.size.append(size)
+        self.offset.append(offset)
+        self.content_hash.append(content_hash)
+
+        if self.spill is not None and len(self.z) >= self.spill.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.column_files is None:
+            self.column_files = { name: self.spill.new_file() for name, _, _ in BUILDER_COLUMNS }
+
+        for name, _, _ in BUILDER_COLUMNS:
+            with open(self.column_files[name], 'ab') as f:
+                getattr(self, name).tofile(f)
+        self.num_spilled += len(self.z)
+        self.reset_buffers()
+
+    def build(self):
+        if self.column_files is None:
+            columns = { name: np.frombuffer(getattr(self, name), dtype=dtype) for name, _, dtype in BUILDER_COLUMNS }
+            tile_id = np.zeros(len(self), dtype=np.uint64)
+            fill_tile_ids(tile_id, columns['z'], columns['x'], columns['y'])
+        else:
+            self.flush()
+            columns = { name: np.memmap(self.column_files[name], dtype=dtype, mode='r', shape=(self.num_spilled,))
+                        for name, _, dtype in BUILDER_COLUMNS }
+            tile_id = self.spill.new_array(self.num_spilled, np.uint64)
+            for start, end in iter_chunks(self.num_spilled, self.spill.chunk_size):
+                fill_tile_ids(tile_id[start:end],
+                              columns['z'][start:end], columns['x'][start:end], columns['y'][start:end])
+            tile_id.flush()
+
+        return TileIndex(
+            columns['z'], columns['x'], columns['y'], tile_id,
+            columns['size'], columns['offset'], columns['content_hash'],
+        )
+
+
+class TileIndex:
+    def __init__(self, z, x, y, tile_id, size, offset, content_hash):
+        self.z = z
+        self.x = x
+        self.y = y
+        self.tile_id = tile_id
+        self.size = size
+        self.offset = offset
+        self.content_hash = content_hash
+
+    def __len__(self):
+        return len(self.z)
+
+    def all_rows(self):
+        return np.arange(len(self), dtype=np.int64)
+
+    def get_tile(self, row):
+        return mercantile.Tile(x=int(self.x[row]), y=int(self.y[row]), z=int(self.z[row]))
+
+    def get_tiles(self, rows):
+        zs = self.z[rows].tolist()
+        xs = self.x[rows].tolist()
+        ys = self.y[rows].tolist()
+        return [ mercantile.Tile(x=x, y=y, z=z) for z, x, y in zip(zs, xs, ys) ]
+
+    def save(self, path):
+        # one .npy file per column, so that loading can map them instead of reading them in
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        for name in INDEX_COLUMNS:
+            np.save(path / f'{name}.npy', getattr(self, name))
+
+    @classmethod
+    def load(cls, path):
+        path = Path(path)
+        return cls(*[ np.load(path / f'{name}.npy', mmap_mode='r') for name in INDEX_COLUMNS ])
+
+
+def get_ancestor_coords(z, coords, from_zoom_level):
+    # the column(or row) of a tile's ancestor at a lower zoom level is just a right shift
+    shifts = z.astype(np.uint32) - np.uint32(from_zoom_level)
+    return coords >> shifts
+
+
+def group_rows(rows, keys):
+    # returns the distinct keys in ascending order, the rows sorted by key and the
+    # boundaries of each key's group in the sorted rows.
+    # rows keep their relative order within a group
+    if len(rows) == 0:
+        return [], rows, [0]
+
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    starts = np.flatnonzero(sorted_keys[1:] != sorted_keys[:-1]) + 1
+    unique_keys = sorted_keys[np.concatenate(([0], starts))]
+    boundaries = np.concatenate(([0], starts, [len(rows)]))
+    return unique_keys.tolist(), rows[order], boundaries.tolist()
+
+
+def group_rows_external(rows, get_keys, spill):
+    # same result as group_rows, for rows that don't fit in memory along with their keys.
+    # A counting sort done a chunk at a time: the first pass counts the rows of every key,
+    # the second one scatters each chunk's rows to their place in a spilled output array.
+    # get_keys maps a chunk of rows to their keys
+    if len(rows) == 0:
+        return [], rows, [0]
+
+    counts = {}
+    for start, end in iter_chunks(len(rows), spill.chunk_size):
+        keys, key_counts = np.unique(get_keys(rows[start:end]), return_counts=True)
+        for key, count in zip(keys.tolist(), key_counts.tolist()):
+            counts[key] = counts.get(key, 0) + count
+
+    unique_keys = sorted(counts)
+    key_array = np.array(unique_keys, dtype=np.int64)
+    boundaries = np.concatenate(([0], np.cumsum([ counts[k] for k in unique_keys ], dtype=np.int64)))
+    next_positions = boundaries[:-1].copy()
+
+    sorted_rows = spill.new_array(len(rows), rows.dtype)
+    for start, end in iter_chunks(len(rows), spill.chunk_size):
+        chunk = np.asarray(rows[start:end])
+        key_idx = np.searchsorted(key_array, get_keys(chunk))
+        order = np.argsort(key_idx, kind='stable')
+        sorted_idx = key_idx[order]
+
+        group_starts = np.flatnonzero(np.concatenate(([True], sorted_idx[1:] != sorted_idx[:-1])))
+        group_sizes = np.diff(np.concatenate((group_starts, [len(chunk)])))
+        ranks = np.arange(len(chunk)) - np.repeat(group_starts, group_sizes)
+
+        sorted_rows[next_positions[sorted_idx] + ranks] = chunk[order]
+        next_positions[sorted_idx[group_starts]] += group_sizes
+
+    sorted_rows.flush()
+    return unique_keys, sorted_rows, boundaries.tolist()
+
+
+def sort_rows_external(rows, values, spill):
+    # rows sorted by values[rows], for rows that don't fit in memory along with their sort keys.
+    # The rows are bucketed on the high bits of their values with the on disk grouping,
+    # then each bucket is sorted in memory. Tile ids are far from evenly spread, the tiles
+    # of the highest zoom level end up in a few buckets, so buckets too big to sort in
+    # memory are bucketed again over their own, narrower, range of values
+    sorted_rows = spill.new_array(len(rows), rows.dtype)
+    for start, end in iter_chunks(len(rows), spill.chunk_size):
+        sorted_rows[start:end] = rows[start:end]
+    sort_rows_in_place(sorted_rows, values, spill)
+    return sorted_rows
+
+def sort_rows_in_place(rows, values, spill):
+    if spill.fits_in_memory(len(rows)):
+        bucket = np.asarray(rows)
+        rows[:] = bucket[np.argsort(values[bucket], kind='stable')]
+        return
+
+    min_value = None
+    max_value = None
+    for start, end in iter_chunks(len(rows), spill.chunk_size):
+        chunk_values = values[rows[start:end]]
+        min_value = chunk_values.min() if min_value is None else min(min_value, chunk_values.min())
+        max_value = chunk_values.max() if max_value is None else max(max_value, chunk_values.max())
+    if min_value == max_value:
+        return
+
+    num_buckets = 4 * ((len(rows) + spill.chunk_size - 1) // spill.chunk_size)
+    shift = np.uint64((int(max_value - min_value) // num_buckets).bit_length())
+    _, grouped_rows, boundaries = group_rows_external(rows, lambda r: (values[r] - min_value) >> shift, spill)
+    for start, end in iter_chunks(len(rows), spill.chunk_size):
+        rows[start:end] = grouped_rows[start:end]
+    spill.remove_array(grouped_rows)
+    for start, end in zip(boundaries[:-1], boundaries[1:]):
+        sort_rows_in_place(rows[start:end], values, spill)
+
+
+def get_repeated_hashes(content_hash, spill):
+    # the distinct content hashes that more than one row has, sorted.
+    # Tiles whose content doesn't repeat anywhere can't be deduplicated either
+    if spill.fits_in_memory(len(content_hash)):
+        hashes, counts = np.unique(content_hash, return_counts=True)
+        return hashes[counts > 1]
+
+    # bucketed on the high bits of the hashes with the on disk grouping, then counted a
+    # bucket at a time. The rows of a bucket can all be one blob repeated all over, so
+    # they are counted a chunk at a time too
+    num_buckets = 4 * ((len(content_hash) + spill.chunk_size - 1) // spill.chunk_size)
+    shift = np.uint64(64 - num_buckets.bit_length())
+    _, sorted_rows, boundaries = group_rows_external(spill.arange(len(content_hash)),
+                                                     lambda r: content_hash[r].view(np.uint64) >> shift, spill)
+
+    repeated = [ np.zeros(0, dtype=np.int64) ]
+    for bucket_start, bucket_end in zip(boundaries[:-1], boundaries[1:]):
+        chunk_hashes = []
+        chunk_counts = []
+        for start, end in iter_chunks(bucket_end - bucket_start, spill.chunk_size):
+            hashes, counts = np.unique(content_hash[np.asarray(sorted_rows[bucket_start + start:bucket_start + end])],
+                                       return_counts=True)
+            chunk_hashes.append(hashes)
+            chunk_counts.append(counts)
+        hashes, inverse = np.unique(np.concatenate(chunk_hashes), return_inverse=True)
+        counts = np.bincount(inverse, weights=np.concatenate(chunk_counts))
+        repeated.append(hashes[counts > 1])
+    return np.sort(np.concatenate(repeated))
+
+
+def get_may_repeat(hashes, repeated_hashes):
+    # whether the content of each tile can come up again, which is any of them without repeated hashes to go by
+    if repeated_hashes is None:
+        return np.ones(len(hashes), dtype=bool)
+    return np.isin(hashes, repeated_hashes)
+
+
+# extents are kept per zoom level as [min_x, min_y, max_x, max_y]
+def update_zoom_extents(extents, tile):
+    extent = extents.get(tile.z)
+    if extent is None:
+        extents[tile.z] = [tile.x, tile.y, tile.x, tile.y]
+        return
+
+    if tile.x < extent[0]:
+        extent[0] = tile.x
+    elif tile.x > extent[2]:
+        extent[2] = tile.x
+
+    if tile.y < extent[1]:
+        extent[1] = tile.y
+    elif tile.y > extent[3]:
+        extent[3] = tile.y
+
+
+def get_zoom_extents_from_arrays(z, x, y):
+    extents = {}
+    for zoom_level in np.unique(z).tolist():
+        mask = (z == zoom_level)
+        zx = x[mask]
+        zy = y[mask]
+        extents[zoom_level] = [int(zx.min()), int(zy.min()), int(zx.max()), int(zy.max())]
+    return extents
+
+
+def get_zoom_extents_from_index(index, chunk_size):
+    extents = {}
+    for start, end in iter_chunks(len(index), chunk_size):
+        merge_zoom_extents(extents, get_zoom_extents_from_arrays(index.z[start:end],
+                                                                 index.x[start:end],
+                                                                 index.y[start:end]))
+    return extents
+
+
+def merge_zoom_extents(extents, other):
+    for z, other_extent in other.items():
+        extent = extents.get(z)
+        if extent is None:
+            extents[z] = list(other_extent)
+            continue
+
+        extent[0] = min(extent[0], other_extent[0])
+        extent[1] = min(extent[1], other_extent[1])
+        extent[2] = max(extent[2], other_extent[2])
+        extent[3] = max(extent[3], other_extent[3])
+
+
+def get_extent_bounds(z, extent):
+    # west and north only depend on the smallest x and y, east and south on the largest
+    min_x, min_y, max_x, max_y = extent
+    top_left = mercantile.bounds(mercantile.Tile(x=min_x, y=min_y, z=z))
+    bottom_right = mercantile.bounds(mercantile.Tile(x=max_x, y=max_y, z=z))
+    return (bottom_right.south, top_left.west, top_left.north, bottom_right.east)
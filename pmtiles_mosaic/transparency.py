@@ -0,0 +1,144 @@
+import io
+import gzip
+import hashlib
+import traceback
+
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+from pmtiles.tile import TileType
+
+from .compression import is_gzipped
+from .logger import LoggerMixin
+
+
+def is_transparent_empty(tdata, tile_type):
+    if is_gzipped(tdata):
+        tdata = gzip.decompress(tdata)
+
+    img_format = 'PNG' if tile_type == TileType.PNG else 'WEBP'
+
+    with Image.open(io.BytesIO(tdata), formats=[img_format]) as im:
+        # Check for transparency
+        if im.mode in ('RGBA', 'LA') or (im.mode == 'P' and 'transparency' in im.info):
+            # Get alpha channel
+            if im.mode != 'A':
+                alpha = im.getchannel('A')
+            else:
+                alpha = im
+            min_alpha, max_alpha = alpha.getextrema()
+            return max_alpha == 0
+
+    return False
+
+def check_transparency(tdata, tile_type):
+    # returns whether the tile is transparent and empty, along with the traceback of the error
+    # if it could not be checked. The traceback is formatted here as it doesn't survive
+    # being sent back from the process pool
+    try:
+        return is_transparent_empty(tdata, tile_type), None
+    except Exception:
+        return False, traceback.format_exc()
+
+def _check_batch(batch, tile_type_value):
+    tile_type = TileType(tile_type_value)
+    return [ check_transparency(tdata, tile_type) for tdata in batch ]
+
+
+# Empty raster tiles are usually byte identical, so results are memoized by content hash.
+# The memo only keeps the most recently seen max_results blobs, as most blobs of a raster
+# tileset are seen just once, so a blob is decoded again when more than max_results other
+# distinct blobs came up since it was last seen. Blobs that keep repeating, like the empty
+# tiles, stay in the memo and are only decoded once.
+# Cache misses are decoded on a process pool as Pillow holds the GIL for most of the decode.
+class TransparencyChecker(LoggerMixin):
+    def __init__(self, tile_type, workers=1, batch_size=256, max_results=64 * 1024, logger=None):
+        self.tile_type = tile_type
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_results = max_results
+        self.logger = logger
+
+        self.results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+        self.executor = None
+        if workers > 1:
+            self.executor = ProcessPoolExecutor(max_workers=workers)
+
+    @staticmethod
+    def applies_to(tile_type):
+        return tile_type in [TileType.PNG, TileType.WEBP]
+
+    def get_key(self, tdata):
+        return hashlib.blake2b(tdata, digest_size=16).digest()
+
+    def _decode_misses(self, misses):
+        datas = list(misses.values())
+        if self.executor is None or len(datas) <= 1:
+            return _check_batch(datas, self.tile_type.value)
+
+        chunk_size = max(1, len(datas) // self.workers)
+        chunks = [ datas[i:i + chunk_size] for i in range(0, len(datas), chunk_size) ]
+        results = []
+        for chunk_results in self.executor.map(_check_batch, chunks, [self.tile_type.value] * len(chunks)):
+            results.extend(chunk_results)
+        return results
+
+    def check_all(self, datas):
+        keys = [ self.get_key(tdata) for tdata in datas ]
+
+        # results of this batch, which the memo may drop again while the misses go in
+        found = {}
+        misses = {}
+        for key, tdata in zip(keys, datas):
+            if key in found or key in misses:
+                continue
+            result = self.results.get(key)
+            if result is not None:
+                self.results.move_to_end(key)
+                found[key] = result
+                continue
+            misses[key] = tdata
+
+        self.misses += len(misses)
+        self.hits += len(keys) - len(misses)
+
+        if misses:
+            results = self._decode_misses(misses)
+            for key, (result, error) in zip(misses.keys(), results):
+                if error is not None:
+                    self.log_warning(f'Error checking transparency, keeping the tile\n{error}')
+                found[key] = result
+                self.results[key] = result
+            while len(self.results) > self.max_results:
+                self.results.popitem(last=False)
+
+        return [ found[key] for key in keys ]
+
+    def filter_all(self, items):
+        # items are (item, tdata) pairs, the ones with transparent empty images are dropped
+        batch = []
+        for pair in items:
+            batch.append(pair)
+            if len(batch) < self.batch_size:
+                continue
+
+            yield from self._filter_batch(batch)
+            batch = []
+
+        if batch:
+            yield from self._filter_batch(batch)
+
+    def _filter_batch(self, batch):
+        transparent = self.check_all([ tdata for _, tdata in batch ])
+        for pair, is_transparent in zip(batch, transparent):
+            if not is_transparent:
+                yield pair
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
@@ -0,0 +1,48 @@
+import json
+import sqlite3
+
+import pytest
+
+from pmtiles_mosaic.spill import SpillArea, GROUPING_BYTES_PER_ROW, get_anon_memory, get_min_max_memory
+
+
+@pytest.fixture
+def make_spill(tmp_path):
+    # spill areas that work a given number of rows at a time, and only keep that many
+    # in memory, however much the test process holds
+    spills = []
+
+    def make(chunk_size):
+        spill = SpillArea(get_min_max_memory(get_anon_memory()) + 64 * 1024 * 1024, base_dir=tmp_path)
+        spill.chunk_size = chunk_size
+        spill.directory_chunk_size = chunk_size
+        spill.object_chunk_size = chunk_size
+        spill.working_memory = 4 * chunk_size * GROUPING_BYTES_PER_ROW
+        spills.append(spill)
+        return spill
+
+    yield make
+    for spill in spills:
+        spill.close()
+
+
+@pytest.fixture
+def make_mbtiles(tmp_path):
+    # writes an indexed MBTiles source from a dict of mercantile tiles to their data
+    def make(name, tiles, metadata=None):
+        path = tmp_path / name
+        con = sqlite3.connect(path)
+        con.execute('create table metadata (name text, value text);')
+        con.execute('create table tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob);')
+        con.execute('create unique index tile_index on tiles (zoom_level, tile_column, tile_row);')
+        zooms = [ t.z for t in tiles ] or [0]
+        metadata = { 'name': 'test', 'format': 'pbf', 'minzoom': min(zooms), 'maxzoom': max(zooms), **(metadata or {}) }
+        con.executemany('insert into metadata (name, value) values (?, ?);',
+                        [ (k, v if isinstance(v, str) else json.dumps(v)) for k, v in metadata.items() ])
+        con.executemany('insert into tiles (zoom_level, tile_column, tile_row, tile_data) values (?, ?, ?, ?);',
+                        [ (t.z, t.x, (1 << t.z) - 1 - t.y, tdata) for t, tdata in tiles.items() ])
+        con.commit()
+        con.close()
+        return path
+
+    return make
@@ -0,0 +1,41 @@
+import gzip
+import random
+
+import pytest
+
+from pmtiles_mosaic.compression import TileCompressor, gzip_tile, recompress_tile
+
+
+def get_blobs(rng):
+    # a few small blobs repeating a lot, some gzipped already, and one too big for the memo
+    common = [ rng.randbytes(rng.randint(1, 200)) for _ in range(5) ] + [ b'', bytes(4096) ]
+    common += [ gzip.compress(blob, compresslevel=1) for blob in common[:2] ]
+    blobs = [ rng.choice(common) if rng.random() < 0.7 else rng.randbytes(rng.randint(1, 2000)) for _ in range(2000) ]
+    return blobs + [ bytes(70 * 1024) ] * 3
+
+
+@pytest.mark.parametrize('recompress', [False, True])
+@pytest.mark.parametrize('workers', [1, 3])
+def test_memoized_tiles_match_fresh_compression(recompress, workers):
+    blobs = get_blobs(random.Random(0))
+    compress_tile = recompress_tile if recompress else gzip_tile
+    compressor = TileCompressor(workers=workers, batch_size=16, max_memo_entries=4, recompress=recompress)
+
+    # memoryviews the way the tile cache hands tiles out
+    compressed = list(compressor.compress_all(enumerate(memoryview(blob) for blob in blobs)))
+    compressor.close()
+
+    assert compressor.memo_hits > 0
+    assert [ i for i, _ in compressed ] == list(range(len(blobs)))
+    assert all(tdata == compress_tile(blob) for (_, tdata), blob in zip(compressed, blobs))
+
+
+def test_memo_stays_within_its_bounds():
+    blobs = get_blobs(random.Random(1))
+    compressor = TileCompressor(max_memo_entries=64, max_memory=8 * 1024)
+
+    for blob in blobs:
+        assert compressor.compress(blob) == gzip_tile(blob)
+        assert len(compressor.memo) <= 64
+        assert compressor.memo_bytes <= 4 * 1024
+        assert compressor.memo_bytes == sum(len(key) + len(value) for key, value in compressor.memo.items())
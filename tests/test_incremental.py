@@ -0,0 +1,159 @@
+import json
+import gzip
+import random
+
+import mercantile
+import numpy as np
+import pytest
+from pmtiles.reader import MemorySource, all_tiles
+from pmtiles.tile import zxy_to_tileid
+
+from pmtiles_mosaic.partition import Partitioner
+from pmtiles_mosaic.previous_mosaic import PreviousMosaic
+from pmtiles_mosaic.tile_sources import create_source_from_paths
+
+
+SIZE_LIMIT = 64 * 1024
+
+
+def get_tiles(seed=0, max_zoom=6):
+    rng = random.Random(seed)
+    return { mercantile.Tile(x=x, y=y, z=z): rng.randbytes(rng.randint(20, 300))
+             for z in range(max_zoom + 1) for x in range(1 << z) for y in range(1 << z) }
+
+def run(tmp_path, make_mbtiles, tiles, strategy, incremental, source_name='source.mbtiles'):
+    source_paths = [ str(make_mbtiles(source_name, tiles)) ]
+    partitioner = Partitioner(create_source_from_paths(source_paths), str(tmp_path / 'out'), SIZE_LIMIT, True,
+                              source_paths=source_paths, strategy=strategy, incremental=incremental)
+    partitioner.plan()
+    partitioner.write_partitions()
+    partitioner.finalize()
+    partitioner.cleanup()
+    return partitioner
+
+def read_mosaic(tmp_path):
+    # the files of the mosaic with their bytes, and all their tiles
+    mosaic = json.loads((tmp_path / 'out.mosaic.json').read_text())
+    files = {}
+    tiles = {}
+    for name in mosaic['slices']:
+        files[name] = (tmp_path / name).read_bytes()
+        for (z, x, y), tdata in all_tiles(MemorySource(files[name])):
+            tiles[mercantile.Tile(x=x, y=y, z=z)] = gzip.decompress(tdata)
+    return files, tiles
+
+def get_counters(partitioner):
+    return { name: partitioner.metrics.counters.get(name, 0)
+             for name in ['slices_kept', 'slices_rewritten', 'slices_split', 'slices_removed'] }
+
+def get_slice_of(tmp_path, tile):
+    # the name of the previous slice a client would look the tile up in
+    previous = PreviousMosaic.load(str(tmp_path / 'out'))
+    key = previous.assign(np.array([tile.z]), np.array([tile.x]), np.array([tile.y]),
+                          np.array([zxy_to_tileid(tile.z, tile.x, tile.y)], dtype=np.uint64))[0]
+    return previous.slices[key].name
+
+
+@pytest.mark.parametrize('strategy', ['zxy', 'hilbert'])
+def test_unchanged_tiles_keep_every_partition(tmp_path, make_mbtiles, strategy):
+    tiles = get_tiles()
+    run(tmp_path, make_mbtiles, tiles, strategy, False)
+    files, _ = read_mosaic(tmp_path)
+    assert len(files) > 3
+
+    partitioner = run(tmp_path, make_mbtiles, tiles, strategy, True, source_name='again.mbtiles')
+
+    assert get_counters(partitioner) == { 'slices_kept': len(files), 'slices_rewritten': 0, 'slices_split': 0, 'slices_removed': 0 }
+    assert read_mosaic(tmp_path)[0] == files
+
+
+@pytest.mark.parametrize('strategy', ['zxy', 'hilbert'])
+def test_changed_tile_rewrites_its_partition(tmp_path, make_mbtiles, strategy):
+    tiles = get_tiles()
+    run(tmp_path, make_mbtiles, tiles, strategy, False)
+    files, _ = read_mosaic(tmp_path)
+
+    changed_tile = mercantile.Tile(x=40, y=21, z=6)
+    tiles[changed_tile] = b'changed'
+    changed_slice = get_slice_of(tmp_path, changed_tile)
+    partitioner = run(tmp_path, make_mbtiles, tiles, strategy, True, source_name='changed.mbtiles')
+
+    assert get_counters(partitioner) == { 'slices_kept': len(files) - 1, 'slices_rewritten': 1, 'slices_split': 0, 'slices_removed': 0 }
+    new_files, new_tiles = read_mosaic(tmp_path)
+    assert new_files.keys() == files.keys()
+    assert [ name for name in files if new_files[name] != files[name] ] == [changed_slice]
+    assert new_tiles == tiles
+
+
+def test_rewritten_partition_replaces_the_old_one_once_the_mosaic_is_written(tmp_path, make_mbtiles):
+    tiles = get_tiles()
+    run(tmp_path, make_mbtiles, tiles, 'zxy', False)
+    files, _ = read_mosaic(tmp_path)
+    mosaic = (tmp_path / 'out.mosaic.json').read_bytes()
+
+    changed_tile = mercantile.Tile(x=40, y=21, z=6)
+    tiles[changed_tile] = b'changed'
+    changed_slice = get_slice_of(tmp_path, changed_tile)
+    source_paths = [ str(make_mbtiles('changed.mbtiles', tiles)) ]
+    partitioner = Partitioner(create_source_from_paths(source_paths), str(tmp_path / 'out'), SIZE_LIMIT, True,
+                              source_paths=source_paths, incremental=True)
+    partitioner.plan()
+    partitioner.write_partitions()
+
+    # an interrupted run leaves the previous mosaic and its partitions as they were
+    assert (tmp_path / changed_slice).read_bytes() == files[changed_slice]
+    assert (tmp_path / 'out.mosaic.json').read_bytes() == mosaic
+
+    partitioner.finalize()
+    partitioner.cleanup()
+
+    assert (tmp_path / changed_slice).read_bytes() != files[changed_slice]
+    assert not (tmp_path / f'{changed_slice}.tmp').exists()
+    assert read_mosaic(tmp_path)[1] == tiles
+
+
+@pytest.mark.parametrize('strategy', ['zxy', 'hilbert'])
+def test_partition_over_the_limit_is_split(tmp_path, make_mbtiles, strategy):
+    tiles = get_tiles()
+    run(tmp_path, make_mbtiles, tiles, strategy, False)
+    files, _ = read_mosaic(tmp_path)
+
+    # incompressible enough to take the partition of the tile over the limit
+    grown_tile = mercantile.Tile(x=40, y=21, z=6)
+    tiles[grown_tile] = random.Random(1).randbytes(SIZE_LIMIT // 2)
+    split_slice = get_slice_of(tmp_path, grown_tile)
+    partitioner = run(tmp_path, make_mbtiles, tiles, strategy, True, source_name='grown.mbtiles')
+
+    counters = get_counters(partitioner)
+    assert counters['slices_split'] == 1
+    assert counters['slices_kept'] == len(files) - 1
+    new_files, new_tiles = read_mosaic(tmp_path)
+    assert split_slice not in new_files
+    assert not (tmp_path / split_slice).exists()
+    # the pieces get partition numbers no earlier run used
+    assert len(new_files.keys() - files.keys()) > 1
+    assert all(name > max(files) for name in new_files.keys() - files.keys())
+    assert all(len(data) <= SIZE_LIMIT for data in new_files.values())
+    assert new_tiles == tiles
+
+
+@pytest.mark.parametrize('strategy', ['zxy', 'hilbert'])
+def test_tiles_outside_the_previous_mosaic_fall_back_to_a_full_run(tmp_path, make_mbtiles, strategy):
+    tiles = get_tiles()
+    run(tmp_path, make_mbtiles, tiles, strategy, False)
+
+    # a zoom level none of the previous partitions covers, and past the highest tile id
+    tiles[mercantile.Tile(x=0, y=0, z=7)] = b'new'
+    partitioner = run(tmp_path, make_mbtiles, tiles, strategy, True, source_name='more.mbtiles')
+
+    assert partitioner.previous_mosaic is None
+    assert get_counters(partitioner) == { 'slices_kept': 0, 'slices_rewritten': 0, 'slices_split': 0, 'slices_removed': 0 }
+    assert read_mosaic(tmp_path)[1] == tiles
+
+
+def test_no_previous_mosaic_falls_back_to_a_full_run(tmp_path, make_mbtiles):
+    tiles = get_tiles()
+    partitioner = run(tmp_path, make_mbtiles, tiles, 'zxy', True)
+
+    assert partitioner.previous_mosaic is None
+    assert read_mosaic(tmp_path)[1] == tiles
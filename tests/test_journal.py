@@ -0,0 +1,153 @@
+import json
+import random
+
+import mercantile
+import pytest
+from pmtiles.reader import MemorySource, Reader, all_tiles
+
+from pmtiles_mosaic.journal import PartitionJournal
+from pmtiles_mosaic.partition import Partitioner, partition_main
+
+
+RUN_KEY = { 'sources': [ 'a.mbtiles' ], 'size_limit': 1024 }
+HEADER = { 'min_zoom': 0, 'max_zoom': 5 }
+CONTEXT = [ ('z', 0, 5) ]
+
+
+def write_partition(tmp_path, name, size):
+    path = tmp_path / name
+    path.write_bytes(b'x' * size)
+    return str(path)
+
+def record_partitions(tmp_path, journal_file, sizes):
+    journal = PartitionJournal(journal_file, RUN_KEY)
+    journal.open()
+    for i, size in enumerate(sizes):
+        journal.record(write_partition(tmp_path, f'out-part{i:04d}.pmtiles', size), CONTEXT, 10 + i, HEADER, size)
+    journal.close()
+
+def read_lines(journal_file):
+    return [ json.loads(line) for line in journal_file.read_text().splitlines() ]
+
+
+def test_resume_skips_the_recorded_partitions(tmp_path):
+    journal_file = tmp_path / 'out.journal.jsonl'
+    record_partitions(tmp_path, journal_file, [100, 200])
+
+    journal = PartitionJournal(journal_file, RUN_KEY)
+    journal.open()
+
+    assert journal.get_written_size(str(tmp_path / 'out-part0000.pmtiles'), CONTEXT, 10, HEADER) == 100
+    assert journal.get_written_size(str(tmp_path / 'out-part0001.pmtiles'), CONTEXT, 11, HEADER) == 200
+    # planned differently this time, or not written at all
+    assert journal.get_written_size(str(tmp_path / 'out-part0000.pmtiles'), [ ('z', 0, 4) ], 10, HEADER) is None
+    assert journal.get_written_size(str(tmp_path / 'out-part0000.pmtiles'), CONTEXT, 12, HEADER) is None
+    assert journal.get_written_size(str(tmp_path / 'out-part0000.pmtiles'), CONTEXT, 10, { **HEADER, 'max_zoom': 6 }) is None
+    assert journal.get_written_size(str(tmp_path / 'out-part0002.pmtiles'), CONTEXT, 12, HEADER) is None
+    journal.close()
+
+
+def test_resume_needs_the_partition_file_as_recorded(tmp_path):
+    journal_file = tmp_path / 'out.journal.jsonl'
+    record_partitions(tmp_path, journal_file, [100, 200])
+    (tmp_path / 'out-part0000.pmtiles').write_bytes(b'cut short')
+    (tmp_path / 'out-part0001.pmtiles').unlink()
+
+    journal = PartitionJournal(journal_file, RUN_KEY)
+    journal.open()
+
+    assert journal.get_written_size(str(tmp_path / 'out-part0000.pmtiles'), CONTEXT, 10, HEADER) is None
+    assert journal.get_written_size(str(tmp_path / 'out-part0001.pmtiles'), CONTEXT, 11, HEADER) is None
+    journal.close()
+
+
+def test_half_written_last_line_is_dropped(tmp_path):
+    journal_file = tmp_path / 'out.journal.jsonl'
+    record_partitions(tmp_path, journal_file, [100, 200])
+    with open(journal_file, 'a') as f:
+        f.write('{"name": "out-part0002.pmtiles", "cont')
+
+    journal = PartitionJournal(journal_file, RUN_KEY)
+    journal.open()
+    journal.record(write_partition(tmp_path, 'out-part0002.pmtiles', 300), CONTEXT, 12, HEADER, 300)
+    journal.close()
+
+    # rewritten without the torn line before anything got appended
+    lines = read_lines(journal_file)
+    assert lines[0] == { 'run': RUN_KEY }
+    assert [ line['name'] for line in lines[1:] ] == [ 'out-part0000.pmtiles', 'out-part0001.pmtiles', 'out-part0002.pmtiles' ]
+
+
+def test_journal_of_another_run_is_ignored(tmp_path):
+    journal_file = tmp_path / 'out.journal.jsonl'
+    record_partitions(tmp_path, journal_file, [100, 200])
+
+    run_key = { **RUN_KEY, 'size_limit': 2048 }
+    journal = PartitionJournal(journal_file, run_key)
+    journal.open()
+
+    assert journal.entries == {}
+    assert journal.get_written_size(str(tmp_path / 'out-part0000.pmtiles'), CONTEXT, 10, HEADER) is None
+    journal.close()
+    assert read_lines(journal_file) == [ { 'run': run_key } ]
+
+
+def get_tiles(seed=0, max_zoom=7):
+    rng = random.Random(seed)
+    return { mercantile.Tile(x=x, y=y, z=z): rng.randbytes(rng.randint(50, 250))
+             for z in range(max_zoom + 1) for x in range(1 << z) for y in range(1 << z) }
+
+def read_partition(path):
+    # the header and tiles, leaving out the gzip timestamps of the directories
+    source = MemorySource(path.read_bytes())
+    return Reader(source).header(), dict(all_tiles(source))
+
+def get_args(source, tmp_path, *extra):
+    return [ '--from-source', str(source), '--to-pmtiles', str(tmp_path / 'out.pmtiles'),
+             '--size-limit', '1M', '--metrics-file', str(tmp_path / 'metrics.json'), *extra ]
+
+
+def test_interrupted_run_is_resumed(tmp_path, make_mbtiles, monkeypatch):
+    source = make_mbtiles('source.mbtiles', get_tiles())
+    reference_dir = tmp_path / 'reference'
+    reference_dir.mkdir()
+    partition_main(get_args(source, reference_dir))
+
+    # killed while writing the third partition
+    write_slice = Partitioner.write_slice
+    calls = []
+    def failing_write_slice(self, planned_slice, progress):
+        calls.append(planned_slice.name)
+        if len(calls) == 3:
+            raise KeyboardInterrupt()
+        write_slice(self, planned_slice, progress)
+
+    with monkeypatch.context() as m:
+        m.setattr(Partitioner, 'write_slice', failing_write_slice)
+        with pytest.raises(KeyboardInterrupt):
+            partition_main(get_args(source, tmp_path, '--resume'))
+    assert (tmp_path / 'out.journal.jsonl').exists()
+    assert (tmp_path / 'out.cache').exists()
+
+    partition_main(get_args(source, tmp_path, '--resume'))
+
+    metrics = json.loads((tmp_path / 'metrics.json').read_text())
+    assert metrics['counters']['slices_resumed'] == 2
+    assert metrics['counters']['tile_cache_reused']
+    assert not (tmp_path / 'out.journal.jsonl').exists()
+    assert not (tmp_path / 'out.cache').exists()
+    reference_files = sorted(p.name for p in reference_dir.glob('*.pmtiles'))
+    assert len(reference_files) > 3
+    assert sorted(p.name for p in tmp_path.glob('*.pmtiles')) == reference_files
+    for name in reference_files:
+        assert read_partition(tmp_path / name) == read_partition(reference_dir / name)
+
+
+def test_plan_only_removes_its_tile_cache(tmp_path, make_mbtiles):
+    source = make_mbtiles('source.mbtiles', get_tiles(max_zoom=5))
+
+    partition_main(get_args(source, tmp_path, '--resume', '--plan-only'))
+
+    assert (tmp_path / 'out.plan.json').exists()
+    assert not (tmp_path / 'out.cache').exists()
+    assert not (tmp_path / 'out.journal.jsonl').exists()
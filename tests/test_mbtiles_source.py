@@ -0,0 +1,51 @@
+import sqlite3
+
+import mercantile
+
+from pmtiles_mosaic.mbtiles_source import MBTilesSource
+from pmtiles_mosaic.stacked_source import StackedTileSource
+
+
+TILES = {
+    mercantile.Tile(x=0, y=0, z=0): b'a',
+    mercantile.Tile(x=0, y=0, z=1): b'bb',
+    mercantile.Tile(x=1, y=0, z=1): b'ccc',
+    mercantile.Tile(x=1, y=1, z=1): b'dddd',
+}
+
+
+def write_mbtiles(path, tiles):
+    con = sqlite3.connect(path)
+    con.execute('create table metadata (name text, value text);')
+    con.execute('create table tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob);')
+    con.executemany('insert into tiles (zoom_level, tile_column, tile_row, tile_data) values (?, ?, ?, ?);',
+                    [ (t.z, t.x, (1 << t.z) - 1 - t.y, tdata) for t, tdata in tiles.items() ])
+    con.commit()
+    con.close()
+    return path
+
+
+def test_all_sizes_covers_all_zoom_levels(tmp_path):
+    src = MBTilesSource(write_mbtiles(tmp_path / 'tiles.mbtiles', TILES))
+
+    assert dict(src.all_sizes()) == { t: len(tdata) for t, tdata in TILES.items() }
+    assert dict(src.all()) == TILES
+
+
+def test_all_z_sizes_covers_one_zoom_level(tmp_path):
+    src = MBTilesSource(write_mbtiles(tmp_path / 'tiles.mbtiles', TILES))
+
+    assert dict(src.all_z_sizes(1)) == { t: len(tdata) for t, tdata in TILES.items() if t.z == 1 }
+    assert list(src.all_z_sizes(2)) == []
+
+
+def test_stacked_mbtiles_sizes(tmp_path):
+    # the first source wins for tiles in both
+    first = { mercantile.Tile(x=0, y=0, z=1): b'first' }
+    src = StackedTileSource([ MBTilesSource(write_mbtiles(tmp_path / 'first.mbtiles', first)),
+                              MBTilesSource(write_mbtiles(tmp_path / 'second.mbtiles', TILES)) ])
+
+    expected = { t: len(tdata) for t, tdata in TILES.items() }
+    expected[mercantile.Tile(x=0, y=0, z=1)] = len(b'first')
+    assert dict(src.all_sizes()) == expected
+    assert dict(src.all_z_sizes(1)) == { t: size for t, size in expected.items() if t.z == 1 }
@@ -0,0 +1,285 @@
+import json
+import gzip
+import random
+import argparse
+
+from types import SimpleNamespace
+
+import mercantile
+import pytest
+from pmtiles.reader import MemorySource, all_tiles
+from pmtiles.tile import zxy_to_tileid
+
+from pmtiles_mosaic.download_mosaic import Merger
+from pmtiles_mosaic.partition import Partitioner, BALANCE_PRECISION, HILBERT_BLOCK_SIZES, parse_memory_size, partition_main
+from pmtiles_mosaic.tile_index import TileIndexBuilder
+from pmtiles_mosaic.tile_sources import create_source_from_paths
+
+
+METADATA = { 'format': 'pbf', 'vector_layers': [ { 'id': 'test', 'minzoom': 0, 'maxzoom': 14 } ] }
+
+
+def get_partitioner(size_limit, tiles=None, **kwargs):
+    # tiles are (tile, size, content hash) triples, indexed without any tile data
+    reader = SimpleNamespace(min_zoom=0, max_zoom=14, get_metadata=lambda: METADATA)
+    partitioner = Partitioner(reader, 'out', size_limit, False, **kwargs)
+    if tiles is not None:
+        builder = TileIndexBuilder()
+        for tile, size, content_hash in tiles:
+            builder.append(tile, size, 0, content_hash)
+        partitioner.tile_index = builder.build()
+    return partitioner
+
+def run_partitioner(source_path, to_pmtiles_prefix, size_limit, **kwargs):
+    # a full run the way partition_main does it
+    source_paths = [ str(source_path) ]
+    partitioner = Partitioner(create_source_from_paths(source_paths), str(to_pmtiles_prefix), size_limit, True,
+                              source_paths=source_paths, **kwargs)
+    partitioner.plan()
+    partitioner.write_partitions()
+    partitioner.finalize()
+    partitioner.cleanup()
+    return partitioner
+
+def read_tiles(path):
+    # tile id to data of the tiles in a pmtiles file, ungzipped
+    tiles = {}
+    for (z, x, y), tdata in all_tiles(MemorySource(path.read_bytes())):
+        tiles[zxy_to_tileid(z, x, y)] = gzip.decompress(tdata)
+    return tiles
+
+def get_random_tiles(rng, max_zoom, num_extra=0):
+    # every tile up to max_zoom, and some more of the next zoom level
+    tiles = [ mercantile.Tile(x=x, y=y, z=z) for z in range(max_zoom + 1)
+              for x in range(1 << z) for y in range(1 << z) ]
+    z = max_zoom + 1
+    extra = { mercantile.Tile(x=rng.randrange(1 << z), y=rng.randrange(1 << z), z=z) for _ in range(num_extra) }
+    return tiles + sorted(extra)
+
+def get_stripe_tiles(rng, num_stripes, zoom=10):
+    # stripes of a column of tiles each, a third of them repeating one of a few contents
+    tiles = []
+    stripes = []
+    for x in range(num_stripes):
+        rows = []
+        for y in range(rng.randint(1, 30)):
+            content_hash = rng.randint(0, 4) if rng.random() < 0.3 else rng.getrandbits(62)
+            rows.append(len(tiles))
+            tiles.append((mercantile.Tile(x=x, y=y, z=zoom), rng.randint(20, 600), content_hash))
+        stripes.append(rows)
+    return tiles, stripes
+
+def get_stripes(partitioner, stripes):
+    index = partitioner.tile_index
+    return [ index.all_rows()[rows] for rows in stripes ]
+
+def get_exact_size(partitioner, stripes):
+    curr_slice = partitioner.create_new_estimator()
+    for rows in stripes:
+        curr_slice.add_rows(rows)
+    size = curr_slice.get_size()
+    curr_slice.close()
+    return size
+
+def get_linear_cut(partitioner, stripes, start, limit):
+    # the first stripe left out, measuring every prefix exactly
+    end = start
+    while end < len(stripes) and get_exact_size(partitioner, stripes[start:end + 1]) <= limit:
+        end += 1
+    return end
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_fill_slice_matches_linear_scan(seed):
+    rng = random.Random(seed)
+    tiles, stripe_rows = get_stripe_tiles(rng, rng.randint(1, 60))
+    partitioner = get_partitioner(1, tiles)
+    stripes = get_stripes(partitioner, stripe_rows)
+    start = rng.randint(0, len(stripes) - 1)
+    limit = rng.randint(500, get_exact_size(partitioner, stripes[start:]) + 1000)
+
+    curr_slice = partitioner.create_new_estimator()
+    end = partitioner.fill_slice(curr_slice, stripes, start, limit)
+
+    assert end == get_linear_cut(partitioner, stripes, start, limit)
+    # rolled back to exactly the stripes that fit
+    assert curr_slice.get_size() == (get_exact_size(partitioner, stripes[start:end]) if end > start else 0)
+
+
+def test_fill_slice_at_the_exact_limit():
+    rng = random.Random(0)
+    tiles, stripe_rows = get_stripe_tiles(rng, 40)
+    partitioner = get_partitioner(1, tiles)
+    stripes = get_stripes(partitioner, stripe_rows)
+
+    for count in [1, 7, 23, 40]:
+        limit = get_exact_size(partitioner, stripes[:count])
+        assert partitioner.fill_slice(partitioner.create_new_estimator(), stripes, 0, limit) == count
+        assert partitioner.fill_slice(partitioner.create_new_estimator(), stripes, 0, limit - 1) == count - 1
+
+
+def test_fill_slice_with_a_single_tile_over_the_limit():
+    tiles = [ (mercantile.Tile(x=0, y=0, z=10), 100, 1),
+              (mercantile.Tile(x=1, y=0, z=10), 5000, 2),
+              (mercantile.Tile(x=2, y=0, z=10), 100, 3) ]
+    partitioner = get_partitioner(1, tiles)
+    stripes = get_stripes(partitioner, [[0], [1], [2]])
+
+    curr_slice = partitioner.create_new_estimator()
+    assert partitioner.fill_slice(curr_slice, stripes, 1, 2000) == 1
+    assert curr_slice.num_tiles == 0
+    assert partitioner.fill_slice(partitioner.create_new_estimator(), stripes, 0, 2000) == 1
+    assert partitioner.get_stripe_slices(stripes, 2000) == [(0, 1), (1, 1), (2, 3)]
+
+
+def count_greedy_slices(sizes, limit):
+    count = 0
+    total = None
+    for size in sizes:
+        if total is None or total + size > limit:
+            count += 1
+            total = 0
+        total += size
+    return count
+
+
+@pytest.mark.parametrize('seed', range(30))
+def test_balanced_limit_matches_linear_scan(seed):
+    rng = random.Random(seed)
+    size_limit = rng.randint(200, 2000)
+    sizes = [ rng.randint(1, size_limit) for _ in range(rng.randint(2, 40)) ]
+    num_slices = count_greedy_slices(sizes, size_limit)
+    partitioner = get_partitioner(size_limit)
+
+    def get_slices(limit, max_slices):
+        if limit < max(sizes) or count_greedy_slices(sizes, limit) > max_slices:
+            return None
+        return []
+
+    smallest = next(limit for limit in range(max(sizes), size_limit + 1)
+                    if count_greedy_slices(sizes, limit) <= num_slices)
+    limit = partitioner.get_balanced_limit(num_slices, get_slices)
+
+    assert smallest <= limit < smallest + max(1, size_limit // BALANCE_PRECISION)
+    assert count_greedy_slices(sizes, limit) == num_slices
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_balanced_limit_over_stripes(seed):
+    rng = random.Random(seed)
+    tiles, stripe_rows = get_stripe_tiles(rng, rng.randint(2, 60))
+    size_limit = rng.randint(4000, 20000)
+    partitioner = get_partitioner(size_limit, tiles)
+    stripes = get_stripes(partitioner, stripe_rows)
+    slices = partitioner.get_stripe_slices(stripes, size_limit)
+    oversize = { start for start, end in slices if start == end }
+
+    def get_slices(limit, max_slices):
+        return partitioner.get_stripe_slices(stripes, limit, oversize, max_slices=max_slices)
+
+    limit = partitioner.get_balanced_limit(len(slices), get_slices)
+
+    # no more slices with the balanced limit, and too many with anything much lower
+    assert get_slices(limit, len(slices)) is not None
+    assert get_slices(limit - max(1, size_limit // BALANCE_PRECISION), len(slices)) is None
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_tile_id_slices_are_as_full_as_they_can_be(seed):
+    # the blocks that overflow are retried as smaller blocks down to single rows, so every
+    # slice ends exactly where the next tile would take it over the limit
+    rng = random.Random(seed)
+    tiles = [ (tile, rng.randint(20, 600), rng.randint(0, 4) if rng.random() < 0.3 else rng.getrandbits(62))
+              for tile in get_random_tiles(rng, 6, 5000) ]
+    assert len(tiles) > 2 * HILBERT_BLOCK_SIZES[0]
+    partitioner = get_partitioner(1, tiles)
+    sorted_rows = partitioner.sort_rows_by_tile_id(partitioner.tile_index.all_rows())
+    limit = rng.randint(200 * 1024, 2 * 1024 * 1024)
+
+    slices = partitioner.get_tile_id_slices(sorted_rows, limit)
+
+    assert slices[0][0] == 0
+    assert slices[-1][1] == len(sorted_rows)
+    for (start, end), (next_start, _) in zip(slices, slices[1:] + [(len(sorted_rows), None)]):
+        assert end == next_start
+        assert get_exact_size(partitioner, [sorted_rows[start:end]]) <= limit
+        if end < len(sorted_rows):
+            assert get_exact_size(partitioner, [sorted_rows[start:end + 1]]) > limit
+
+
+def test_tile_id_slices_with_a_tile_over_the_limit():
+    tiles = [ (mercantile.Tile(x=0, y=0, z=0), 100, 1), (mercantile.Tile(x=0, y=0, z=1), 5000, 2) ]
+    partitioner = get_partitioner(1, tiles)
+
+    assert partitioner.get_tile_id_slices(partitioner.tile_index.all_rows(), 2000) is None
+
+
+@pytest.mark.parametrize('balance', [False, True])
+def test_hilbert_mosaic_tile_id_ranges(tmp_path, make_mbtiles, balance):
+    rng = random.Random(0)
+    tiles = { tile: rng.randbytes(rng.randint(20, 300)) for tile in get_random_tiles(rng, 6, 500) }
+    size_limit = 64 * 1024
+
+    run_partitioner(make_mbtiles('source.mbtiles', tiles), tmp_path / 'out', size_limit,
+                    strategy='hilbert', balance=balance)
+
+    mosaic = json.loads((tmp_path / 'out.mosaic.json').read_text())
+    slices = sorted(mosaic['slices'].items(), key=lambda item: item[1]['min_tile_id'])
+    assert len(slices) > 3
+    written = {}
+    for name, entry in slices:
+        path = tmp_path / name
+        assert path.stat().st_size <= size_limit
+        slice_tiles = read_tiles(path)
+        assert min(slice_tiles) == entry['min_tile_id']
+        assert max(slice_tiles) == entry['max_tile_id']
+        written.update(slice_tiles)
+
+    # the ranges don't overlap, and between them hold every tile
+    for (_, entry), (_, next_entry) in zip(slices, slices[1:]):
+        assert entry['max_tile_id'] < next_entry['min_tile_id']
+    assert written == { zxy_to_tileid(t.z, t.x, t.y): tdata for t, tdata in tiles.items() }
+
+
+@pytest.mark.parametrize('strategy, version', [('zxy', 1), ('hilbert', 2)])
+def test_mosaic_version_and_download(tmp_path, make_mbtiles, strategy, version):
+    rng = random.Random(0)
+    tiles = { tile: rng.randbytes(rng.randint(20, 300)) for tile in get_random_tiles(rng, 6, 500) }
+
+    run_partitioner(make_mbtiles('source.mbtiles', tiles), tmp_path / 'out', 64 * 1024, strategy=strategy)
+
+    mosaic_file = tmp_path / 'out.mosaic.json'
+    mosaic = json.loads(mosaic_file.read_text())
+    assert mosaic['version'] == version
+    assert len(mosaic['slices']) > 3
+
+    merged_file = tmp_path / 'merged.pmtiles'
+    Merger(str(mosaic_file), 'pmtiles', merged_file, 60, 3).process()
+    assert read_tiles(merged_file) == { zxy_to_tileid(t.z, t.x, t.y): tdata for t, tdata in tiles.items() }
+
+
+@pytest.mark.parametrize('size_str, expected', [
+    ('512', 512), ('64k', 64 * 1024), ('40M', 40 * 1024 * 1024), (' 2G ', 2 * 1024 * 1024 * 1024),
+])
+def test_parse_memory_size(size_str, expected):
+    assert parse_memory_size(size_str) == expected
+
+
+@pytest.mark.parametrize('size_str', ['github_release', '1.5G', '8GB', '-1M', '0', ''])
+def test_parse_memory_size_rejects(size_str):
+    with pytest.raises(argparse.ArgumentTypeError):
+        parse_memory_size(size_str)
+
+
+@pytest.mark.parametrize('max_memory, message', [
+    ('github_release', 'Invalid memory size'),
+    ('512K', '--max-memory must be at least'),
+])
+def test_max_memory_argument(tmp_path, make_mbtiles, capsys, max_memory, message):
+    source = make_mbtiles('source.mbtiles', { mercantile.Tile(x=0, y=0, z=0): b'tile' })
+
+    with pytest.raises(SystemExit):
+        partition_main([ '--from-source', str(source), '--to-pmtiles', str(tmp_path / 'out.pmtiles'),
+                         '--max-memory', max_memory ])
+
+    assert message in capsys.readouterr().err
@@ -0,0 +1,93 @@
+import random
+import sqlite3
+
+from types import SimpleNamespace
+
+import mercantile
+import pytest
+
+from pmtiles_mosaic.partition_basic import Partitioner
+from pmtiles_mosaic.tile_sources import create_source_from_paths
+
+
+def get_partitioner(size_limit, stripe_blobs=None):
+    reader = SimpleNamespace(min_zoom=0, max_zoom=0)
+    partitioner = Partitioner(reader, 'out', size_limit, dedup=stripe_blobs is not None)
+    partitioner.stripe_blobs = stripe_blobs
+    return partitioner
+
+def get_sizes_by_x(stripe_blobs):
+    return { x: sum(size for _, size in blobs) for x, blobs in stripe_blobs.items() }
+
+def count_buckets(stripe_blobs, size_limit):
+    # greedy contiguous packing with each bucket sized by the distinct blobs of its stripes
+    count = 0
+    bucket = None
+    for x in sorted(stripe_blobs.keys()):
+        grown = dict(stripe_blobs[x]) if bucket is None else { **bucket, **dict(stripe_blobs[x]) }
+        if bucket is None or sum(grown.values()) > size_limit:
+            count += 1
+            grown = dict(stripe_blobs[x])
+        bucket = grown
+    return count
+
+def get_brute_force_limit(stripe_blobs, size_limit):
+    # the smallest limit a stripe fits in that needs no more buckets than the size limit
+    num_buckets = count_buckets(stripe_blobs, size_limit)
+    start = max(get_sizes_by_x(stripe_blobs).values())
+    return next(limit for limit in range(start, size_limit + 1)
+                if count_buckets(stripe_blobs, limit) <= num_buckets)
+
+
+def test_balanced_size_limit_with_blobs_shared_across_stripes():
+    # each stripe has the same 10 byte blob and a distinct 1 byte one, 14 bytes in a single bucket,
+    # while the stripes add up to 44
+    stripe_blobs = { x: [(1000, 10), (x, 1)] for x in range(4) }
+    partitioner = get_partitioner(20, stripe_blobs)
+
+    assert partitioner.get_balanced_size_limit(get_sizes_by_x(stripe_blobs)) == 14
+    assert get_brute_force_limit(stripe_blobs, 20) == 14
+
+
+@pytest.mark.parametrize('seed', range(50))
+def test_balanced_size_limit_matches_brute_force_with_dedup(seed):
+    rng = random.Random(seed)
+    shared_blobs = [ (1000 + i, rng.randint(5, 30)) for i in range(4) ]
+    stripe_blobs = {}
+    for x in range(rng.randint(2, 12)):
+        blobs = rng.sample(shared_blobs, rng.randint(0, len(shared_blobs)))
+        blobs.append((x, rng.randint(1, 20)))
+        stripe_blobs[x] = blobs
+    size_limit = rng.randint(max(get_sizes_by_x(stripe_blobs).values()), 150)
+    partitioner = get_partitioner(size_limit, stripe_blobs)
+
+    assert (partitioner.get_balanced_size_limit(get_sizes_by_x(stripe_blobs)) ==
+            get_brute_force_limit(stripe_blobs, size_limit))
+
+
+@pytest.mark.parametrize('seed', range(50))
+def test_balanced_size_limit_matches_brute_force_without_dedup(seed):
+    rng = random.Random(seed)
+    stripe_blobs = { x: [(x, rng.randint(1, 40))] for x in range(rng.randint(1, 12)) }
+    size_limit = rng.randint(max(get_sizes_by_x(stripe_blobs).values()), 150)
+    partitioner = get_partitioner(size_limit)
+
+    assert (partitioner.get_balanced_size_limit(get_sizes_by_x(stripe_blobs)) ==
+            get_brute_force_limit(stripe_blobs, size_limit))
+
+
+def test_tile_added_to_the_source_after_planning_is_reported(tmp_path, make_mbtiles):
+    tiles = { mercantile.Tile(x=x, y=y, z=z): b'tile' for z in range(3) for x in range(1 << z) for y in range(1 << z) }
+    del tiles[mercantile.Tile(x=3, y=3, z=2)]
+    source_path = make_mbtiles('source.mbtiles', tiles)
+    partitioner = Partitioner(create_source_from_paths([str(source_path)]), str(tmp_path / 'out'), 1024 * 1024)
+    partitioner.partition()
+
+    # past the highest tile id the plan knows of
+    con = sqlite3.connect(source_path)
+    con.execute('insert into tiles (zoom_level, tile_column, tile_row, tile_data) values (2, 3, 0, ?);', (b'new',))
+    con.commit()
+    con.close()
+
+    with pytest.raises(Exception, match='was not in the source when the partitions were planned'):
+        partitioner.write_partitions()
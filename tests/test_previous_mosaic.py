@@ -0,0 +1,85 @@
+import json
+
+import numpy as np
+import pytest
+from pmtiles.tile import Compression, TileType, zxy_to_tileid
+from pmtiles.writer import Writer
+
+from pmtiles_mosaic.previous_mosaic import PreviousMosaic
+
+
+WORLD = { 'min_lon_e7': -1800000000, 'min_lat_e7': -850511287, 'max_lon_e7': 1800000000, 'max_lat_e7': 850511287 }
+WEST = { 'min_lon_e7': -1800000000, 'min_lat_e7': -850511287, 'max_lon_e7': 0, 'max_lat_e7': 850511287 }
+EAST = { 'min_lon_e7': 0, 'min_lat_e7': -850511287, 'max_lon_e7': 1800000000, 'max_lat_e7': 850511287 }
+
+
+def write_mosaic(tmp_path, slices):
+    mosaic = { 'version': 1, 'metadata': {}, 'header': {}, 'slices': slices }
+    (tmp_path / 'out.mosaic.json').write_text(json.dumps(mosaic))
+    return PreviousMosaic.load(str(tmp_path / 'out'))
+
+def assign(previous, tiles):
+    z, x, y = ( np.array(values) for values in zip(*tiles) )
+    tile_ids = np.array([ zxy_to_tileid(*tile) for tile in tiles ], dtype=np.uint64)
+    return previous.assign(z, x, y, tile_ids).tolist()
+
+
+def test_load_without_a_mosaic(tmp_path):
+    assert PreviousMosaic.load(str(tmp_path / 'out')) is None
+
+
+def test_assign_by_bounds_first_match_wins(tmp_path):
+    previous = write_mosaic(tmp_path, {
+        'out-part0000.pmtiles': { 'header': { 'min_zoom': 0, 'max_zoom': 2, **WORLD } },
+        'out-part0001.pmtiles': { 'header': { 'min_zoom': 3, 'max_zoom': 5, **WEST } },
+        'out-part0002.pmtiles': { 'header': { 'min_zoom': 3, 'max_zoom': 5, **WORLD } },
+    })
+
+    assert not previous.uses_tile_id_ranges()
+    # a tile of the top slice, a western and an eastern one, and one past all zoom levels
+    assert assign(previous, [(1, 1, 0), (4, 2, 7), (4, 12, 7), (6, 0, 0)]) == [0, 1, 2, -1]
+
+
+def test_assign_by_tile_id_range(tmp_path):
+    previous = write_mosaic(tmp_path, {
+        'out-part0000.pmtiles': { 'header': { 'min_zoom': 0, 'max_zoom': 2, **WORLD }, 'min_tile_id': 0, 'max_tile_id': 12 },
+        'out-part0001.pmtiles': { 'header': { 'min_zoom': 2, 'max_zoom': 3, **WEST }, 'min_tile_id': 13, 'max_tile_id': 84 },
+    })
+
+    assert previous.uses_tile_id_ranges()
+    # by tile id alone, an eastern tile goes in the second slice whatever its bounds say
+    assert assign(previous, [(2, 1, 1), (2, 3, 3), (3, 0, 0), (4, 0, 0)]) == [0, 1, 1, -1]
+
+
+def test_missing_files_and_next_part_number(tmp_path):
+    previous = write_mosaic(tmp_path, {
+        'out.pmtiles': { 'header': { 'min_zoom': 0, 'max_zoom': 2, **WORLD } },
+        'out-part0003.pmtiles': { 'header': { 'min_zoom': 3, 'max_zoom': 5, **WEST } },
+        'other-part0009.pmtiles': { 'header': { 'min_zoom': 3, 'max_zoom': 5, **EAST } },
+    })
+    (tmp_path / 'out.pmtiles').write_bytes(b'')
+
+    assert previous.get_missing_files() == [ tmp_path / 'out-part0003.pmtiles', tmp_path / 'other-part0009.pmtiles' ]
+    assert previous.get_next_part_number(str(tmp_path / 'out')) == 4
+
+
+@pytest.mark.parametrize('tiles', [
+    # a run, a repeated blob out of the run, and distinct blobs
+    [ (0, b'a'), (1, b'b'), (2, b'b'), (3, b'b'), (4, b'c'), (7, b'b'), (9, b'a') ],
+    [ (5, b'x') ],
+])
+def test_read_contents(tmp_path, tiles):
+    path = tmp_path / 'out.pmtiles'
+    with open(path, 'wb') as f:
+        writer = Writer(f)
+        for tile_id, data in tiles:
+            writer.write_tile(tile_id, data)
+        writer.finalize({ 'tile_type': TileType.MVT, 'tile_compression': Compression.NONE, **WORLD }, { 'name': 'test' })
+    previous = write_mosaic(tmp_path, { 'out.pmtiles': { 'header': { 'min_zoom': 0, 'max_zoom': 2, **WORLD } } })
+
+    tile_ids, hashes, header, metadata = previous.slices[0].read_contents()
+
+    assert tile_ids.tolist() == [ tile_id for tile_id, _ in tiles ]
+    assert hashes.tolist() == [ hash(data) for _, data in tiles ]
+    assert header['addressed_tiles_count'] == len(tiles)
+    assert metadata == { 'name': 'test' }
@@ -0,0 +1,99 @@
+import os
+import json
+import gzip
+import random
+
+import pytest
+from pmtiles.tile import Compression, TileType, deserialize_header
+from pmtiles.reader import MemorySource, all_tiles
+from pmtiles.writer import Writer
+
+from pmtiles_mosaic.directory import PMTILES_HEADER_SIZE, PMTILES_ROOT_DIR_MAX_SIZE
+from pmtiles_mosaic.slice_writer import SizeOnlyPMTilesWriter, write_slice_file
+
+
+METADATA = { 'name': 'test', 'format': 'pbf' }
+# enough entries for the root directory to overflow into leaves
+NUM_TILES = 60000
+
+
+def get_header():
+    return {
+        'tile_type': TileType.MVT,
+        'tile_compression': Compression.GZIP,
+        'min_lon_e7': -1800000000,
+        'min_lat_e7': -850000000,
+        'max_lon_e7': 1800000000,
+        'max_lat_e7': 850000000,
+    }
+
+def get_tiles(case, seed=0):
+    # (tile_id, data) pairs, with tile ids spread out enough for the entries not to compress away
+    rng = random.Random(seed)
+    blobs = [ rng.randbytes(rng.randint(1, 60)) for _ in range(50) ]
+    tiles = []
+    tile_id = 0
+    while len(tiles) < NUM_TILES:
+        tile_id += rng.randint(1, 40)
+        if case == 'run_length' and len(tiles) % 2:
+            # the same blob over consecutive tile ids, a single entry
+            blob = rng.choice(blobs)
+            for _ in range(rng.randint(2, 8)):
+                tiles.append((tile_id, blob))
+                tile_id += 1
+            continue
+
+        if case in ('dedup', 'unclustered') and rng.random() < 0.6:
+            # a few blobs repeating all over
+            data = rng.choice(blobs)
+        else:
+            data = len(tiles).to_bytes(4, 'little') + rng.randbytes(rng.randint(0, 40))
+        tiles.append((tile_id, data))
+
+    if case == 'unclustered':
+        rng.shuffle(tiles)
+    return tiles
+
+def get_planned_size(tiles, spill):
+    writer = SizeOnlyPMTilesWriter(spill=spill)
+    for tile_id, data in tiles:
+        writer.add_tile(tile_id, len(data), hash(data))
+    size = (PMTILES_HEADER_SIZE + writer.get_directories_size() +
+            len(gzip.compress(json.dumps(METADATA).encode())) + writer.offset)
+    writer.close()
+    return size
+
+def write_with_library(path, tiles):
+    with open(path, 'wb') as f:
+        writer = Writer(f)
+        for tile_id, data in tiles:
+            writer.write_tile(tile_id, data)
+        writer.finalize(get_header(), METADATA)
+
+def decode(path):
+    buf = path.read_bytes()
+    header = deserialize_header(buf[:PMTILES_HEADER_SIZE])
+    return header, list(all_tiles(MemorySource(buf)))
+
+
+@pytest.mark.parametrize('case', ['distinct', 'run_length', 'dedup', 'unclustered'])
+@pytest.mark.parametrize('chunk_size', [None, 1000])
+def test_planned_size_is_written_size(tmp_path, make_spill, case, chunk_size):
+    spill = make_spill(chunk_size) if chunk_size is not None else None
+    tiles = get_tiles(case)
+
+    path = tmp_path / 'slice.pmtiles'
+    written_size = write_slice_file(path, get_header(), METADATA,
+                                    ( (tile_id, data, True) for tile_id, data in tiles ), spill=spill)
+
+    assert written_size == os.path.getsize(path)
+    assert get_planned_size(tiles, spill) == written_size
+
+    header, decoded = decode(path)
+    assert header['leaf_directory_length'] > 0
+    assert header['root_length'] <= PMTILES_ROOT_DIR_MAX_SIZE
+
+    library_path = tmp_path / 'library.pmtiles'
+    write_with_library(library_path, tiles)
+    assert decode(library_path) == (header, decoded)
+    assert os.path.getsize(library_path) == written_size
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+from pmtiles_mosaic.spill import GrowableArray, SpillArea, get_anon_memory
+
+
+DTYPE = np.dtype([('tile_id', np.uint64), ('length', np.uint32)])
+
+
+def get_batches(rng, num_batches):
+    batches = []
+    for _ in range(num_batches):
+        batch = np.zeros(rng.integers(0, 700), dtype=DTYPE)
+        batch['tile_id'] = rng.integers(0, 1 << 40, size=len(batch))
+        batch['length'] = rng.integers(0, 1 << 20, size=len(batch))
+        batches.append(batch)
+    return batches
+
+
+@pytest.mark.parametrize('chunk_size', [None, 7, 1000, 100000])
+def test_growable_array_matches_concatenate(make_spill, chunk_size):
+    # grows past several capacities, moving to a spill file once it outgrows the in memory share
+    spill = make_spill(chunk_size) if chunk_size is not None else None
+    batches = get_batches(np.random.default_rng(0), 40)
+    array = GrowableArray(DTYPE, spill=spill)
+    for batch in batches:
+        array.extend(batch)
+
+    expected = np.concatenate(batches)
+    assert len(array) == len(expected)
+    assert np.array_equal(array.view(), expected)
+    if chunk_size == 7:
+        assert isinstance(array.data, np.memmap)
+
+    array.truncate(100)
+    array.extend(batches[0])
+    assert np.array_equal(array.view(), np.concatenate((expected[:100], batches[0])))
+
+    array.release()
+    assert len(array.view()) == 0
+
+
+def test_growable_array_empty(make_spill):
+    array = GrowableArray(DTYPE, spill=make_spill(7))
+    array.extend(np.zeros(0, dtype=DTYPE))
+
+    assert len(array) == 0
+    assert len(array.view()) == 0
+
+
+def test_spill_area_takes_off_what_the_process_holds(tmp_path):
+    max_memory = get_anon_memory() + 64 * 1024 * 1024
+    spill = SpillArea(max_memory, base_dir=tmp_path)
+    try:
+        assert spill.held_memory > 0
+        assert spill.working_memory < max_memory - spill.held_memory
+    finally:
+        spill.close()
+
+    with pytest.raises(ValueError):
+        SpillArea(get_anon_memory(), base_dir=tmp_path)
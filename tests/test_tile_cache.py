@@ -0,0 +1,87 @@
+import random
+
+import mercantile
+import pytest
+
+from pmtiles_mosaic.partition import Partitioner
+from pmtiles_mosaic.tile_cache import TileCacheDir
+from pmtiles_mosaic.tile_sources import create_source_from_paths
+
+
+def get_tiles(seed=0, max_zoom=4):
+    rng = random.Random(seed)
+    return { mercantile.Tile(x=x, y=y, z=z): rng.randbytes(rng.randint(20, 300))
+             for z in range(max_zoom + 1) for x in range(1 << z) for y in range(1 << z) }
+
+def collect(source_path, cache_dir, **kwargs):
+    source_paths = [ str(source_path) ]
+    partitioner = Partitioner(create_source_from_paths(source_paths), str(cache_dir.parent / 'out'), 1024 * 1024, True,
+                              source_paths=source_paths, cache_dir=str(cache_dir), **kwargs)
+    partitioner.collect_tiles()
+    reused = partitioner.metrics.counters.get('tile_cache_reused', False)
+    tiles = { int(tile_id): bytes(partitioner.tile_cache.get(int(offset), int(size)))
+              for tile_id, offset, size in zip(partitioner.tile_index.tile_id, partitioner.tile_index.offset,
+                                               partitioner.tile_index.size) }
+    partitioner.tile_cache.close()
+    return reused, tiles
+
+
+def test_cache_is_reused_for_the_same_run(tmp_path, make_mbtiles):
+    source = make_mbtiles('source.mbtiles', get_tiles())
+    cache_dir = tmp_path / 'cache'
+
+    reused, tiles = collect(source, cache_dir)
+    assert not reused
+
+    assert collect(source, cache_dir) == (True, tiles)
+
+
+@pytest.mark.parametrize('change', ['source', 'recompress', 'exclude_transparent'])
+def test_changed_source_or_setting_invalidates_the_cache(tmp_path, make_mbtiles, change):
+    tiles = get_tiles()
+    source = make_mbtiles('source.mbtiles', tiles)
+    cache_dir = tmp_path / 'cache'
+    collect(source, cache_dir)
+
+    kwargs = {}
+    if change == 'source':
+        tiles[mercantile.Tile(x=3, y=2, z=4)] = b'changed'
+        source.unlink()
+        source = make_mbtiles('source.mbtiles', tiles)
+    else:
+        kwargs[change] = True
+    reused, cached_tiles = collect(source, cache_dir, **kwargs)
+
+    assert not reused
+    assert cached_tiles == collect(source, tmp_path / 'fresh', **kwargs)[1]
+
+
+@pytest.mark.parametrize('lost', ['manifest.json', 'tiles.bin', 'index/offset.npy', 'truncated tiles.bin'])
+def test_cache_missing_a_file_is_rejected(tmp_path, make_mbtiles, lost):
+    source = make_mbtiles('source.mbtiles', get_tiles())
+    cache_dir = tmp_path / 'cache'
+    _, tiles = collect(source, cache_dir)
+
+    if lost == 'truncated tiles.bin':
+        with open(cache_dir / 'tiles.bin', 'r+b') as f:
+            f.truncate(100)
+    else:
+        (cache_dir / lost).unlink()
+    reused, cached_tiles = collect(source, cache_dir)
+
+    assert not reused
+    assert cached_tiles == tiles
+
+
+def test_load_of_another_fingerprint(tmp_path, make_mbtiles):
+    source = make_mbtiles('source.mbtiles', get_tiles())
+    collect(source, tmp_path / 'cache')
+
+    assert TileCacheDir(tmp_path / 'cache', { 'sources': [] }).load() is None
+
+
+@pytest.mark.parametrize('kwargs', [{ 'cache_dir': 'cache' }, { 'resume': True }])
+def test_cache_dir_and_resume_need_the_source_paths(tmp_path, make_mbtiles, kwargs):
+    source = make_mbtiles('source.mbtiles', get_tiles())
+    with pytest.raises(ValueError, match='source_paths'):
+        Partitioner(create_source_from_paths([ str(source) ]), str(tmp_path / 'out'), 1024 * 1024, True, **kwargs)
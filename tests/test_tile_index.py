@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+from pmtiles_mosaic.tile_index import group_rows, group_rows_external, sort_rows_external, get_repeated_hashes
+
+
+CHUNK_SIZES = [7, 100, 1000, 100000]
+
+
+def get_random_rows(rng, num_rows):
+    # a shuffled subset of the rows of a bigger index
+    return rng.permutation(2 * num_rows)[:num_rows].astype(np.int64)
+
+
+@pytest.mark.parametrize('chunk_size', CHUNK_SIZES)
+@pytest.mark.parametrize('num_rows', [0, 1, 5000])
+def test_group_rows_external_matches_group_rows(make_spill, chunk_size, num_rows):
+    rng = np.random.default_rng(num_rows)
+    rows = get_random_rows(rng, num_rows)
+    keys = rng.integers(0, 50, size=2 * num_rows)
+
+    expected_keys, expected_rows, expected_boundaries = group_rows(rows, keys[rows])
+    unique_keys, sorted_rows, boundaries = group_rows_external(rows, lambda r: keys[r], make_spill(chunk_size))
+
+    assert unique_keys == expected_keys
+    assert np.array_equal(np.asarray(sorted_rows), expected_rows)
+    assert boundaries == expected_boundaries
+
+
+@pytest.mark.parametrize('chunk_size', CHUNK_SIZES)
+@pytest.mark.parametrize('num_rows', [0, 1, 5000])
+def test_sort_rows_external_matches_argsort(make_spill, chunk_size, num_rows):
+    rng = np.random.default_rng(num_rows)
+    rows = get_random_rows(rng, num_rows)
+    # skewed like tile ids, most of them bunched up at the top with a few repeats,
+    # and a long thin tail below
+    values = np.concatenate((rng.integers(0, 1 << 40, size=num_rows // 10),
+                             rng.integers((1 << 40) - 500, 1 << 40, size=2 * num_rows - num_rows // 10))).astype(np.uint64)
+
+    expected = rows[np.argsort(values[rows], kind='stable')]
+    sorted_rows = sort_rows_external(rows, values, make_spill(chunk_size))
+
+    assert np.array_equal(np.asarray(sorted_rows), expected)
+
+
+def test_sort_rows_external_with_a_single_value(make_spill):
+    rows = np.arange(1000, dtype=np.int64)[::-1].copy()
+    values = np.full(1000, 42, dtype=np.uint64)
+
+    assert np.array_equal(np.asarray(sort_rows_external(rows, values, make_spill(7))), rows)
+
+
+@pytest.mark.parametrize('chunk_size', CHUNK_SIZES)
+@pytest.mark.parametrize('num_rows', [0, 1, 5000])
+def test_get_repeated_hashes_matches_unique(make_spill, chunk_size, num_rows):
+    rng = np.random.default_rng(num_rows)
+    # hashes span the whole int64 range, negative ones included, and one blob repeats all over
+    distinct = rng.integers(np.iinfo(np.int64).min, np.iinfo(np.int64).max, size=max(num_rows // 2, 1))
+    content_hash = rng.choice(distinct, size=num_rows)
+    content_hash[::3] = distinct[0]
+
+    hashes, counts = np.unique(content_hash, return_counts=True)
+    repeated_hashes = get_repeated_hashes(content_hash, make_spill(chunk_size))
+
+    assert repeated_hashes.dtype == np.int64
+    assert np.array_equal(repeated_hashes, hashes[counts > 1])
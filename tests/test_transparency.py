@@ -0,0 +1,62 @@
+import io
+import gzip
+import logging
+
+import pytest
+from PIL import Image
+from pmtiles.tile import TileType
+
+from pmtiles_mosaic.transparency import TransparencyChecker
+
+
+def get_png(color, mode='RGBA'):
+    f = io.BytesIO()
+    Image.new(mode, (8, 8), color).save(f, format='PNG')
+    return f.getvalue()
+
+TRANSPARENT = get_png((0, 0, 0, 0))
+OPAQUE = get_png((10, 20, 30, 255))
+RGB = get_png((10, 20, 30), mode='RGB')
+BROKEN = b'\x89PNG\r\n\x1a\n not really a png'
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_transparent_tiles_are_dropped(workers):
+    checker = TransparencyChecker(TileType.PNG, workers=workers, batch_size=3)
+    tiles = [TRANSPARENT, OPAQUE, gzip.compress(TRANSPARENT), RGB, TRANSPARENT, OPAQUE, get_png((0, 0, 0, 1))]
+
+    kept = [ i for i, _ in checker.filter_all(enumerate(tiles)) ]
+    checker.close()
+
+    assert kept == [1, 3, 5, 6]
+    assert (checker.misses, checker.hits) == (5, 2)
+
+
+def test_tile_that_fails_to_decode_is_kept_and_logged(caplog):
+    logger = logging.getLogger('test_transparency')
+    checker = TransparencyChecker(TileType.PNG, logger=logger)
+
+    with caplog.at_level(logging.WARNING, logger='test_transparency'):
+        assert checker.check_all([BROKEN, TRANSPARENT]) == [False, True]
+
+    assert len(caplog.records) == 1
+    assert 'Error checking transparency' in caplog.text
+    # the traceback of the error comes along
+    assert 'Traceback' in caplog.text and 'UnidentifiedImageError' in caplog.text
+
+
+def test_results_are_bounded():
+    checker = TransparencyChecker(TileType.PNG, max_results=4)
+    tiles = [ get_png((i, 0, 0, 255)) for i in range(10) ]
+
+    # the tile seen again and again stays while the ones seen once come and go
+    for tile in tiles:
+        assert checker.check_all([tile, TRANSPARENT]) == [False, True]
+        assert len(checker.results) <= 4
+
+    assert checker.get_key(TRANSPARENT) in checker.results
+    assert (checker.misses, checker.hits) == (11, 9)
+
+    # a tile that fell out of the memo is decoded again
+    assert checker.check_all([tiles[0]]) == [False]
+    assert (checker.misses, checker.hits) == (12, 9)